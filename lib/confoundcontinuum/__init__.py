@@ -7,6 +7,8 @@ from . import visualize  # noqa
 from . import features  # noqa
 from . import atlases  # noqa
 from . import pipelines  # noqa
+from . import jobs  # noqa
+from . import benchmark  # noqa
 
 from ._classes import LinearSVRHeuristicC  # noqa
 from ._classes import HeuristicWrapper  # noqa
@@ -1,6 +1,10 @@
+from functools import lru_cache
+import hashlib
+import json
 from pathlib import Path
 import io
 import os
+import tempfile
 import requests
 import wget
 import shutil
@@ -85,6 +89,64 @@ def list_atlases():
     return sorted(_available_atlases.keys())
 
 
+def get_atlas_kwargs(name):
+    """
+    Get the keyword arguments to load an available atlas with `load_atlas`.
+    The highest valid resolution of the atlas is used.
+    Parameters
+    ----------
+    name : str
+        The name of the atlas.
+        Check valid options by calling `list_atlases`.
+    Returns
+    -------
+    kwargs : dict
+        Keyword arguments to pass on to `load_atlas` together with `name`.
+    """
+    if name not in _available_atlases:
+        raise_error(
+            f'The atlas {name} is not available. Valid atlases: '
+            f'{list_atlases()}')
+    atlas_definition = _available_atlases[name]
+    t_family = atlas_definition['family']
+
+    kwargs = {}
+    if 'valid_resolutions' in atlas_definition:
+        kwargs['resolution'] = min(atlas_definition['valid_resolutions'])
+    if t_family == 'Schaefer':
+        kwargs['n_rois'] = atlas_definition['n_rois']
+        kwargs['yeo_network'] = atlas_definition['yeo_networks']
+    elif t_family == 'Tian':
+        kwargs['scale'] = atlas_definition['scale']
+        kwargs['magneticfield'] = atlas_definition['magneticfield']
+        kwargs['space'] = name.split('x')[-1]
+    elif t_family == 'SUIT':
+        kwargs['space'] = atlas_definition['space']
+    return kwargs
+
+
+def get_features_atlas_name(name):
+    """
+    Get the atlas name used for the feature tables of an available atlas.
+    The Schaefer atlases with 7 networks keep the names used by the single
+    family extraction scripts (e.g. 'schaefer2018_100parcels'), so that the
+    merge and conversion scripts apply to all feature databases.
+    Parameters
+    ----------
+    name : str
+        The name of the atlas.
+        Check valid options by calling `list_atlases`.
+    Returns
+    -------
+    features_name : str
+        The atlas name of the feature tables.
+    """
+    atlas_kwargs = get_atlas_kwargs(name)
+    if name.startswith('Schaefer') and atlas_kwargs['yeo_network'] == 7:
+        return f'schaefer2018_{atlas_kwargs["n_rois"]}parcels'
+    return name
+
+
 # def _check_resolution(resolution, valid_resolution):
 #     if resolution is None:
 #         return None
@@ -168,6 +230,182 @@ def load_atlas(name, atlas_dir=None, resolution=None, path_only=False,
     return atlas_img, atlas_labels, atlas_fname
 
 
+def get_atlas(name, atlas_dir=None):
+    """
+    Get an available atlas from the in-process atlas cache.
+    The atlas is retrieved and loaded with `load_atlas` (using the arguments
+    of `get_atlas_kwargs`) on the first call only. Later calls with the same
+    name and atlas_dir return the same (read-only) objects, so that an atlas
+    is loaded once per process for all subjects and atlases. The least
+    recently used atlases are dropped from the cache.
+    Parameters
+    ----------
+    name : str
+        The name of the atlas.
+        Check valid options by calling `list_atlases`.
+    atlas_dir: path
+        Path where the atlas files are stored.
+        Defaults to: $HOME/junifer/data/atlas
+    Returns
+    -------
+    atlas_img : nibabel.Nifti1Image
+        Atlas image with its (read-only) data in memory.
+    atlas_labels : tuple of str
+        Atlas labels.
+    atlas_rois : np.ndarray
+        Sorted (read-only) label values of the ROIs in the atlas image
+        (without background 0).
+    """
+    if atlas_dir is not None:
+        atlas_dir = Path(atlas_dir).absolute()
+    return _get_atlas(name, atlas_dir)
+
+
+@lru_cache(maxsize=16)
+def _get_atlas(name, atlas_dir):
+    """Load an atlas for get_atlas() (memoized)"""
+    atlas_img, atlas_labels, _ = load_atlas(
+        name=name, atlas_dir=atlas_dir, **get_atlas_kwargs(name))
+    atlas_data = np.asanyarray(atlas_img.dataobj)
+    atlas_data.flags.writeable = False
+    atlas_img = nib.Nifti1Image(atlas_data, atlas_img.affine, atlas_img.header)
+    atlas_rois = np.unique(atlas_data)
+    atlas_rois = atlas_rois[atlas_rois != 0]
+    atlas_rois.flags.writeable = False
+    logger.info(f'Atlas {name} with {len(atlas_rois)} ROIs cached.')
+    return atlas_img, tuple(atlas_labels), atlas_rois
+
+
+def import_atlases(store_dir, names=None, atlas_dir=None):
+    """
+    Imports atlases into a local content-addressed atlas store.
+    The atlases are retrieved into atlas_dir (downloaded only if missing
+    there) and all files of their directories are stored once under the
+    SHA-256 checksum of their content. The store keeps the directory layout
+    of atlas_dir as (relative) symbolic links to the stored files, so that it
+    can be passed as atlas_dir to `load_atlas` and `get_atlas`. Atlases are
+    then resolved from the store without network access and without copying
+    them per job.
+    Parameters
+    ----------
+    store_dir : path
+        Path of the atlas store (created if missing).
+    names : list of str
+        The names of the atlases to import. Defaults to None (all atlases of
+        `list_atlases`).
+    atlas_dir: path
+        Path where the atlas files are stored (or downloaded to).
+        Defaults to: $HOME/junifer/data/atlas
+    Returns
+    -------
+    index : dict
+        The index of the store, i.e. the checksum ('sha256') and size in
+        bytes ('size') of each stored file by its path relative to atlas_dir.
+    """
+    store_dir = Path(store_dir)
+    if names is None:
+        names = list_atlases()
+    if atlas_dir is None:
+        atlas_dir = Path().home() / 'junifer' / 'data' / 'atlas'
+    atlas_dir = Path(atlas_dir).absolute()
+    if _is_atlas_store(atlas_dir):
+        raise_error(f'Cannot import atlases from the atlas store {atlas_dir}.')
+    index = _read_atlas_store_index(store_dir)
+    for name in names:
+        if _available_atlases[name]['family'] == 'CustomUserAtlas':
+            raise_error(f'The custom atlas {name} cannot be imported.')
+        _, _, atlas_fname = load_atlas(
+            name=name, atlas_dir=atlas_dir, path_only=True,
+            **get_atlas_kwargs(name))
+        for fname in sorted(Path(atlas_fname).absolute().parent.iterdir()):
+            if fname.is_file():
+                rel_fname = fname.relative_to(atlas_dir).as_posix()
+                index[rel_fname] = _store_atlas_file(
+                    store_dir, fname, rel_fname)
+        logger.info(f'Atlas {name} imported into {store_dir}.')
+
+    # replace the index at once, so that it is never read half written
+    with tempfile.NamedTemporaryFile(
+            'w', dir=store_dir, suffix='.tmp', delete=False) as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.replace(f.name, _get_atlas_store_fname(store_dir, 'index'))
+    return index
+
+
+def verify_atlas_store(store_dir):
+    """
+    Verifies the checksums of all files in an atlas store.
+    Parameters
+    ----------
+    store_dir : path
+        Path of the atlas store.
+    Returns
+    -------
+    invalid_fnames : list of str
+        Paths (relative to the atlas directory) of the files that are missing
+        in the store or whose content does not match their checksum.
+    """
+    store_dir = Path(store_dir)
+    if not _is_atlas_store(store_dir):
+        raise_error(f'{store_dir} is not an atlas store.')
+    invalid_fnames = []
+    for rel_fname, t_entry in _read_atlas_store_index(store_dir).items():
+        fname = _get_atlas_store_fname(store_dir, 'atlases') / rel_fname
+        if not fname.exists() or _hash_file(fname) != t_entry['sha256']:
+            invalid_fnames.append(rel_fname)
+    return invalid_fnames
+
+
+def _get_atlas_store_fname(store_dir, kind):
+    """Path of the index ('index'), the stored files ('objects') or the
+    atlas directory layout ('atlases') of an atlas store"""
+    return Path(store_dir) / {
+        'index': 'index.json', 'objects': 'objects',
+        'atlases': 'atlases'}[kind]
+
+
+def _is_atlas_store(atlas_dir):
+    return _get_atlas_store_fname(atlas_dir, 'index').exists()
+
+
+def _read_atlas_store_index(store_dir):
+    index_fname = _get_atlas_store_fname(store_dir, 'index')
+    if not index_fname.exists():
+        return {}
+    with open(index_fname, 'r') as f:
+        return json.load(f)
+
+
+def _hash_file(fname, chunk_size=2 ** 20):
+    sha256 = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _store_atlas_file(store_dir, fname, rel_fname):
+    """Add a file to an atlas store and link it at rel_fname"""
+    sha256 = _hash_file(fname)
+    # keep the extensions, as nibabel detects the file format from them
+    object_fname = _get_atlas_store_fname(store_dir, 'objects') / (
+        sha256[:2]) / (sha256 + ''.join(Path(fname).suffixes))
+    if not object_fname.exists():
+        object_fname.parent.mkdir(exist_ok=True, parents=True)
+        with tempfile.NamedTemporaryFile(
+                dir=object_fname.parent, suffix='.tmp', delete=False) as f:
+            with open(fname, 'rb') as f_in:
+                shutil.copyfileobj(f_in, f)
+        os.chmod(f.name, 0o444)
+        os.replace(f.name, object_fname)
+    link_fname = _get_atlas_store_fname(store_dir, 'atlases') / rel_fname
+    link_fname.parent.mkdir(exist_ok=True, parents=True)
+    if link_fname.is_symlink() or link_fname.exists():
+        link_fname.unlink()
+    os.symlink(os.path.relpath(object_fname, link_fname.parent), link_fname)
+    return {'sha256': sha256, 'size': object_fname.stat().st_size}
+
+
 def _retrieve_atlas(family, atlas_dir=None, resolution=None, **kwargs):
     """
     Retrieves a brain atlas object either from nilearn or a specified online
@@ -179,7 +417,9 @@ def _retrieve_atlas(family, atlas_dir=None, resolution=None, **kwargs):
     family : str
         Specify by name of atlas family, e.g. 'Schaefer'.
     atlas_dir: path
-        Path to where to store the retrieved atlas file.
+        Path to where to store the retrieved atlas file. If it is an atlas
+        store (see `import_atlases`), the atlas is only resolved from the
+        store and never downloaded.
         Defaults to: $HOME/junifer/data/atlas
     resolution : int
         The (desired) resolution of the atlas to load. If its not available,
@@ -219,19 +459,23 @@ def _retrieve_atlas(family, atlas_dir=None, resolution=None, **kwargs):
     if atlas_dir is None:
         atlas_dir = Path().home() / 'junifer' / 'data' / 'atlas'
         atlas_dir.mkdir(exist_ok=True, parents=True)
+    atlas_dir = Path(atlas_dir)
+    offline = _is_atlas_store(atlas_dir)
+    if offline:
+        atlas_dir = _get_atlas_store_fname(atlas_dir, 'atlases')
 
     logger.info(f"Fetching one of {family} atlas.")
 
     # retrieval details per atlas
     if family == 'Schaefer':
-        atlas_fname, atl_labels = \
-            _retrieve_schaefer(atlas_dir, resolution, **kwargs)
+        atlas_fname, atl_labels = _retrieve_schaefer(
+            atlas_dir, resolution, offline=offline, **kwargs)
     elif family == 'SUIT':
-        atlas_fname, atl_labels = \
-            _retrieve_suit(atlas_dir, resolution, **kwargs)
+        atlas_fname, atl_labels = _retrieve_suit(
+            atlas_dir, resolution, offline=offline, **kwargs)
     elif family == 'Tian':
-        atlas_fname, atl_labels = \
-            _retrieve_tian(atlas_dir, resolution, **kwargs)
+        atlas_fname, atl_labels = _retrieve_tian(
+            atlas_dir, resolution, offline=offline, **kwargs)
     else:
         raise_error(
             f"The provided atlas name {family} cannot be retrieved. ")
@@ -256,7 +500,8 @@ def _closest_resolution(resolution, valid_resolution):
     return closest
 
 
-def _retrieve_schaefer(atlas_dir, resolution, n_rois=None, yeo_network=7):
+def _retrieve_schaefer(atlas_dir, resolution, n_rois=None, yeo_network=7,
+                       offline=False):
     logger.info('Atlas parameters:')
     logger.info(f'\tn_rois: {n_rois}')
     logger.info(f'\tyeo_network: {yeo_network}')
@@ -286,6 +531,8 @@ def _retrieve_schaefer(atlas_dir, resolution, n_rois=None, yeo_network=7):
 
     # check existance of atlas
     if not (atlas_fname.exists() and atlas_lname.exists()):
+        if offline:
+            _raise_missing_atlas(atlas_dir, atlas_fname)
         logger.info(
             'At least one of the atlas files is missing. '
             'Fetching using nilearn.')
@@ -310,7 +557,7 @@ def _retrieve_schaefer(atlas_dir, resolution, n_rois=None, yeo_network=7):
 
 def _retrieve_tian(
     atlas_dir, resolution, scale=None, space='MNI6thgeneration',
-        magneticfield='3T'):
+        magneticfield='3T', offline=False):
 
     # check validity of atlas parameters
     _valid_scales = [1, 2, 3, 4]
@@ -319,10 +566,10 @@ def _retrieve_tian(
         raise_error(
             f'The parameter `scale` ({scale}) needs to be one of the '
             f'following: {_valid_scales}')
-    if field not in _valid_fields:
+    if magneticfield not in _valid_fields:
         raise_error(
-            f'The parameter `magneticfield` ({field}) needs to be one of '
-            f'the following: {_valid_fields}')
+            f'The parameter `magneticfield` ({magneticfield}) needs to be one '
+            f'of the following: {_valid_fields}')
 
     if magneticfield == '3T':
         _valid_spaces = ['MNI6thgeneration', 'MNInonlinear2009cAsym']
@@ -375,15 +622,18 @@ def _retrieve_tian(
             ('parcel_' + str(x)) for x in np.arange(1, scale7Trois[scale]+1)]
         atlas_lname = atlas_fname_base_7T / (
             f'Tian_Subcortex_S{scale}_7T_labelnumbering.txt')
-        with open(atlas_lname, 'w') as filehandle:
-            for listitem in labels:
-                filehandle.write('%s\n' % listitem)
+        if not (atlas_lname.exists() or offline):
+            with open(atlas_lname, 'w') as filehandle:
+                for listitem in labels:
+                    filehandle.write('%s\n' % listitem)
         logger.info(
             'Currently there are no labels provided for the 7T Tian atlas. A '
             'simple numbering scheme for distinction was therefore used.')
 
     # check existance of atlas
     if not (atlas_fname.exists() and atlas_lname.exists()):
+        if offline:
+            _raise_missing_atlas(atlas_dir, atlas_fname)
         logger.info(
             'At least one of the atlas files is missing. '
             'Fetching.')
@@ -411,7 +661,7 @@ def _retrieve_tian(
     return atlas_fname, labels
 
 
-def _retrieve_suit(out_dir, resolution, space='MNI'):
+def _retrieve_suit(out_dir, resolution, space='MNI', offline=False):
     logger.info('Atlas parameters:')
     logger.info(f'\tspace: {space}')
 
@@ -432,10 +682,12 @@ def _retrieve_suit(out_dir, resolution, space='MNI'):
         f'SUIT_{space}Space_{resolution}mm.nii')
     atlas_lname = out_dir / 'SUIT' / (
         f'SUIT_{space}Space_{resolution}mm.tsv')
-    Path(os.path.dirname(atlas_fname)).mkdir(exist_ok=True, parents=True)
 
     # check existance of atlas
     if not (atlas_fname.exists() and atlas_lname.exists()):
+        if offline:
+            _raise_missing_atlas(out_dir, atlas_fname)
+        Path(os.path.dirname(atlas_fname)).mkdir(exist_ok=True, parents=True)
         logger.info(
             'At least one of the atlas files is missing. '
             'Fetching.')
@@ -470,4 +722,10 @@ def _retrieve_suit(out_dir, resolution, space='MNI'):
     labels = pd.read_csv(
         atlas_lname, sep='\t', usecols=['name'])['name'].to_list()
 
-    return atlas_fname, labels
\ No newline at end of file
+    return atlas_fname, labels
+
+
+def _raise_missing_atlas(atlas_dir, atlas_fname):
+    raise_error(
+        f'The atlas {Path(atlas_fname).name} is missing in the atlas store '
+        f'{Path(atlas_dir).parent}. Import it with `import_atlases` first.')
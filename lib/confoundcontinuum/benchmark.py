@@ -0,0 +1,462 @@
+from contextlib import contextmanager
+from pathlib import Path
+import resource
+import time
+import tracemalloc
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+from nilearn import image
+from scipy.spatial import cKDTree
+
+from confoundcontinuum.features import (
+    _get_funcbyname, _moment_aggregations, get_atlas_index, get_roi_moments,
+    get_roi_qc, get_roi_values, sort_roi_values)
+from confoundcontinuum.io import get_engine, save_features
+from confoundcontinuum.logging import logger, raise_error
+
+# MNI field of view (bounding box in mm) shared by all synthetic volumes. On
+# this box, 1.5 mm voxels give the 121 x 145 x 121 grid of the CAT VBM output
+_mni_origin = np.array([-90., -126., -72.])
+_mni_extent = np.array([180., 216., 180.])
+
+# brain and atlas regions as ellipsoids in mm: (center, radii)
+_brain_region = ((0., -18., 18.), (68., 100., 80.))
+_atlas_regions = {
+    # cortical shell of the brain above the cerebellum
+    'schaefer': {'n_rois': 400, 'shell': 0.8, 'min_z': -30.,
+                 'region': _brain_region},
+    # subcortex
+    'tian': {'n_rois': 54, 'region': ((0., -10., 5.), (30., 25., 20.))},
+    # cerebellum
+    'suit': {'n_rois': 34, 'region': ((0., -60., -35.), (50., 30., 25.))},
+}
+
+
+def _get_grid(voxel_size):
+    """Shape and affine of the MNI field of view with isotropic voxels"""
+    shape = tuple(int(x) for x in np.round(_mni_extent / voxel_size) + 1)
+    affine = np.diag([voxel_size] * 3 + [1.])
+    affine[:3, 3] = _mni_origin
+    return shape, affine
+
+
+def _get_ellipsoid_radius(shape, affine, region):
+    """Normalized ellipsoid radius (1 on the surface) of each voxel"""
+    center, radii = (np.asarray(x) for x in region)
+    coords = [
+        affine[i, i] * np.arange(shape[i]) + affine[i, 3] - center[i]
+        for i in range(3)]
+    radius = sum(
+        np.square(x / r).reshape([-1 if i == j else 1 for j in range(3)])
+        for i, (x, r) in enumerate(zip(coords, radii)))
+    return np.sqrt(radius), coords
+
+
+def make_synthetic_vbm(voxel_size=1.5, seed=0):
+    """
+    Generates a synthetic VBM nifti (modulated gray matter density as
+    outputted by CAT) on the MNI field of view. Voxels in ellipsoids of
+    cerebrum and cerebellum get smooth spatial patterns plus noise in
+    [0, 1], voxels outside are 0.
+
+    Parameters
+    ----------
+    voxel_size : float
+        Isotropic voxel size in mm. Defaults to 1.5 (121 x 145 x 121 voxels,
+        as the CAT VBM output).
+    seed : int
+        Seed of the random number generator. Defaults to 0.
+
+    Returns
+    -------
+    vbm_nifti : nibabel.Nifti1Image
+        Synthetic VBM nifti (float32).
+    """
+    rng = np.random.RandomState(seed)
+    shape, affine = _get_grid(voxel_size)
+    radius, coords = _get_ellipsoid_radius(shape, affine, _brain_region)
+    phase = rng.uniform(0, 2 * np.pi, size=3)
+    pattern = sum(
+        np.sin(x / 12. + p).reshape([-1 if i == j else 1 for j in range(3)])
+        for i, (x, p) in enumerate(zip(coords, phase)))
+    data = 0.5 + 0.1 * pattern + rng.normal(0, 0.1, size=shape)
+    # more gray matter towards the cortex
+    data += 0.2 * radius
+    data = np.clip(data, 0, 1).astype(np.float32)
+    # cerebrum and cerebellum
+    cerebellum, _ = _get_ellipsoid_radius(
+        shape, affine, _atlas_regions['suit']['region'])
+    data[(radius > 1) & (cerebellum > 1)] = 0
+    return nib.Nifti1Image(data, affine)
+
+
+def make_synthetic_atlas(kind, n_rois=None, voxel_size=1., seed=0):
+    """
+    Generates a synthetic label volume resembling the atlases used for the
+    extraction of gray matter density: 'schaefer' (cortical parcels),
+    'tian' (subcortical parcels) or 'suit' (cerebellar parcels). The region
+    of the atlas is split into n_rois contiguous parcels (Voronoi cells of
+    random seed voxels).
+
+    Parameters
+    ----------
+    kind : str
+        Kind of atlas. Valid inputs: 'schaefer', 'tian' and 'suit'.
+    n_rois : int
+        Number of ROIs. Defaults to 400 for 'schaefer', 54 for 'tian' and 34
+        for 'suit'.
+    voxel_size : float
+        Isotropic voxel size in mm. Defaults to 1 (as the atlases are
+        resampled from 1 mm to the VBM grid).
+    seed : int
+        Seed of the random number generator. Defaults to 0.
+
+    Returns
+    -------
+    atlas_nifti : nibabel.Nifti1Image
+        Synthetic atlas with labels 1 to n_rois and 0 as background (int32).
+    """
+    if kind not in _atlas_regions:
+        raise_error(
+            f'Atlas kind {kind} unknown. Valid kinds: '
+            f'{list(_atlas_regions.keys())}.')
+    params = _atlas_regions[kind]
+    if n_rois is None:
+        n_rois = params['n_rois']
+    rng = np.random.RandomState(seed)
+    shape, affine = _get_grid(voxel_size)
+    radius, coords = _get_ellipsoid_radius(shape, affine, params['region'])
+    in_region = (radius <= 1) & (radius >= params.get('shell', 0))
+    if 'min_z' in params:
+        in_region &= (coords[2] >= params['min_z']).reshape(1, 1, -1)
+    voxels = np.argwhere(in_region)
+    if len(voxels) < n_rois:
+        raise_error(
+            f'The {kind} region has only {len(voxels)} voxels at '
+            f'{voxel_size} mm, less than the {n_rois} ROIs.')
+
+    # each voxel gets the label of the closest seed voxel
+    seeds = voxels[rng.choice(len(voxels), size=n_rois, replace=False)]
+    _, labels = cKDTree(seeds).query(voxels)
+    data = np.zeros(shape, dtype=np.int32)
+    data[tuple(voxels.T)] = labels + 1
+    return nib.Nifti1Image(data, affine)
+
+
+@contextmanager
+def _measure(timings, stage, track_memory):
+    """Measures wall time and peak of traced memory of a stage"""
+    if track_memory:
+        tracemalloc.reset_peak()
+        start_memory = tracemalloc.get_traced_memory()[0]
+    start_time = time.perf_counter()
+    yield
+    timings[stage] = {'time_s': time.perf_counter() - start_time}
+    if track_memory:
+        timings[stage]['peak_mb'] = (
+            tracemalloc.get_traced_memory()[1] - start_memory) / 2 ** 20
+
+
+def benchmark_gmd(vbm_fnames, atlas_niftis, uri, aggregation=None,
+                  limits=None, subject_ids=None, session='ses-2', qc=False,
+                  track_memory=True):
+    """
+    Benchmarks the extraction of gray matter density (GMD) stage by stage
+    for each subject and atlas, as done by get_gmd(): atlas resampling to
+    the VBM grid, building the voxel-to-ROI index, masking (reading the
+    voxel values of the atlas from the VBM nifti), ROI moments, sorting the
+    values (if order statistics are aggregated), each aggregation, quality
+    control metrics (if qc) and saving the results.
+
+    Parameters
+    ----------
+    vbm_fnames : list of str or Path
+        Paths of the VBM niftis, e.g. synthetic volumes written from
+        make_synthetic_vbm(). Read from disk in the masking stage.
+    atlas_niftis : dict
+        Atlas niftis (values, e.g. from make_synthetic_atlas()) by atlas
+        name (keys).
+    uri : str
+        Connection URI of the database to save the results to (see
+        confoundcontinuum.io.save_features()).
+    aggregation : list
+        Aggregation methods (see get_gmd()). Defaults to
+        ['winsorized_mean', 'mean', 'std'].
+    limits : array
+        Limits of the winsorized (or trimmed) mean. Defaults to [0.1, 0.1].
+    subject_ids : list of str
+        Subject IDs to save the results with. Defaults to the file names of
+        vbm_fnames.
+    session : str
+        Session to save the results with. Defaults to 'ses-2'.
+    qc : bool
+        Whether to also benchmark (and save) the quality control metrics
+        (see get_roi_qc()). Defaults to False.
+    track_memory : bool
+        Whether to measure the peak memory allocated by each stage with
+        tracemalloc (this slows down the stages a little). Defaults to True.
+
+    Returns
+    -------
+    results : pandas.DataFrame
+        One row per subject, atlas and stage with the columns SubjectID,
+        atlas_name, stage, time_s, n_voxels (voxels processed by the stage:
+        the VBM grid for resample and index, the voxels of the atlas
+        otherwise), voxels_per_s, peak_mb (peak memory allocated by the
+        stage, NaN without track_memory) and max_rss_mb (maximum resident
+        memory of the process so far).
+    """
+    if aggregation is None:
+        aggregation = ['winsorized_mean', 'mean', 'std']
+    if limits is None:
+        limits = [0.1, 0.1]
+    if subject_ids is None:
+        subject_ids = [Path(x).name.split('.')[0] for x in vbm_fnames]
+    if len(subject_ids) != len(vbm_fnames):
+        raise_error('One subject ID per VBM nifti is required.')
+    agg_func_params = {
+        'winsorized_mean': {'limits': limits},
+        'trimmed_mean': {'limits': limits},
+    }
+    agg_funcs = {
+        x: _get_funcbyname(x, agg_func_params.get(x), segmented=True)
+        for x in aggregation if x not in _moment_aggregations}
+
+    started_tracing = track_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    results = []
+    try:
+        for subid, vbm_fname in zip(subject_ids, vbm_fnames):
+            # header only, the data is read in the masking stage
+            vbm_nifti = nib.load(Path(vbm_fname).as_posix())
+            n_grid = int(np.prod(vbm_nifti.shape[:3]))
+            for atlas_name, atlas_nifti in atlas_niftis.items():
+                timings = {}
+                with _measure(timings, 'resample', track_memory):
+                    atlas_re = image.resample_to_img(
+                        atlas_nifti, vbm_nifti, interpolation='nearest')
+                with _measure(timings, 'index', track_memory):
+                    atlas_index = get_atlas_index(atlas_re, vbm_nifti)
+                with _measure(timings, 'mask', track_memory):
+                    values, nonfinite = get_roi_values(
+                        vbm_fname, atlas_index, return_nonfinite=True)
+                with _measure(timings, 'moments', track_memory):
+                    moments = get_roi_moments(values, atlas_index)
+                if len(agg_funcs) > 0:
+                    with _measure(timings, 'sort', track_memory):
+                        sorted_values, offsets = sort_roi_values(
+                            values, atlas_index)
+                gmd_aggregated = {}
+                for agg_name in aggregation:
+                    with _measure(timings, agg_name, track_memory):
+                        if agg_name in agg_funcs:
+                            gmd_aggregated[agg_name] = agg_funcs[agg_name](
+                                sorted_values, offsets)
+                        else:
+                            gmd_aggregated[agg_name] = \
+                                _moment_aggregations[agg_name](moments)
+                if qc:
+                    with _measure(timings, 'qc', track_memory):
+                        roi_qc = get_roi_qc(
+                            values, atlas_index, limits, nonfinite)
+                    gmd_aggregated.update(
+                        {f'qc_{k}': v for k, v in roi_qc.items()})
+                labels = [str(x) for x in atlas_index['rois']]
+                with _measure(timings, 'save', track_memory):
+                    for agg_name, gmd in gmd_aggregated.items():
+                        gmd = np.atleast_2d(gmd)
+                        if gmd.shape[0] > 1:
+                            # histogram sketch: one row per bin
+                            index = pd.MultiIndex.from_tuples(
+                                [(subid, session, i_bin)
+                                 for i_bin in range(gmd.shape[0])],
+                                names=['SubjectID', 'Session', 'Bin'])
+                        else:
+                            index = pd.MultiIndex.from_tuples(
+                                [(subid, session)],
+                                names=['SubjectID', 'Session'])
+                        df = pd.DataFrame(gmd, index=index, columns=labels)
+                        save_features(df, uri, 'gmd', atlas_name, agg_name)
+
+                n_voxels = len(atlas_index['voxels'])
+                max_rss_mb = resource.getrusage(
+                    resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+                for stage, t_timing in timings.items():
+                    t_n_voxels = n_grid if stage in ['resample', 'index'] \
+                        else n_voxels
+                    results.append({
+                        'SubjectID': subid,
+                        'atlas_name': atlas_name,
+                        'stage': stage,
+                        'time_s': t_timing['time_s'],
+                        'n_voxels': t_n_voxels,
+                        'voxels_per_s': t_n_voxels / t_timing['time_s'],
+                        'peak_mb': t_timing.get('peak_mb', np.nan),
+                        'max_rss_mb': max_rss_mb,
+                    })
+                total_time = sum(x['time_s'] for x in timings.values())
+                logger.info(
+                    f'Subject {subid}, atlas {atlas_name}: {n_voxels} voxels '
+                    f'in {total_time:.3f} s.')
+    finally:
+        if started_tracing:
+            tracemalloc.stop()
+    return pd.DataFrame(results)
+
+
+def summarize_benchmark(results):
+    """
+    Summarizes the results of benchmark_gmd() per atlas and stage over
+    subjects. The stage 'total' sums all stages of a subject.
+
+    Parameters
+    ----------
+    results : pandas.DataFrame
+        Results as returned by benchmark_gmd().
+
+    Returns
+    -------
+    summary : pandas.DataFrame
+        One row per atlas and stage (index) with the columns n_subjects,
+        time_s (median), time_s_total (sum over subjects), voxels_per_s
+        (median), peak_mb (maximum) and max_rss_mb (maximum).
+    """
+    totals = results.groupby(
+        ['SubjectID', 'atlas_name'], as_index=False, sort=False).agg(
+            time_s=('time_s', 'sum'), n_voxels=('n_voxels', 'min'),
+            peak_mb=('peak_mb', 'max'), max_rss_mb=('max_rss_mb', 'max'))
+    totals['stage'] = 'total'
+    totals['voxels_per_s'] = totals['n_voxels'] / totals['time_s']
+    summary = pd.concat([results, totals]).groupby(
+        ['atlas_name', 'stage'], sort=False).agg(
+            n_subjects=('SubjectID', 'nunique'),
+            time_s=('time_s', 'median'),
+            time_s_total=('time_s', 'sum'),
+            voxels_per_s=('voxels_per_s', 'median'),
+            peak_mb=('peak_mb', 'max'),
+            max_rss_mb=('max_rss_mb', 'max'))
+    return summary
+
+
+def make_synthetic_features(n_subjects=1000, n_rois=1000, seed=0):
+    """
+    Generates a synthetic feature table as saved by the extraction scripts:
+    one row per subject (index SubjectID and Session) and one column of GMD
+    values in [0, 1] per ROI.
+
+    Parameters
+    ----------
+    n_subjects : int
+        Number of subjects (rows). Defaults to 1000.
+    n_rois : int
+        Number of ROIs (columns). Defaults to 1000.
+    seed : int
+        Seed of the random number generator. Defaults to 0.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        Synthetic features.
+    """
+    rng = np.random.RandomState(seed)
+    index = pd.MultiIndex.from_arrays(
+        [[f'sub-{x:07d}' for x in range(n_subjects)], ['ses-2'] * n_subjects],
+        names=['SubjectID', 'Session'])
+    return pd.DataFrame(
+        rng.uniform(0, 1, size=(n_subjects, n_rois)), index=index,
+        columns=[f'roi_{x}' for x in range(n_rois)])
+
+
+def benchmark_save_features(db_dir, n_subjects=1000, n_rois=1000,
+                            chunksize=None, n_single=100, seed=0,
+                            target=1e6):
+    """
+    Benchmarks the throughput of save_features() on wide synthetic feature
+    tables (see make_synthetic_features()), each case on a new SQLite
+    database in db_dir:
+    table: the table of all subjects is saved at once (as when merging or
+    compacting), with pandas to_sql (reference), save_features() and
+    save_features() with scratch pragmas.
+    subject: n_single subjects are saved one by one (as during the
+    extraction), with save_features() and with scratch pragmas. Their
+    throughput is bounded by one transaction per subject and is reported
+    separately, without throughput target.
+
+    Parameters
+    ----------
+    db_dir : str or Path
+        Directory for the databases, ideally on the disk to benchmark.
+    n_subjects : int
+        Number of subjects of the table. Defaults to 1000.
+    n_rois : int
+        Number of ROIs (columns). Defaults to 1000.
+    chunksize : int
+        Rows per transaction of save_features() (see there). Defaults to
+        None (one transaction).
+    n_single : int
+        Number of subjects saved one by one. Defaults to 100.
+    seed : int
+        Seed of the random number generator. Defaults to 0.
+    target : float
+        Throughput target of the whole-table saves in values (rows x
+        columns) per second, for a SQLite database on a local disk. Defaults
+        to 1e6.
+
+    Returns
+    -------
+    results : pandas.DataFrame
+        One row per case and method with the columns case, method, n_rows,
+        n_columns, time_s, rows_per_s, values_per_s and meets_target
+        (values_per_s reaches target; None for the per-subject saves).
+    """
+    db_dir = Path(db_dir)
+    db_dir.mkdir(exist_ok=True, parents=True)
+    df = make_synthetic_features(n_subjects, n_rois, seed)
+
+    def _to_sql(uri, df):
+        with get_engine(uri).begin() as con:
+            df.to_sql('gmd$bench$mean', con=con, if_exists='append')
+
+    def _save(uri, df, scratch=False):
+        save_features(df, uri, 'gmd', 'bench', 'mean', chunksize=chunksize,
+                      scratch=scratch)
+
+    cases = [
+        ('table', 'to_sql', _to_sql, df, False),
+        ('table', 'save_features', _save, df, False),
+        ('table', 'save_features_scratch', _save, df, True),
+        ('subject', 'save_features', _save, df.iloc[:n_single], False),
+        ('subject', 'save_features_scratch', _save, df.iloc[:n_single],
+         True),
+    ]
+    results = []
+    for i_case, (case, method, func, t_df, scratch) in enumerate(cases):
+        uri = f'sqlite:///{(db_dir / f"save_{i_case}.sqlite").as_posix()}'
+        if case == 'table':
+            batches = [t_df]
+        else:
+            batches = [t_df.iloc[[x]] for x in range(len(t_df))]
+        kwargs = {'scratch': scratch} if func is _save else {}
+        start_time = time.perf_counter()
+        for t_batch in batches:
+            func(uri, t_batch, **kwargs)
+        elapsed_time = time.perf_counter() - start_time
+        values_per_s = t_df.size / elapsed_time
+        results.append({
+            'case': case,
+            'method': method,
+            'n_rows': len(t_df),
+            'n_columns': t_df.shape[1],
+            'time_s': elapsed_time,
+            'rows_per_s': len(t_df) / elapsed_time,
+            'values_per_s': values_per_s,
+            'meets_target': (
+                values_per_s >= target if case == 'table' else None),
+        })
+        logger.info(
+            f'Save {case} ({method}): {len(t_df)} x {t_df.shape[1]} values '
+            f'in {elapsed_time:.3f} s ({values_per_s:.0f} values/s).')
+    return pd.DataFrame(results)
@@ -1,22 +1,34 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+import fcntl
 from functools import partial
+import gzip
+import hashlib
+import json
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+import os
 from pathlib import Path, PurePath
-import io
 import shutil
+import sys
+import tempfile
+import threading
+import time
 
 from confoundcontinuum.logging import configure_logging, log_versions
 from confoundcontinuum.logging import logger, raise_error
+from confoundcontinuum.io import read_features
 
+import nibabel as nib
 import numpy as np
 import pandas as pd
 import re
+from scipy import sparse, stats
+from scipy.stats import mstats
 from scipy.stats.mstats import winsorize
 
-import requests
-
-from nilearn import datasets
 from nilearn import image
-from nilearn import masking
-from nilearn.datasets.utils import _get_dataset_descr
 
 import nest_asyncio
 nest_asyncio.apply()
@@ -25,450 +37,157 @@ import datalad.api as dl  # noqa E402
 configure_logging()
 log_versions()
 
-"""
-A dictionary containing all supported atlases and their respective valid
-parameters.
-"""
 
-_available_atlases = {
-    # cortical
-    'Schaefer': {
-        'valid_nrois': np.arange(100, 1100, 100).tolist(),
-        'valid_yeonetworks': [7, 17],
-        'valid_resolution': [1, 2],
-        'kind': ['cortical', 'nifti'],
-    },
-    # subcortical
-    'Tian': {
-        'valid_scales': [1, 2, 3, 4],
-        'valid_magenticfield': [3, 7],
-        'valid_space': ['MNI152_nonlinear_6th_generation',
-                        'MNI152_nonlinear_2009cAsym'],
-        'valid_resolution': [1, 1.6, 2],
-        'kind': ['subcortical', 'nifti']
-    },
-    # cerebellar
-    'SUIT': {
-        'valid_space': ['MNI', 'SUIT'],
-        'valid_resolution': [1],
-        'kind': ['cerebellar', 'nifti'],
-    },
-}
+# -----------------------------------------------------------------------------#
+# DataLad dataset related
+# -----------------------------------------------------------------------------#
+
+# lock files of the dataset files in use by this process (path: [fd, count]),
+# guarded by a mutex as the files may be got in a background thread
+_dataset_file_locks = {}
+_dataset_file_locks_mutex = threading.Lock()
 
 
-def list_atlases(name_only=True):
+def get_dataset(source, dataset_dir):
     """
-    List all the available atlases.
+    Installs a DataLad dataset once into dataset_dir and reuses this clone in
+    all later calls, e.g. one clone per node shared by all jobs instead of
+    one clone per job. The installation is serialized with a file lock, so
+    that concurrent jobs wait for the first one to install the dataset.
 
     Parameters
     ----------
-    name_only : bool
-        If True (default), return a list of available atlas names. If False,
-        return a dict of available atlas names including their valid
-        parameters.
+    source : str
+        URL or path of the DataLad dataset.
+    dataset_dir : str or Path
+        Directory of the (shared) local clone.
+
     Returns
     -------
-    out : list(str) or dict
-        A list or dict with all available atlases.
+    dataset_dir : Path
+        Directory of the installed dataset.
     """
-    out = None
-    if name_only is True:
-        out = list(_available_atlases.keys())
-    else:
-        out = _available_atlases
-    return out
-
-# -----------------------------------------------------------------------------#
-# Masks related
-# -----------------------------------------------------------------------------#
+    dataset_dir = Path(dataset_dir)
+    dataset_dir.parent.mkdir(exist_ok=True, parents=True)
+    with _file_lock(dataset_dir.parent / f'.{dataset_dir.name}.lock'):
+        if not dl.Dataset(dataset_dir).is_installed():
+            dl.install(path=dataset_dir, source=source)
+            logger.info(
+                f'DataLad dataset was installed from {source} to '
+                f'{dataset_dir}')
+        else:
+            logger.info(f'DataLad dataset found in {dataset_dir}.')
+    return dataset_dir
 
 
-def get_atlas_params(atlas_name):
+def get_dataset_files(dataset_dir, fnames):
     """
-    Separate the atlas family name and the atlas specific further parameters.
-
-    Parameters (required)
-    ---------------------
-    atlas_name : str
-        Specify the atlas to be loaded by its name following the Junifer naming
-        convention. Follow the principle
-        <AtlasfamilynameAtlasxAdditionalparameterxAdditionalparameter>. E.g.
-        the name for the Schaefer atlas (atlas family) with 1000 ROIs (atlas)
-        and 7 yeo networks (additional parameter) and at a resolution of 1 mm
-        (additional parametr) would be 'Schaefer1000x7x1'.
-        Check valid options by calling list_atlases(name_only=False).
-
-    Returns
-    -------
-    atlas_famname : str
-        Name of the atlas family (e.g. 'Schaefer')
-    atlas_params : dict
-        Parameters further specifying the atlas family.
-    """
-    # get atlas family name
-    atlas_famname = re.split(r'(\d+)', atlas_name.split('x')[0])[0]
-
-    # atlas specific parameters
-    if atlas_famname == 'Schaefer':
-        # Get parameters from atlas_name (defaults are set in _retrieve_atlas)
-        if len(atlas_name.split('x')) >= 1:
-            atlas_params = {
-                'n_rois': int(re.split(r'(\d+)', atlas_name.split('x')[0])[1])}
-        if len(atlas_name.split('x')) == 3:
-            resolution = int(atlas_name.split('x')[2])
-            atlas_params['resolution'] = resolution
-        if len(atlas_name.split('x')) == 2:
-            yeo_network = int(atlas_name.split('x')[1])
-            atlas_params['yeo_network'] = yeo_network
-
-    elif atlas_famname == 'SUIT':
-        # Get parameters from atlas_name (defaults are set in _retrieve_atlas)
-        if len(atlas_name.split('x')) == 1:
-            atlas_params = {}
-        if len(atlas_name.split('x')) == 2:
-            atlas_params = {
-                'space': atlas_name.split('x')[1]}
-        if len(atlas_name.split('x')) == 3:
-            resolution = int(atlas_name.split('x')[2])
-            atlas_params['resolution'] = resolution
-
-    return atlas_famname, atlas_params
-
-
-def load_atlas(atlas_famname, out_dir='data/masks', **kwargs):
-    """
-    Loads a brain atlas (including a label file, description and kind of atlas)
-    for parcellation. If the atlas is not yet in the out_dir it retrieves the
-    atlas first and saves it in out_dir.
-
-    Parameters (required)
-    ---------------------
-    atlas_famname : str
-        Specify by name of atlas family, e.g. 'Schaefer'.
-        Check valid options by calling list_atlases(name_only=True).
-    out_dir: path
-        Path to where to store the retrieved atlas file.
-        Default (relative to base of project structure): data/masks
-
-    Parameters (optional, atlas dependent)
-    --------------------------------------
-    Use to specify atlas specific keyword arguments. Check valid options by
-    calling list_atlases(name_only=False).
-
-    Schaefer :
-        n_rois (required) : int
-            Granularity of atlas to be used. Valid values: between 100 and 1000
-            (included) in steps of 100.
-        yeo_network (optional) : int
-            Number of yeo networks to use. Valid values: 7, 17. Defaults to 7.
-        resolution (optional) : int
-            Resolution of atlas nifti to use. Valid values: 1, 2. Defaults to 1.
-
-    SUIT :
-        space (optional) : str
-            Space of atlas can be either 'MNI' or 'SUIT' (for more information
-            see http://www.diedrichsenlab.org/imaging/suit.htm). Defaults to
-            'MNI'.
-
-    Returns
-    -------
-    atlas_img : niimg-like object (depending on atlas)
-        Loaded atlas image.
-    atlas_labels : List of str
-        Atlas labels.
-    atlas : atlas object
-        Atlas object as retrieved with _retrieve_atlas() for further operations.
-    """
-
-    # retrieve atlases by passing arguments on to _retrieve_atlas()
-    atlas = _retrieve_atlas(
-        atlas_famname, out_dir, **kwargs)
-
-    # atlas retrieved from
-    logger.info(
-        f'Load atlas {PurePath(Path(atlas["maps"])).name} from directory '
-        f'{Path(atlas["maps"]).parent}.')
-
-    # load atlas img
-    # load nifti
-    atlas_img = image.load_img(atlas["maps"])
-
-    atlas_labels = atlas['labels']
-
-    return atlas_img, atlas_labels, atlas
+    Gets files of a dataset installed with get_dataset() and marks them as in
+    use by this job (shared file lock per file), so that other jobs do not
+    drop them (see drop_dataset_files()).
 
+    Parameters
+    ----------
+    dataset_dir : str or Path
+        Directory of the dataset.
+    fnames : list of str or Path
+        Paths of the files to get.
 
-def _retrieve_atlas(atlas_famname, out_dir='data/masks', **kwargs):
+    Returns
+    -------
+    fnames : list of Path
+        Paths of the files.
     """
-    Retrieves a brain atlas object either from nilearn or a specified online
-    source. Only returns one atlas per call. Call function multiple times for
-    different parameter specifications. Only retrieves atlas if it is not yet in
-    out_dir.
-
-    Parameters (required)
-    ---------------------
-    atlas_famname : str
-        Specify by name of atlas family, e.g. 'Schaefer'.
-        Check valid options by calling list_atlases(name_only=True).
-    out_dir: path
-        Path to where to store the retrieved atlas file.
-        Default (relative to base of project structure): data/masks
-
-    Parameters (optional, atlas dependent)
-    --------------------------------------
-    Use to specify atlas specific keyword arguments. Check valid options by
-    calling list_atlases(name_only=False).
-
-    Schaefer :
-        n_rois (required) : int
-            Granularity of atlas to be used. Valid values: between 100 and 1000
-            (included) in steps of 100.
-        yeo_network (optional) : int
-            Number of yeo networks to use. Valid values: 7, 17. Defaults to 7.
-        resolution (optional) : int
-            Resolution of atlas nifti to use. Valid values: 1, 2. Defaults to 1.
+    dataset_dir = Path(dataset_dir)
+    fnames = [Path(x) for x in fnames]
+    with _dataset_file_locks_mutex:
+        for fname in fnames:
+            lock_fname = _get_dataset_lock_fname(dataset_dir, fname)
+            if lock_fname in _dataset_file_locks:
+                _dataset_file_locks[lock_fname][1] += 1
+                continue
+            lock_fname.parent.mkdir(exist_ok=True, parents=True)
+            fd = os.open(lock_fname, os.O_RDWR | os.O_CREAT, 0o666)
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            _dataset_file_locks[lock_fname] = [fd, 1]
+    dl.get(path=[x.as_posix() for x in fnames], dataset=dataset_dir)
+    return fnames
+
+
+def drop_dataset_files(dataset_dir, fnames):
+    """
+    Releases files got with get_dataset_files() and drops those that are not
+    in use by any other job.
 
-    SUIT :
-        space (optional) : str
-            Space of atlas can be either 'MNI' or 'SUIT' (for more information
-            see http://www.diedrichsenlab.org/imaging/suit.htm). Defaults to
-            'MNI'.
+    Parameters
+    ----------
+    dataset_dir : str or Path
+        Directory of the dataset.
+    fnames : list of str or Path
+        Paths of the files to release.
 
     Returns
     -------
-    atlas : dict
-        Dictionary with the following keys:
-        maps : str - path to atlas file
-        labels : labels of atlas ROIs
-        description : Only if retrieved from nilearn. Background info on atlas
-        kind : str - indicating type of atlas (volumetric/surface) by file name
-               extension (e.g. nifti)
+    dropped : list of Path
+        Paths of the dropped files.
     """
+    dataset_dir = Path(dataset_dir)
+    drop_locks = {}
+    try:
+        with _dataset_file_locks_mutex:
+            for fname in [Path(x) for x in fnames]:
+                lock_fname = _get_dataset_lock_fname(dataset_dir, fname)
+                if lock_fname not in _dataset_file_locks:
+                    continue
+                _dataset_file_locks[lock_fname][1] -= 1
+                if _dataset_file_locks[lock_fname][1] > 0:
+                    continue
+                fd = _dataset_file_locks.pop(lock_fname)[0]
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                # exclusive only if no other job uses the file (anymore)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    os.close(fd)
+                    continue
+                drop_locks[fname] = fd
+        if len(drop_locks) > 0:
+            dl.drop(
+                path=[x.as_posix() for x in drop_locks], dataset=dataset_dir)
+    finally:
+        for fd in drop_locks.values():
+            os.close(fd)
+    logger.info(
+        f'{len(drop_locks)} of {len(fnames)} dataset files were dropped (the '
+        'others are in use by other jobs).')
+    return list(drop_locks)
 
-    _valid_atlases = list_atlases(name_only=True)
 
-    out_dir = Path(out_dir)
-    out_dir_atl = out_dir / atlas_famname
-    out_dir_atl.mkdir(exist_ok=True, parents=True)
-
-    if atlas_famname in _valid_atlases:
-        logger.info(f"{atlas_famname} atlas was selected.")
-
-        # retrieval details per atlas
-        if atlas_famname == 'Schaefer':
-            # valid atlas parameters
-            _valid_nrois = list_atlases(
-                name_only=False)[atlas_famname]['valid_nrois']
-            _valid_resolution = list_atlases(
-                name_only=False)[atlas_famname]['valid_resolution']
-            _valid_yeonetworks = list_atlases(
-                name_only=False)[atlas_famname]['valid_yeonetworks']
-            kind = list_atlases(
-                name_only=False)[atlas_famname]['kind'][1]
-
-            # set atlas defaults for **kwargs parameters
-            resolution = kwargs.get('resolution', 1)
-            yeo_network = kwargs.get('yeo_network', 7)
-            logger.info(
-                'The atlas parameters "resolution" and "yeo_network" were set '
-                f'to {resolution} mm and {yeo_network} networks, respectively.')
+def _get_dataset_lock_fname(dataset_dir, fname):
+    """Lock file of a file of the dataset (next to the dataset)"""
+    rel_fname = Path(os.path.relpath(
+        Path(fname).absolute(), Path(dataset_dir).absolute()))
+    return dataset_dir.parent / f'.{dataset_dir.name}.locks' / \
+        f'{"%".join(rel_fname.parts)}.lock'
 
-            # check missing atlas parameter specifications in **kwargs
-            if 'n_rois' not in kwargs:
-                raise_error(
-                    'The specification of the "n_rois" parameter (atlas '
-                    'granualrity) is a required keyword parameter for the '
-                    'schaefer atlas.')
-            else:
-                n_rois = kwargs.get('n_rois')
 
-            # check validity of atlas parameters
-            if n_rois not in _valid_nrois:
-                raise_error(
-                    f'The parameter "n_rois" for the {atlas_famname} atlas '
-                    f'needs to be within {_valid_nrois}. n_rois={n_rois}'
-                    ' was specified instead.')
-            if resolution not in _valid_resolution:
-                raise_error(
-                    f'The parameter "resolution" for the {atlas_famname} atlas '
-                    f'needs to be within {_valid_resolution}. resolution = '
-                    f'{resolution} was specified instead.')
-            if yeo_network not in _valid_yeonetworks:
-                raise_error(
-                    f'The parameter "yeo_network" for the {atlas_famname} atlas'
-                    f' needs to be within {_valid_yeonetworks}. yeo_network = '
-                    f'{yeo_network} was specified instead.')
-
-            # define file names
-            atlas_fname = out_dir_atl / (
-                f'Schaefer2018_{n_rois}Parcels_{yeo_network}Networks_order_'
-                f'FSLMNI152_{resolution}mm.nii.gz')
-            atlas_tname = out_dir_atl / (
-                f'Schaefer2018_{n_rois}Parcels_{yeo_network}Networks_order.txt')
-
-            # check existance of atlas
-            if atlas_fname.exists() and atlas_tname.exists():
-                logger.info(
-                    f'The atlas {PurePath(atlas_fname).name} and '
-                    f'its metadata file exist in {out_dir_atl}.')
-                labels = [
-                    '_'.join(x.split('_')[1:])
-                    for x in pd.read_csv(
-                        atlas_tname, sep='\t', header=None).iloc[:, 1].to_list()
-                ]
-                description = _get_dataset_descr('schaefer_2018')
-                atlas = {
-                    'maps': atlas_fname.as_posix(),
-                    'labels': labels,
-                    'description': description,
-                    'kind': kind,
-                }
-
-            # fetch atlas from nilearn
-            else:
-                atlas = (
-                    datasets.fetch_atlas_schaefer_2018(
-                        n_rois=n_rois,
-                        yeo_networks=yeo_network,
-                        resolution_mm=resolution,
-                        data_dir=out_dir.as_posix()))
-                # move atlas from nilearn directory to atlas family directory
-                shutil.copy2(atlas["maps"], atlas_fname)  # nifti
-                shutil.copy2(
-                    PurePath(atlas["maps"]).parent / PurePath(atlas_tname).name,
-                    atlas_tname)  # metadata
-                # delete nilearn created directory
-                shutil.rmtree(PurePath(atlas["maps"]).parent)
-                # change directory entry in atlas object
-                atlas['maps'] = atlas_fname.as_posix()
-                atlas['kind'] = kind
-                atlas['labels'] = [
-                    '_'.join(x.split('_')[1:]) for x in atlas.labels.astype('U')
-                ]
-                logger.info(
-                    f'The atlas {PurePath(atlas_fname).name} and '
-                    'its metadata file DID NOT exist in '
-                    f'{out_dir_atl} and were retrieved from '
-                    'nilearn.')
-
-        # elif atlas_famname == 'Tian':
-        #     # valid atlas parameters
-        #     _valid_nrois = list_atlases(
-        #         name_only=False)[atlas_famname]['valid_nrois']
-        #     _valid_resolution = list_atlases(
-        #         name_only=False)[atlas_famname]['valid_resolution']
-        #     _valid_yeonetworks = list_atlases(
-        #         name_only=False)[atlas_famname]['valid_yeonetworks']
-        #     kind = list_atlases(
-        #         name_only=False)[atlas_famname]['kind'][1]
-
-        elif atlas_famname == 'SUIT':
-            # valid atlas parameters
-            _valid_resolution = list_atlases(
-                name_only=False)[atlas_famname]['valid_resolution']
-            _valid_space = list_atlases(
-                name_only=False)[atlas_famname]['valid_space']
-            kind = list_atlases(
-                name_only=False)[atlas_famname]['kind'][1]
-            description = (
-                'Probabilistic atlas for cerebellar lobules. Known as '
-                'SUIT atlas or Diedrichsen 2009 (Diedrichsen, J., Balsters, '
-                'J. H., Flavell, J., Cussans, E., & Ramnani, N. (2009). A '
-                'probabilistic atlas of the human cerebellum. Neuroimage.46(1),'
-                ' 39-46.)). For more information see: http://www.diedrichsenlab'
-                '.org/imaging/suit.htm. Atlas retrieved from https://github.com'
-                '/DiedrichsenLab/cerebellar_atlases/tree/master/Diedrichsen_'
-                '2009.')
-
-            # set atlas defaults for **kwargs parameters
-            resolution = kwargs.get('resolution', 1)
-            space = kwargs.get('space', 'MNI')
-            logger.info(
-                'The atlas parameters "resolution" and "space" were set to '
-                f'{resolution} mm and {space} space, respectively.')
-
-            # check validity of atlas parameters
-            if resolution not in _valid_resolution:
-                raise_error(
-                    f'The parameter "resolution" for the {atlas_famname} atlas '
-                    f'needs to be within {_valid_resolution}. resolution = '
-                    f'{resolution} was specified instead.')
-            if space not in _valid_space:
-                raise_error(
-                    f'The parameter "space" for the {atlas_famname} atlas '
-                    f'needs to be within {_valid_space}. space = '
-                    f'{space} was specified instead.')
-
-            # define file names
-            atlas_fname = out_dir_atl / (
-                f'SUIT_{space}Space_{resolution}mm.nii')
-            atlas_tname = out_dir_atl / (
-                f'SUIT_{space}Space_{resolution}mm.tsv')
-
-            # check existance of atlas
-            if atlas_fname.exists() and atlas_tname.exists():
-                logger.info(
-                    f'The atlas {PurePath(atlas_fname).name} and '
-                    f'its label file exist in {out_dir_atl}.')
-                atlas = {
-                    'maps': atlas_fname.as_posix(),
-                    'labels': pd.read_csv(
-                        atlas_tname,
-                        sep='\t', usecols=['name'])['name'].to_list(),
-                    'description': description,
-                    'kind': kind,
-                }
-
-            # fetch atlas from github
-            else:
-                url_basis = (
-                    'https://github.com/DiedrichsenLab/cerebellar_atlases/raw'
-                    '/master/Diedrichsen_2009/')
-                url_MNI = url_basis + 'atl-Anatom_space-MNI_dseg.nii'
-                url_SUIT = url_basis + 'atl-Anatom_space-SUIT_dseg.nii'
-                url_labels = url_basis + 'atl-Anatom.tsv'
-                # get labels
-                labels_download = requests.get(url_labels)
-                labels = pd.read_csv(
-                    io.StringIO(labels_download.content.decode("utf-8")),
-                    sep='\t', usecols=['name'])['name'].to_list()
-                with open(atlas_tname, 'wb') as f:
-                    f.write(labels_download.content)  # save df not down.content
-                # download atlas and save
-                if space == 'MNI':
-                    atlas_download = requests.get(url_MNI)
-                    with open(atlas_fname, 'wb') as f:
-                        f.write(atlas_download.content)
-                elif space == 'SUIT':
-                    atlas_download = requests.get(url_SUIT)
-                    with open(atlas_fname, 'wb') as f:
-                        f.write(atlas_download.content)
-                # build atlas dictionary to be consistent with nilearn
-                atlas = {
-                    'maps': atlas_fname.as_posix(),
-                    'labels': labels,
-                    'description': description,
-                    'kind': kind,
-                }
-                logger.info(
-                    f'The atlas {PurePath(atlas_fname).name} and '
-                    'its metadata file DID NOT exist in '
-                    f'{out_dir_atl} and were retrieved from '
-                    f'{url_basis}.')
-
-    else:
-        raise_error(
-            f"The provided atlas name {atlas_famname} cannot be retrieved. "
-            f"Please choose one of these options: {_valid_atlases}")
-
-    return atlas
+@contextmanager
+def _file_lock(lock_fname):
+    """Holds an exclusive file lock while in context (waits for it)"""
+    fd = os.open(lock_fname, os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)  # releases the lock
 
 
 # -----------------------------------------------------------------------------#
 # Structural features related
 # -----------------------------------------------------------------------------#
 
-def get_vbm(CAT_REPO_URL, target_dir, dataset_name, subid, session):
+def get_vbm(CAT_REPO_URL, target_dir, dataset_name, subid, session,
+            cache_dir=None, cache_size=None):
     """
     Retrieves the preprocessed VBM data from the CAT DataLad dataset.
 
@@ -488,13 +207,117 @@ def get_vbm(CAT_REPO_URL, target_dir, dataset_name, subid, session):
     session: str
         Session ID (e.g. 'ses-2') as used in the CAT preprocessed DataLad
         dataset.
+    cache_dir : str or Path
+        Directory of the local VBM cache (see cache_vbm()). If None
+        (default), the VBM nifti is not cached.
+    cache_size : float
+        Maximum size of the VBM cache in bytes. If None (default), the cache
+        is not bounded.
 
     Returns
     -------
     vbm_nifti : Niimg like object
         VBM nifti for a subject and session as preprocessed by CAT and stored
-        in specified DataLad dataset.
+        in specified DataLad dataset. The data is not read yet, so that
+        get_gmd() reads only the part of it covered by the atlas.
+    """
+
+    nifti_fname = get_vbm_fnames(
+        CAT_REPO_URL, target_dir, dataset_name, [subid], [session],
+        cache_dir=cache_dir, cache_size=cache_size)[0]
+
+    # load nifti (header only, the data is read lazily)
+    vbm_nifti = nib.load(nifti_fname.as_posix())
+    logger.info('VBM nifti was loaded.')
+
+    return vbm_nifti
+
+
+def get_vbm_fnames(CAT_REPO_URL, target_dir, dataset_name, subids, sessions,
+                   cache_dir=None, cache_size=None, get=True):
+    """
+    Retrieves the preprocessed VBM data of several subjects from the CAT
+    DataLad dataset. The dataset is installed once and all files are
+    fetched with one datalad get call. If a cache_dir is given, niftis found
+    in the local VBM cache are not fetched again and the fetched ones are
+    added to the cache (see cache_vbm()).
+
+    Parameters
+    ----------
+    CAT_REPO_URL : str
+        URL of CAT preprocessed DataLad dataset.
+    target_dir : str
+        General directory to install DataLad dataset to. The DataLad dataset
+        will be created as a subdirectory with the specified dataset_name in
+        this directory. Can be shared by all jobs of a node (see
+        get_dataset()), the niftis are then released with
+        drop_dataset_files().
+    dataset_name : str
+        Name of the dataset. Used to create a subdirectory in target_dir to
+        install the datalad dataset to.
+    subids : list of str
+        Subject IDs as used in the CAT preprocessed DataLad dataset.
+    sessions : list of str
+        Session IDs (e.g. 'ses-2') as used in the CAT preprocessed DataLad
+        dataset. One session per subject ID.
+    cache_dir : str or Path
+        Directory of the local VBM cache. If None (default), the VBM niftis
+        are not cached.
+    cache_size : float
+        Maximum size of the VBM cache in bytes. If None (default), the cache
+        is not bounded.
+    get : bool
+        If False, the niftis are not fetched, e.g. to fetch them while
+        processing (see get_gmd_subjects()). Not used with cache_dir.
+        Defaults to True.
+
+    Returns
+    -------
+    nifti_fnames : list of Path
+        Paths to the VBM niftis in the order of subids and sessions (in the
+        cache, uncompressed, if cache_dir is given).
     """
+    if len(subids) != len(sessions):
+        raise_error(
+            f'The number of subject IDs ({len(subids)}) and sessions '
+            f'({len(sessions)}) differ.')
+
+    if cache_dir is not None:
+        cache_dir = Path(cache_dir)
+        cached_fnames = [
+            cache_dir / f'm0wp1{subid}_{session}_T1w.nii'
+            for subid, session in zip(subids, sessions)]
+        for i_attempt in range(_vbm_cache_attempts):
+            missing = [
+                i for i, x in enumerate(cached_fnames) if not x.is_file()]
+            logger.info(
+                f'{len(cached_fnames) - len(missing)} of {len(cached_fnames)} '
+                f'VBM niftis found in the cache {cache_dir}.')
+            if len(missing) > 0:
+                nifti_fnames = get_vbm_fnames(
+                    CAT_REPO_URL, target_dir, dataset_name,
+                    [subids[i] for i in missing],
+                    [sessions[i] for i in missing])
+            else:
+                nifti_fnames = []
+            try:
+                cache_vbm(
+                    nifti_fnames, cache_dir, cache_size=cache_size,
+                    keep=cached_fnames)
+                break
+            except FileNotFoundError:
+                # found niftis were removed by another job before they were
+                # marked as used: fetch and decompress them again
+                if i_attempt == _vbm_cache_attempts - 1:
+                    raise
+                logger.warning(
+                    'VBM niftis were removed from the cache by another job, '
+                    'they are added again.')
+            finally:
+                if len(nifti_fnames) > 0:  # the cache is used from now on
+                    drop_dataset_files(
+                        Path(target_dir) / dataset_name, nifti_fnames)
+        return cached_fnames
 
     # definitions
     target_dir = Path(target_dir)
@@ -502,56 +325,592 @@ def get_vbm(CAT_REPO_URL, target_dir, dataset_name, subid, session):
     install_dir = target_dir / dataset_name  # existance established by datalad
     get_dir = install_dir / 'm0wp1'  # defined by dataset structure
 
-    # clone VBM datalad dataset
-    dl.install(path=install_dir, source=CAT_REPO_URL)
-    logger.info(
-        f'VBM DataLad dataset was installed from {CAT_REPO_URL} to '
-        f'{install_dir}')
+    # clone VBM datalad dataset (once, if target_dir is shared by jobs)
+    get_dataset(CAT_REPO_URL, install_dir)
 
-    # create nifti-image path
-    nifti_fname = (
-        get_dir / f'm0wp1{subid}_{session}_T1w.nii.gz')
+    # create nifti-image paths
+    nifti_fnames = [
+        get_dir / f'm0wp1{subid}_{session}_T1w.nii.gz'
+        for subid, session in zip(subids, sessions)]
 
     # check existance of cloned symbolic links
-    if not nifti_fname.is_symlink():
+    for nifti_fname in nifti_fnames:
+        if not nifti_fname.is_symlink():
+            raise_error(
+                f'VBM image file name "{nifti_fname.name}" does not exist in: '
+                f'{nifti_fname.as_posix()}')
+
+    # get data (of predefined sbj, ses), release with drop_dataset_files()
+    if get:
+        get_dataset_files(install_dir, nifti_fnames)
+        logger.info(
+            'Symlinks from dataset installation existed. Got VBM niftis for '
+            f'{len(nifti_fnames)} subject(s) and session(s).')
+
+    return nifti_fnames
+
+
+# niftis used (by any job) more recently than this (in s) are not removed
+# from the VBM cache, so that niftis returned to a job are still there when
+# it opens them
+_vbm_cache_grace = 600.
+# attempts to get niftis of the VBM cache removed by other jobs meanwhile
+_vbm_cache_attempts = 3
+
+
+def cache_vbm(nifti_fnames, cache_dir, cache_size=None, keep=None):
+    """
+    Adds VBM niftis to a local cache as uncompressed niftis (which keep the
+    affine and are memory-mapped by nibabel), so that repeated extraction
+    passes do not need to decompress them again. If the cache exceeds
+    cache_size, the least recently used niftis are removed from it (but not
+    the ones used in the last 10 minutes, e.g. by other jobs). Adding,
+    marking and removing niftis is locked against the other jobs using the
+    cache.
+
+    Parameters
+    ----------
+    nifti_fnames : list of str or Path
+        Paths to the (gzipped) VBM niftis to add to the cache.
+    cache_dir : str or Path
+        Directory of the cache.
+    cache_size : float
+        Maximum size of the cache in bytes. If None (default), the cache is
+        not bounded.
+    keep : list of Path
+        Niftis in the cache that are in use and are not removed. They are
+        marked as used. Defaults to the added niftis.
+
+    Returns
+    -------
+    cached_fnames : list of Path
+        Paths to the niftis in the cache (of keep, if given, else of
+        nifti_fnames).
+
+    Raises
+    ------
+    FileNotFoundError
+        If niftis of keep are not in the cache (anymore), e.g. as another
+        job removed them. The cache is then not reduced to cache_size.
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(exist_ok=True, parents=True)
+    tmp_fnames = []
+    added_fnames = []
+    for nifti_fname in nifti_fnames:
+        nifti_fname = Path(nifti_fname)
+        cached_fname = cache_dir / nifti_fname.name.replace('.nii.gz', '.nii')
+        # write to a temporary file first (other jobs may use the cache)
+        fd, tmp_fname = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f_out:
+                if nifti_fname.suffix == '.gz':
+                    with gzip.open(nifti_fname, 'rb') as f_in:
+                        shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+                else:
+                    with open(nifti_fname, 'rb') as f_in:
+                        shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+        except BaseException:
+            if os.path.exists(tmp_fname):
+                os.remove(tmp_fname)
+            for t_fname in tmp_fnames:
+                os.remove(t_fname)
+            raise
+        tmp_fnames.append(tmp_fname)
+        added_fnames.append(cached_fname)
+
+    cached_fnames = added_fnames if keep is None else \
+        [Path(x) for x in keep]
+    with _file_lock(cache_dir / '.lock'):
+        for tmp_fname, cached_fname in zip(tmp_fnames, added_fnames):
+            os.replace(tmp_fname, cached_fname)
+        if len(added_fnames) > 0:
+            logger.info(f'{len(added_fnames)} VBM niftis added to the cache.')
+        removed = []
+        for cached_fname in cached_fnames:
+            try:
+                os.utime(cached_fname)  # mark as recently used
+            except FileNotFoundError:
+                removed.append(cached_fname)
+        if len(removed) > 0:
+            raise FileNotFoundError(
+                f'{len(removed)} VBM niftis are not in the cache: {removed}')
+        if cache_size is not None:
+            _evict_vbm_cache(cache_dir, cache_size, cached_fnames)
+    return cached_fnames
+
+
+def _evict_vbm_cache(cache_dir, cache_size, keep):
+    """Remove the least recently used niftis until the cache fits (with the
+    lock of the cache held)"""
+    min_mtime = time.time() - _vbm_cache_grace
+    entries = []
+    for fname in Path(cache_dir).glob('*.nii'):
+        try:
+            stat = fname.stat()
+        except FileNotFoundError:  # removed by another job
+            continue
+        entries.append((stat.st_mtime, stat.st_size, fname))
+    total_size = sum(x[1] for x in entries)
+    keep = {Path(x).name for x in keep}
+    n_removed = 0
+    for mtime, size, fname in sorted(entries):
+        if total_size <= cache_size:
+            break
+        if mtime > min_mtime:  # in use (by this or another job)
+            break
+        if fname.name in keep:
+            continue
+        try:
+            fname.unlink()
+        except FileNotFoundError:
+            pass
+        total_size -= size
+        n_removed += 1
+    if n_removed > 0:
+        logger.info(
+            f'{n_removed} least recently used VBM niftis removed from the '
+            'cache.')
+    if total_size > cache_size:
+        logger.warning(
+            f'The VBM cache ({total_size} bytes) exceeds its maximum size '
+            f'({cache_size} bytes) with the niftis in use.')
+
+
+def get_atlas_index(atlas_nifti, target_nifti):
+    """
+    Resamples the atlas_nifti to the grid of target_nifti if necessary and
+    flattens it once into a voxel-to-ROI index. All ROIs can then be reduced
+    in a single vectorized pass over the data instead of building one mask
+    per ROI.
+
+    Parameters
+    ----------
+    atlas_nifti : niimg-like object
+        Nifti of atlas to use for parcellation.
+    target_nifti : niimg-like object
+        Nifti defining the grid to resample the atlas to, e.g. the VBM nifti.
+
+    Returns
+    -------
+    atlas_index : dict
+        Dictionary with the following keys:
+        rois : array - ROI values of the atlas (sorted, without background)
+        voxels : array - flat indices (Fortran order) of all voxels that
+                 belong to an ROI, grouped by ROI
+        voxel_rois : array - position of the ROI (0 to n_rois - 1) in rois
+                     for each entry in voxels
+        shape : tuple - shape of the grid the index refers to
+    """
+
+    # sort rois to be related to the order of i_roi (and get rid of 0 entry)
+    rois = np.unique(image.get_data(atlas_nifti))[1:]  # roi numbering
+    n_rois = len(rois)  # granularity
+    if n_rois == 0:
+        raise_error('The atlas does not contain any ROI.')
+
+    # resample atlas if needed
+    if not atlas_nifti.shape == target_nifti.shape:
+        atlas_nifti = image.resample_to_img(
+            atlas_nifti, target_nifti, interpolation='nearest')
+        logger.info('Atlas nifti was resampled to resolution of VBM nifti.')
+
+    # Fortran order matches the on-disk order of nifti data
+    atlas_data = np.asarray(image.get_data(atlas_nifti)).ravel(order='F')
+
+    # position of each voxel value in rois (background voxels do not match)
+    roi_pos = np.searchsorted(rois, atlas_data)
+    in_roi = rois[np.minimum(roi_pos, n_rois - 1)] == atlas_data
+    voxels = np.flatnonzero(in_roi)
+    voxel_rois = roi_pos[voxels].astype(np.int32)
+
+    # group voxels by ROI so that ROI segments are contiguous
+    order = np.argsort(voxel_rois, kind='stable')
+
+    atlas_index = {
+        'rois': rois,
+        'voxels': voxels[order],
+        'voxel_rois': voxel_rois[order],
+        'shape': tuple(atlas_nifti.shape[:3]),
+    }
+    return atlas_index
+
+
+def get_cached_atlas_index(atlas_name, atlas_nifti, target_nifti, cache_dir):
+    """
+    Voxel-to-ROI index as returned by get_atlas_index(), cached on disk.
+    The cache is keyed by the atlas name, a hash of the atlas data and affine
+    and the affine and shape of the target grid. On the first call the atlas
+    is resampled and indexed and the resampled label volume and its index
+    are saved as .npy files. Later calls memory-map these files and skip
+    resampling.
+
+    Parameters
+    ----------
+    atlas_name : str
+        Name of the atlas (part of the name of the cache entry).
+    atlas_nifti : niimg-like object
+        Nifti of atlas to use for parcellation. Its data is read to hash it,
+        it is only resampled if the index is not cached yet.
+    target_nifti : niimg-like object
+        Nifti defining the grid to resample the atlas to, e.g. the VBM nifti.
+        Only its header (affine and shape) is read if the index is cached.
+    cache_dir : str or Path
+        Directory of the cache.
+
+    Returns
+    -------
+    atlas_index : dict
+        Voxel-to-ROI index as returned by get_atlas_index(), with the arrays
+        memory-mapped (read-only) from the cache. Additional key:
+        labels : array - atlas label volume resampled to the target grid
+    """
+    shape = tuple(target_nifti.shape[:3])
+    affine = np.round(np.asarray(target_nifti.affine, dtype=np.float64), 6)
+    # the same name can refer to other atlas data (e.g. after re-importing
+    # the atlas or changing its resolution)
+    atlas_nifti = image.load_img(atlas_nifti)
+    atlas_data = np.ascontiguousarray(np.asarray(atlas_nifti.dataobj))
+    atlas_affine = np.round(
+        np.asarray(atlas_nifti.affine, dtype=np.float64), 6)
+    key = hashlib.sha1(
+        f'{atlas_name}_{shape}_{atlas_data.shape}_{atlas_data.dtype.str}'
+        .encode() + affine.tobytes() + atlas_affine.tobytes() +
+        atlas_data.tobytes()).hexdigest()
+    index_dir = Path(cache_dir) / f'{atlas_name}_{key[:16]}'
+    keys = ['rois', 'voxels', 'voxel_rois', 'labels']
+
+    if not index_dir.exists():
+        logger.info(
+            f'Atlas index of {atlas_name} not cached yet. Build and save it '
+            f'to {index_dir.as_posix()}.')
+        atlas_index = get_atlas_index(atlas_nifti, target_nifti)
+        labels = np.zeros(np.prod(shape), dtype=atlas_index['rois'].dtype)
+        labels[atlas_index['voxels']] = \
+            atlas_index['rois'][atlas_index['voxel_rois']]
+        atlas_index['labels'] = labels.reshape(shape, order='F')
+
+        # write to a temporary directory first so that concurrent jobs never
+        # read a partially written index
+        index_dir.parent.mkdir(exist_ok=True, parents=True)
+        tmp_dir = Path(tempfile.mkdtemp(dir=index_dir.parent))
+        for t_key in keys:
+            np.save(tmp_dir / f'{t_key}.npy', atlas_index[t_key])
+        with open(tmp_dir / 'meta.json', 'w') as f:
+            json.dump(
+                {'atlas_name': atlas_name, 'shape': shape,
+                 'affine': affine.tolist(), 'key': key}, f)
+        try:
+            os.rename(tmp_dir, index_dir)
+        except OSError:  # another job cached the index in the meantime
+            shutil.rmtree(tmp_dir)
+
+    logger.info(f'Load cached atlas index from {index_dir.as_posix()}.')
+    atlas_index = {
+        t_key: np.load(index_dir / f'{t_key}.npy', mmap_mode='r')
+        for t_key in keys}
+    atlas_index['shape'] = shape
+    return atlas_index
+
+
+def get_roi_values(vbm_nifti, atlas_index, return_nonfinite=False):
+    """
+    Extracts the values of all voxels indexed by atlas_index from the
+    vbm_nifti in one pass. As for nilearn.masking.apply_mask, non-float data
+    is converted to float32 and non-finite values are set to 0. If the data
+    of the vbm_nifti is not in memory yet, only the bounding box of the
+    atlas is read (as float32, see load_vbm_bbox()).
+
+    Parameters
+    ----------
+    vbm_nifti : niimg-like object, str, Path or dict
+        Nifti of voxel based morphometry as e.g. outputted by CAT, its path
+        or VBM data already read with load_vbm_bbox().
+    atlas_index : dict
+        Voxel-to-ROI index as returned by get_atlas_index().
+    return_nonfinite : bool
+        Whether to also return which voxel values were non-finite (before
+        setting them to 0). Defaults to False.
+
+    Returns
+    -------
+    values : array
+        Voxel values in the order of atlas_index['voxels'].
+    nonfinite : array
+        Boolean array, True for the voxel values that were non-finite. Only
+        returned if return_nonfinite is True.
+    """
+    if isinstance(vbm_nifti, (str, PurePath)):
+        # nibabel reads only the header (nilearn would read the data)
+        vbm_nifti = nib.load(Path(vbm_nifti).as_posix())
+    if isinstance(vbm_nifti, dict):  # VBM data read by load_vbm_bbox()
+        vbm_crop = vbm_nifti
+    elif not vbm_nifti.in_memory:
+        # read lazily only the bounding box of the atlas
+        vbm_crop = load_vbm_bbox(vbm_nifti, get_atlas_bbox([atlas_index]))
+    else:
+        vbm_crop = None
+    vbm_shape = vbm_nifti.shape if vbm_crop is None else vbm_crop['shape']
+    if tuple(vbm_shape[:3]) != atlas_index['shape']:
         raise_error(
-            f'VBM image file name "m0wp1{subid}_{session}_T1w.nii.gz" does not '
-            f'exist in: {nifti_fname.as_posix()}')
+            f'Shape of the VBM nifti {vbm_shape} does not match the '
+            f'shape of the atlas index {atlas_index["shape"]}.')
+    if vbm_crop is None:
+        vbm_data = np.asarray(image.get_data(vbm_nifti))
+        values = vbm_data.ravel(order='F')[atlas_index['voxels']]
+    else:
+        values = vbm_crop['data'].ravel(order='F')[
+            _get_bbox_voxels(atlas_index, vbm_crop['bbox'])]
+    if values.dtype.kind != 'f':
+        values = values.astype(np.float32)
+    finite = np.isfinite(values)
+    if not finite.all():
+        logger.warning(
+            f'{np.count_nonzero(~finite)} non-finite voxel values were set '
+            'to 0.')
+        values[~finite] = 0
+    if return_nonfinite:
+        return values, ~finite
+    return values
+
+
+def get_atlas_bbox(atlas_indexes):
+    """
+    Bounding box of the voxels of one or several atlases on the VBM grid.
 
-    # get data (of predefined sbj, ses)
-    dl.get(path=nifti_fname, dataset=install_dir)
-    logger.info(
-        'Symlinks from dataset installation existed. Got VBM nifti for subject '
-        f'{subid} and session {session}.')
+    Parameters
+    ----------
+    atlas_indexes : list of dict
+        Voxel-to-ROI indices as returned by get_atlas_index(), all built on
+        the same grid.
 
-    # load nifti
-    vbm_nifti = image.load_img(nifti_fname.as_posix())
-    logger.info('VBM nifti was loaded.')
+    Returns
+    -------
+    bbox : tuple of slice
+        One slice per axis of the grid, covering the voxels of all atlases.
+    """
+    bbox = None
+    for atlas_index in atlas_indexes:
+        coords = np.unravel_index(
+            atlas_index['voxels'], atlas_index['shape'], order='F')
+        t_bbox = [(int(x.min()), int(x.max()) + 1) for x in coords]
+        if bbox is None:
+            bbox = t_bbox
+        else:
+            bbox = [(min(start, t_start), max(stop, t_stop))
+                    for (start, stop), (t_start, t_stop) in zip(bbox, t_bbox)]
+    if bbox is None:
+        raise_error('At least one atlas index is required.')
+    return tuple(slice(start, stop) for start, stop in bbox)
 
-    return vbm_nifti
 
+def load_vbm_bbox(vbm_nifti, bbox):
+    """
+    Lazily reads the voxels inside a bounding box of a VBM nifti as float32.
+    Only the slabs of the file up to the end of the box are decompressed and
+    only the box is kept in memory, which saves most of the time and memory
+    for atlases covering a small part of the brain (e.g. subcortical or
+    cerebellar atlases).
+
+    Parameters
+    ----------
+    vbm_nifti : niimg-like object, str or Path
+        Nifti of voxel based morphometry as e.g. outputted by CAT or its path.
+    bbox : tuple of slice
+        Bounding box as returned by get_atlas_bbox().
+
+    Returns
+    -------
+    vbm_crop : dict
+        Dictionary with the following keys (accepted by get_roi_values()):
+        data : array - VBM data inside the bounding box (float32)
+        bbox : tuple of slice - the bounding box
+        shape : tuple - shape of the VBM grid
+    """
+    if isinstance(vbm_nifti, (str, PurePath)):
+        # nibabel reads only the header (nilearn would read the data)
+        vbm_nifti = nib.load(Path(vbm_nifti).as_posix())
+    if vbm_nifti.in_memory:
+        data = np.asarray(image.get_data(vbm_nifti))[bbox]
+    else:
+        # slicing the array proxy reads only the needed part of the file
+        data = np.asarray(vbm_nifti.dataobj[bbox])
+    vbm_crop = {
+        'data': data.astype(np.float32, copy=False),
+        'bbox': tuple(bbox),
+        'shape': tuple(vbm_nifti.shape[:3]),
+    }
+    return vbm_crop
+
+
+def _get_bbox_voxels(atlas_index, bbox):
+    """Flat (Fortran order) indices of the atlas voxels within a bbox"""
+    coords = np.unravel_index(
+        atlas_index['voxels'], atlas_index['shape'], order='F')
+    return np.ravel_multi_index(
+        tuple(x - s.start for x, s in zip(coords, bbox)),
+        tuple(s.stop - s.start for s in bbox), order='F')
+
+
+def get_roi_moments(values, atlas_index):
+    """
+    Computes count, sum and sum of squares of the voxel values for every ROI
+    in a single vectorized pass.
+
+    Parameters
+    ----------
+    values : array
+        Voxel values as returned by get_roi_values().
+    atlas_index : dict
+        Voxel-to-ROI index as returned by get_atlas_index().
+
+    Returns
+    -------
+    moments : dict
+        Dictionary with the keys 'count', 'sum' and 'sumsq', each an array
+        with one entry per ROI.
+    """
+    n_rois = len(atlas_index['rois'])
+    voxel_rois = atlas_index['voxel_rois']
+    values = np.asarray(values, dtype=np.float64)
+    moments = {
+        'count': np.bincount(voxel_rois, minlength=n_rois),
+        'sum': np.bincount(voxel_rois, weights=values, minlength=n_rois),
+        'sumsq': np.bincount(
+            voxel_rois, weights=np.square(values), minlength=n_rois),
+    }
+    return moments
+
+
+def get_roi_qc(values, atlas_index, limits=None, nonfinite=None):
+    """
+    Computes quality control metrics of the voxel values of every ROI in a
+    single vectorized pass: number of voxels, fraction of zero and of
+    non-finite voxels, minimum, maximum and the number of voxels replaced by
+    winsorizing with limits.
+
+    Parameters
+    ----------
+    values : array
+        Voxel values as returned by get_roi_values().
+    atlas_index : dict
+        Voxel-to-ROI index as returned by get_atlas_index().
+    limits : array
+        Lower and upper limit of the winsorized mean (see
+        winsorized_mean()). If None (default), the number of winsorized
+        voxels is not computed.
+    nonfinite : array
+        Boolean array, True for the voxel values that were non-finite, as
+        returned by get_roi_values() with return_nonfinite. Non-finite
+        values are not counted as zero. If None (default), all values are
+        considered finite.
+
+    Returns
+    -------
+    roi_qc : dict
+        Dictionary with the keys 'n_voxels', 'zero_fraction',
+        'nonfinite_fraction', 'min', 'max' and (if limits is given)
+        'n_winsorized', each an array with one entry per ROI. Minimum and
+        maximum of ROIs without voxels are NaN.
+    """
+    n_rois = len(atlas_index['rois'])
+    voxel_rois = atlas_index['voxel_rois']
+    if nonfinite is None:
+        nonfinite = np.zeros(len(values), dtype=bool)
+    counts = np.bincount(voxel_rois, minlength=n_rois)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        roi_qc = {
+            'n_voxels': counts,
+            'zero_fraction': np.bincount(
+                voxel_rois, weights=(values == 0) & ~nonfinite,
+                minlength=n_rois) / counts,
+            'nonfinite_fraction': np.bincount(
+                voxel_rois, weights=nonfinite, minlength=n_rois) / counts,
+        }
+    # reduce the contiguous segment of each ROI (voxels are grouped by ROI
+    # in indices of get_atlas_index())
+    if np.any(np.diff(voxel_rois) < 0):
+        values = values[np.argsort(voxel_rois, kind='stable')]
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    valid = counts > 0
+    for t_key, t_func in [('min', np.minimum), ('max', np.maximum)]:
+        roi_qc[t_key] = np.ones(shape=(n_rois)) * np.nan
+        if valid.any():
+            roi_qc[t_key][valid] = t_func.reduceat(values, starts[valid])
+    if limits is not None:
+        # positions replaced by winsorizing (see _segmented_winsorized_mean)
+        lowidx, upidx = _segment_limits(counts, limits)
+        roi_qc['n_winsorized'] = lowidx + counts - np.maximum(upidx, lowidx)
+    return roi_qc
+
+
+def sort_roi_values(values, atlas_index):
+    """
+    Sorts the voxel values once by (ROI, value). Order statistics of all ROIs
+    (winsorized and trimmed means, medians, quantiles) can then be computed
+    from the segment offsets without a loop over ROIs.
+
+    Parameters
+    ----------
+    values : array
+        Voxel values as returned by get_roi_values().
+    atlas_index : dict
+        Voxel-to-ROI index as returned by get_atlas_index().
+
+    Returns
+    -------
+    sorted_values : array
+        Voxel values sorted by ROI and, within each ROI, by value.
+    offsets : array
+        Start of the segment of each ROI in sorted_values, with the total
+        number of values appended (length n_rois + 1).
+    """
+    n_rois = len(atlas_index['rois'])
+    voxel_rois = atlas_index['voxel_rois']
+    sorted_values = values[np.lexsort((values, voxel_rois))]
+    offsets = np.zeros(n_rois + 1, dtype=np.int64)
+    np.cumsum(np.bincount(voxel_rois, minlength=n_rois), out=offsets[1:])
+    return sorted_values, offsets
 
-def get_gmd(atlas_nifti, vbm_nifti, aggregation=None, limits=None):
+
+def get_gmd(atlas_nifti, vbm_nifti, aggregation=None, limits=None,
+            atlas_index=None, atlas_name=None, cache_dir=None, qc=False):
     """
-    Constructs a masker based on the input atlas_nifti, applies resampling of
-    the atlas if necessary and applies the masker to
-    the vbm_nifti to extract (and return) measures of region-wise gray matter
-    density (GMD). So far the aggregtaion methods "winsorized mean", "mean" and
-    "std" are supported.
+    Builds a voxel-to-ROI index based on the input atlas_nifti, applies
+    resampling of the atlas if necessary and reduces the vbm_nifti per ROI to
+    extract (and return) measures of region-wise gray matter density (GMD).
+    Mean and std are derived from ROI moments, all other aggregation methods
+    from a single sort of the voxel values (see _get_funcbyname() for the
+    supported methods).
 
     Parameters
     ----------
     atlas_nifti : niimg-like object
         Nifti of atlas to use for parcellation.
     vbm_nifti: niimg-like object
-        Nifti of voxel based morphometry as e.g. outputted by CAT.
+        Nifti of voxel based morphometry as e.g. outputted by CAT. If its data
+        is not in memory, only the bounding box of the atlas is read (see
+        get_roi_values()). Can also be VBM data read by load_vbm_bbox() if
+        atlas_index is given.
     aggregation: list
         List with strings of aggregation methods to apply. Defaults to
         aggregation = ['winsorized_mean', 'mean', 'std'].
     limits: array
         Array with lower and upper limit for the calculation of the winsorized
-        mean. Only needed when 'winsorized_mean' was specified
-        in aggregation. If wasn't specified defaults to [0.1, 0.1].
+        (or trimmed) mean. Only needed when 'winsorized_mean' or
+        'trimmed_mean' was specified in aggregation. If wasn't specified
+        defaults to [0.1, 0.1].
+    atlas_index : dict
+        Voxel-to-ROI index as returned by get_atlas_index(). If None
+        (default), it is computed from atlas_nifti and vbm_nifti.
+    atlas_name : str
+        Name of the atlas. Only needed together with cache_dir.
+    cache_dir : str or Path
+        Directory of the atlas index cache (see get_cached_atlas_index()).
+        If None (default), the atlas index is not cached.
+    qc : bool
+        Whether to also compute the quality control metrics of every ROI
+        (see get_roi_qc()) from the same voxel values. Defaults to False.
 
     Returns
     -------
@@ -559,7 +918,9 @@ def get_gmd(atlas_nifti, vbm_nifti, aggregation=None, limits=None):
         Dictionary with keys being each of the chosen aggregation methods
         and values the corresponding array with the calculated GMD based on the
         provided atlas. The array therefore as the shape of the chosen number
-        of ROIs (granularity).
+        of ROIs (granularity). If qc, additionally the quality control
+        metrics of get_roi_qc() with keys prefixed by 'qc_' (e.g.
+        'qc_n_voxels').
     agg_func_params: dict
         Dictionary with parameters used for the aggregation function. Keys:
         respective aggregation function, values: dict with responding
@@ -573,36 +934,973 @@ def get_gmd(atlas_nifti, vbm_nifti, aggregation=None, limits=None):
         limits = [0.1, 0.1]
 
     # aggregation function parameters (validity is checked in _get_funcbyname())
-    agg_func_params = {'winsorized_mean': {'limits': limits}}
-
-    # definitions
-    # sort rois to be related to the order of i_roi (and get rid of 0 entry)
-    rois = sorted(np.unique(image.get_data(atlas_nifti)))[1:]  # roi numbering
-    n_rois = len(rois)  # granularity
+    agg_func_params = {
+        'winsorized_mean': {'limits': limits},
+        'trimmed_mean': {'limits': limits},
+    }
+
+    # flatten (and resample) atlas once
+    if atlas_index is None and cache_dir is not None:
+        if atlas_name is None:
+            raise_error('The atlas_name is required to cache the atlas index.')
+        atlas_index = get_cached_atlas_index(
+            atlas_name, atlas_nifti, vbm_nifti, cache_dir)
+    elif atlas_index is None:
+        atlas_index = get_atlas_index(atlas_nifti, vbm_nifti)
+    n_rois = len(atlas_index['rois'])  # granularity
     gmd_aggregated = {x: np.ones(shape=(n_rois)) * np.nan for x in aggregation}
 
-    # resample atlas if needed
-    if not atlas_nifti.shape == vbm_nifti.shape:
-        atlas_nifti = image.resample_to_img(
-            atlas_nifti, vbm_nifti, interpolation='nearest')
-        logger.info('Atlas nifti was resampled to resolution of VBM nifti.')
-
-    # make masker and apply
-    for i_roi, roi in enumerate(rois):
-        mask = image.math_img(f'img=={roi}', img=atlas_nifti)
-        gmd = masking.apply_mask(imgs=vbm_nifti, mask_img=mask)  # gmd per roi
-        logger.info(f'Mask applied for roi {roi}.')
-        # aggregate (for all aggregation options in list)
-        for agg_name in aggregation:
-            logger.info(f'Aggregate GMD in roi {roi} using {agg_name}.')
-            agg_func = _get_funcbyname(
-                agg_name, agg_func_params.get(agg_name, None))
-            gmd_aggregated[agg_name][i_roi] = agg_func(gmd)
+    # single pass over the VBM data for all ROIs
+    values, nonfinite = get_roi_values(
+        vbm_nifti, atlas_index, return_nonfinite=True)
+    moments = get_roi_moments(values, atlas_index)
+    logger.info(f'Voxel values and moments extracted for all {n_rois} ROIs.')
+    if qc:
+        roi_qc = get_roi_qc(values, atlas_index, limits, nonfinite)
+        gmd_aggregated.update({f'qc_{k}': v for k, v in roi_qc.items()})
+
+    # aggregate (for all aggregation options in list)
+    sorted_values = None
+    for agg_name in aggregation:
+        logger.info(f'Aggregate GMD in all ROIs using {agg_name}.')
+        agg_params = agg_func_params.get(agg_name, None)
+        if agg_name in _moment_aggregations:
+            _get_funcbyname(agg_name, agg_params)  # check validity
+            gmd_aggregated[agg_name] = _moment_aggregations[agg_name](moments)
+            continue
+        agg_func = _get_funcbyname(agg_name, agg_params, segmented=True)
+        if sorted_values is None:  # sort only once for all order statistics
+            sorted_values, offsets = sort_roi_values(values, atlas_index)
+        gmd_aggregated[agg_name] = agg_func(sorted_values, offsets)
     logger.info(f'{aggregation} was computed for all {n_rois} ROIs.\n')
 
     return gmd_aggregated, agg_func_params
 
 
+def get_gmd_atlases(atlas_niftis, vbm_nifti, aggregation=None, limits=None,
+                    qc=False):
+    """
+    Extracts region-wise gray matter density (GMD) for several atlases from
+    one VBM nifti. The VBM data is read (and decompressed) only once and
+    shared by all parcellations. See get_gmd() for the aggregation per atlas.
+
+    Parameters
+    ----------
+    atlas_niftis : dict
+        Dictionary with keys being the atlas names and values the nifti of
+        the respective atlas.
+    vbm_nifti: niimg-like object
+        Nifti of voxel based morphometry as e.g. outputted by CAT.
+    aggregation: list
+        List with strings of aggregation methods to apply to every atlas.
+        Defaults to aggregation = ['winsorized_mean', 'mean', 'std'].
+    limits: array
+        Array with lower and upper limit for the calculation of the winsorized
+        (or trimmed) mean. If wasn't specified defaults to [0.1, 0.1].
+    qc : bool
+        Whether to also compute the quality control metrics per ROI (see
+        get_gmd()). Defaults to False.
+
+    Returns
+    -------
+    gmd_atlases : dict
+        Dictionary with keys being the atlas names and values the
+        gmd_aggregated dictionary as returned by get_gmd() for this atlas.
+    agg_func_params: dict
+        Dictionary with parameters used for the aggregation function. Keys:
+        respective aggregation function, values: dict with responding
+        parameters
+    """
+
+    # load the VBM data into memory once for all atlases
+    vbm_nifti = image.load_img(vbm_nifti)
+    vbm_nifti = image.new_img_like(
+        vbm_nifti, np.asarray(image.get_data(vbm_nifti)), copy_header=True)
+    logger.info(
+        f'VBM data loaded once for {len(atlas_niftis)} atlases.')
+
+    gmd_atlases = {}
+    agg_func_params = None
+    for atlas_name, atlas_nifti in atlas_niftis.items():
+        logger.info(f'Compute GMD for atlas {atlas_name}.')
+        gmd_atlases[atlas_name], agg_func_params = get_gmd(
+            atlas_nifti, vbm_nifti, aggregation=aggregation, limits=limits,
+            qc=qc)
+
+    return gmd_atlases, agg_func_params
+
+
+def get_gmd_subjects(vbm_fnames, atlas_indexes, aggregation=None,
+                     limits=None, n_jobs=1, dataset_dir=None, prefetch=2,
+                     qc=False):
+    """
+    Extracts region-wise gray matter density (GMD) for several subjects and
+    atlases. The atlases are resampled and indexed once (see
+    get_atlas_index()) and the subjects are processed in a local process
+    pool. The voxel-to-ROI indices are shared read-only with the worker
+    processes through shared memory instead of being copied to each of them.
+    If a dataset_dir is given, the niftis are fetched from the DataLad
+    dataset in a background thread while the previous ones are processed and
+    dropped again once processed (see get_dataset_files()).
+
+    Parameters
+    ----------
+    vbm_fnames : list of str or Path
+        Paths to the VBM niftis of all subjects. All niftis need to be on the
+        grid the atlas indices were built for.
+    atlas_indexes : dict
+        Dictionary with keys being the atlas names and values the voxel-to-ROI
+        index as returned by get_atlas_index().
+    aggregation: list
+        List with strings of aggregation methods to apply to every atlas.
+        Defaults to aggregation = ['winsorized_mean', 'mean', 'std'].
+    limits: array
+        Array with lower and upper limit for the calculation of the winsorized
+        (or trimmed) mean. If wasn't specified defaults to [0.1, 0.1].
+    n_jobs : int
+        Number of worker processes. If 1 (default), the subjects are
+        processed sequentially in the calling process.
+    dataset_dir : str or Path
+        Directory of the installed DataLad dataset (see get_dataset()) of
+        the VBM niftis. If None (default), the niftis need to be available.
+    prefetch : int
+        Number of niftis fetched ahead of the ones being processed (only
+        used with dataset_dir). At most prefetch + 2 * n_jobs niftis are on
+        disk at once. Defaults to 2.
+    qc : bool
+        Whether to also compute the quality control metrics per ROI (see
+        get_gmd()). Defaults to False.
+
+    Returns
+    -------
+    gmd_subjects : list of dict
+        One dictionary per VBM nifti (in the order of vbm_fnames) with keys
+        being the atlas names and values the gmd_aggregated dictionary as
+        returned by get_gmd() for this atlas.
+    agg_func_params: dict
+        Dictionary with parameters used for the aggregation function. Keys:
+        respective aggregation function, values: dict with responding
+        parameters
+    """
+    if n_jobs < 1:
+        raise_error(f'n_jobs ({n_jobs}) needs to be at least 1.')
+    if prefetch < 0:
+        raise_error(f'prefetch ({prefetch}) needs to be at least 0.')
+
+    if n_jobs == 1:
+        _init_gmd_worker(atlas_indexes, aggregation, limits, qc)
+        results = _map_vbm_fnames(
+            _get_gmd_worker, vbm_fnames, None, 1, dataset_dir, prefetch)
+    else:
+        # copy the voxel-to-ROI indices into shared memory once
+        shared = []
+        shared_indexes = {}
+        try:
+            for atlas_name, atlas_index in atlas_indexes.items():
+                shared_indexes[atlas_name] = dict(atlas_index)
+                for key in ['voxels', 'voxel_rois']:
+                    shm, spec = _share_array(atlas_index[key])
+                    shared.append(shm)
+                    shared_indexes[atlas_name][key] = spec
+            logger.info(
+                f'Process {len(vbm_fnames)} VBM niftis with {n_jobs} worker '
+                'processes.')
+            with ProcessPoolExecutor(
+                    max_workers=n_jobs, initializer=_init_gmd_worker,
+                    mp_context=multiprocessing.get_context('fork'),
+                    initargs=(shared_indexes, aggregation, limits,
+                              qc)) as pool:
+                # fork the workers before the prefetch thread starts (forking
+                # while another thread holds a lock can hang a worker)
+                list(pool.map(int, range(n_jobs)))
+                results = _map_vbm_fnames(
+                    _get_gmd_worker, vbm_fnames, pool, n_jobs, dataset_dir,
+                    prefetch)
+        finally:
+            for shm in shared:
+                shm.close()
+                shm.unlink()
+
+    gmd_subjects = [x[0] for x in results]
+    agg_func_params = results[0][1] if len(results) > 0 else None
+    return gmd_subjects, agg_func_params
+
+
+def _map_vbm_fnames(func, vbm_fnames, pool, n_jobs, dataset_dir, prefetch):
+    """
+    Applies func to each VBM nifti (in the pool, at most one nifti per worker
+    process at once, or in the calling process if pool is None). With a
+    dataset_dir, the next prefetch niftis are fetched in a background thread
+    while the current ones are processed and each nifti is dropped once its
+    result was collected. If the processing fails, the niftis fetched ahead
+    or in process are dropped as well.
+    """
+    vbm_fnames = [Path(x) for x in vbm_fnames]
+    n_active = 1 if pool is None else n_jobs
+    results = []
+    pending = deque()  # niftis (with the future of their result) in process
+    fetches = deque()  # niftis (with the future of their fetch) fetched ahead
+
+    def _collect():
+        fname, result = pending[0]
+        results.append(result if pool is None else result.result())
+        pending.popleft()
+        if dataset_dir is not None:
+            drop_dataset_files(dataset_dir, [fname])
+
+    with ThreadPoolExecutor(max_workers=1) as fetcher:
+        try:
+            for i_fetch in range(len(vbm_fnames)):
+                if dataset_dir is not None:
+                    # keep prefetch niftis fetched ahead of the ones in process
+                    while (len(fetches) < prefetch + n_active and
+                           i_fetch + len(fetches) < len(vbm_fnames)):
+                        t_fname = vbm_fnames[i_fetch + len(fetches)]
+                        fetches.append((t_fname, fetcher.submit(
+                            get_dataset_files, dataset_dir, [t_fname])))
+                    fetches[0][1].result()
+                if len(pending) >= n_active:
+                    _collect()
+                fname = vbm_fnames[i_fetch]
+                result = func(fname) if pool is None else \
+                    pool.submit(func, fname)
+                if dataset_dir is not None:
+                    fetches.popleft()
+                pending.append((fname, result))
+            while len(pending) > 0:
+                _collect()
+        finally:
+            if dataset_dir is not None and len(pending) + len(fetches) > 0:
+                # failed: wait for the fetches and workers still using the
+                # niftis, then drop them (e.g. in a shared dataset)
+                futures = [x[1] for x in fetches]
+                if pool is not None:
+                    futures.extend(x[1] for x in pending)
+                for t_future in futures:
+                    t_future.cancel()
+                wait(futures)
+                drop_dataset_files(
+                    dataset_dir, [x[0] for x in [*pending, *fetches]])
+    return results
+
+
+def _share_array(array):
+    """Copy an array into a new shared memory block. Returns the block and the
+    specification (name, shape, dtype) needed to attach to it."""
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared_array = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    shared_array[:] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def _attach_array(spec, track=True):
+    """Attach read-only to an array shared with _share_array(). With
+    track=False, the block is not registered with the resource tracker of
+    this process, as the creating process unlinks it. Before Python 3.13,
+    this replaces the register function of the tracker while attaching and
+    is thus only allowed in a single-threaded process (e.g. in the
+    initializer of a worker)."""
+    name, shape, dtype = spec
+    if track:
+        shm = shared_memory.SharedMemory(name=name)
+    elif sys.version_info >= (3, 13):
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    else:
+        # (unregistering after attaching would also unregister the block of
+        # the creating process if the tracker is shared, e.g. when forked)
+        if threading.active_count() > 1:
+            raise_error(
+                'Shared arrays can only be attached without tracking in a '
+                'single-threaded process.')
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args: None
+        try:
+            shm = shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    array.flags.writeable = False
+    return shm, array
+
+
+# state of a GMD worker process (set once by _init_gmd_worker)
+_gmd_worker = {}
+
+
+def _init_gmd_worker(atlas_indexes, aggregation, limits, qc=False):
+    """Set up a GMD worker with the (shared) atlas indices"""
+    _gmd_worker['shared'] = []
+    _gmd_worker['atlas_indexes'] = {}
+    for atlas_name, atlas_index in atlas_indexes.items():
+        atlas_index = dict(atlas_index)
+        for key in ['voxels', 'voxel_rois']:
+            if isinstance(atlas_index[key], tuple):
+                # untracked: get_gmd_subjects unlinks the blocks. The
+                # initializer runs before the worker starts any thread, so
+                # no resource of another thread is left untracked
+                shm, atlas_index[key] = _attach_array(
+                    atlas_index[key], track=False)
+                _gmd_worker['shared'].append(shm)
+        _gmd_worker['atlas_indexes'][atlas_name] = atlas_index
+    # one bounding box for all atlases: each VBM nifti is read once
+    _gmd_worker['bbox'] = get_atlas_bbox(
+        _gmd_worker['atlas_indexes'].values())
+    _gmd_worker['aggregation'] = aggregation
+    _gmd_worker['limits'] = limits
+    _gmd_worker['qc'] = qc
+
+
+def _get_gmd_worker(vbm_fname):
+    """GMD of one VBM nifti for all atlases of the worker"""
+    vbm_crop = load_vbm_bbox(vbm_fname, _gmd_worker['bbox'])
+    gmd_atlases = {}
+    agg_func_params = None
+    for atlas_name, atlas_index in _gmd_worker['atlas_indexes'].items():
+        gmd_atlases[atlas_name], agg_func_params = get_gmd(
+            None, vbm_crop, aggregation=_gmd_worker['aggregation'],
+            limits=_gmd_worker['limits'], atlas_index=atlas_index,
+            qc=_gmd_worker['qc'])
+    logger.info(f'GMD computed for {vbm_fname}.')
+    return gmd_atlases, agg_func_params
+
+
+# -----------------------------------------------------------------------------#
+# Cohort voxel matrix related
+# -----------------------------------------------------------------------------#
+
+def build_voxel_matrix(vbm_fnames, subject_ids, mask_nifti, out_dir):
+    """
+    Writes the VBM voxels inside a brain mask of all subjects into one
+    memory-mapped float32 voxel x subject matrix. The matrix is stored in
+    Fortran order, so that the voxels of each subject (and any block of
+    subjects) are contiguous on disk. As for get_roi_values(), non-finite
+    values are set to 0.
+
+    Parameters
+    ----------
+    vbm_fnames : iterable of str or Path
+        Paths to the VBM niftis, in the order of subject_ids. Can be a
+        generator, e.g. to fetch (and drop) the niftis in chunks.
+    subject_ids : list
+        Identifier of each subject, e.g. (SubjectID, Session) pairs. Saved
+        with the matrix, one column per subject.
+    mask_nifti : niimg-like object
+        Brain mask on the grid of the VBM niftis. Voxels with non-zero values
+        are stored.
+    out_dir : str or Path
+        Directory to save the matrix (matrix.npy), the flat (Fortran order)
+        indices of the mask voxels (voxels.npy) and the grid and subject
+        information (meta.json) to.
+
+    Returns
+    -------
+    voxel_matrix : dict
+        The voxel matrix as returned by load_voxel_matrix().
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(exist_ok=True, parents=True)
+    mask_nifti = image.load_img(mask_nifti)
+    shape = tuple(mask_nifti.shape[:3])
+    voxels = np.flatnonzero(
+        np.asarray(image.get_data(mask_nifti)).ravel(order='F'))
+    n_subjects = len(subject_ids)
+    logger.info(
+        f'Build voxel matrix of {len(voxels)} voxels x {n_subjects} subjects '
+        f'in {out_dir.as_posix()}.')
+
+    np.save(out_dir / 'voxels.npy', voxels)
+    with open(out_dir / 'meta.json', 'w') as f:
+        json.dump(
+            {'shape': shape, 'affine': mask_nifti.affine.tolist(),
+             'subject_ids': [
+                 list(x) if isinstance(x, (list, tuple)) else [x]
+                 for x in subject_ids]},
+            f)
+    matrix = np.lib.format.open_memmap(
+        out_dir / 'matrix.npy', mode='w+', dtype=np.float32,
+        shape=(len(voxels), n_subjects), fortran_order=True)
+
+    atlas_index = {'voxels': voxels, 'shape': shape}
+    i_subject = -1
+    for i_subject, vbm_fname in enumerate(vbm_fnames):
+        if i_subject >= n_subjects:
+            raise_error(
+                f'More VBM niftis than subject IDs ({n_subjects}) were given.')
+        matrix[:, i_subject] = get_roi_values(vbm_fname, atlas_index)
+        if (i_subject + 1) % 1000 == 0:
+            matrix.flush()
+            logger.info(f'{i_subject + 1} subjects written.')
+    if i_subject + 1 != n_subjects:
+        raise_error(
+            f'Only {i_subject + 1} VBM niftis for {n_subjects} subject IDs '
+            'were given.')
+    matrix.flush()
+    del matrix
+    logger.info('Voxel matrix was built.')
+
+    return load_voxel_matrix(out_dir)
+
+
+def load_voxel_matrix(out_dir):
+    """
+    Loads a voxel matrix written by build_voxel_matrix() (memory-mapped
+    read-only).
+
+    Parameters
+    ----------
+    out_dir : str or Path
+        Directory the voxel matrix was saved to.
+
+    Returns
+    -------
+    voxel_matrix : dict
+        Dictionary with the following keys:
+        matrix : array - memory-mapped voxel x subject matrix (float32)
+        voxels : array - flat indices (Fortran order) of the mask voxels,
+                 i.e. of the rows of matrix
+        shape : tuple - shape of the VBM grid
+        affine : array - affine of the VBM grid
+        subject_ids : list - identifier of each subject (column of matrix)
+    """
+    out_dir = Path(out_dir)
+    with open(out_dir / 'meta.json', 'r') as f:
+        meta = json.load(f)
+    voxel_matrix = {
+        'matrix': np.load(out_dir / 'matrix.npy', mmap_mode='r'),
+        'voxels': np.load(out_dir / 'voxels.npy', mmap_mode='r'),
+        'shape': tuple(meta['shape']),
+        'affine': np.array(meta['affine']),
+        'subject_ids': [tuple(x) for x in meta['subject_ids']],
+    }
+    return voxel_matrix
+
+
+def get_roi_projection(atlas_index, voxel_matrix):
+    """
+    Sparse label-indicator matrix (ROIs x rows of the voxel matrix) of an
+    atlas. Multiplying it with the voxel matrix sums the voxels of each ROI.
+
+    Parameters
+    ----------
+    atlas_index : dict
+        Voxel-to-ROI index as returned by get_atlas_index(), built on the
+        grid of the voxel matrix.
+    voxel_matrix : dict
+        The voxel matrix as returned by load_voxel_matrix().
+
+    Returns
+    -------
+    projection : scipy.sparse.csr_matrix
+        Indicator matrix of shape n_rois x n_voxels (of the voxel matrix).
+    """
+    if atlas_index['shape'] != voxel_matrix['shape']:
+        raise_error(
+            f'The shape of the atlas index {atlas_index["shape"]} differs '
+            f'from the shape of the voxel matrix {voxel_matrix["shape"]}.')
+    mask_voxels = voxel_matrix['voxels']
+    rows = np.searchsorted(mask_voxels, atlas_index['voxels'])
+    in_mask = mask_voxels[np.minimum(rows, len(mask_voxels) - 1)] == \
+        atlas_index['voxels']
+    if not in_mask.all():
+        logger.warning(
+            f'{np.count_nonzero(~in_mask)} atlas voxels are outside of the '
+            'mask of the voxel matrix and are ignored.')
+    projection = sparse.csr_matrix(
+        (np.ones(np.count_nonzero(in_mask)),
+         (np.asarray(atlas_index['voxel_rois'])[in_mask], rows[in_mask])),
+        shape=(len(atlas_index['rois']), len(mask_voxels)))
+    return projection
+
+
+def project_voxel_matrix(voxel_matrix, projection, aggregation=None,
+                         block_size=512):
+    """
+    Aggregates the voxel matrix per ROI for all subjects with the sparse
+    projection of an atlas, in blocks of subjects (columns) to bound the
+    memory. Only moment-based aggregation methods are supported.
+
+    Parameters
+    ----------
+    voxel_matrix : dict
+        The voxel matrix as returned by load_voxel_matrix().
+    projection : scipy.sparse matrix
+        Indicator matrix as returned by get_roi_projection().
+    aggregation : list
+        List with strings of aggregation methods to apply. Valid methods:
+        'mean', 'std', 'count', 'sum', 'sumsq'. Defaults to ['mean', 'std'].
+    block_size : int
+        Number of subjects processed at once. Defaults to 512.
+
+    Returns
+    -------
+    roi_aggregated : dict
+        Dictionary with keys being each of the chosen aggregation methods
+        and values arrays of shape n_subjects x n_rois.
+    """
+    if aggregation is None:
+        aggregation = ['mean', 'std']
+    invalid = [x for x in aggregation if x not in _moment_aggregations]
+    if len(invalid) > 0:
+        raise_error(
+            f'{invalid} cannot be computed from the voxel matrix. Valid '
+            f'methods: {list(_moment_aggregations.keys())}')
+
+    matrix = voxel_matrix['matrix']
+    n_subjects = matrix.shape[1]
+    n_rois = projection.shape[0]
+    moments = {
+        'count': np.tile(np.asarray(projection.sum(axis=1)).ravel(),
+                         (n_subjects, 1)),
+        'sum': np.zeros((n_subjects, n_rois)),
+        'sumsq': np.zeros((n_subjects, n_rois)),
+    }
+    for i_start in range(0, n_subjects, block_size):
+        i_stop = min(i_start + block_size, n_subjects)
+        block = np.asarray(matrix[:, i_start:i_stop], dtype=np.float64)
+        moments['sum'][i_start:i_stop] = (projection @ block).T
+        moments['sumsq'][i_start:i_stop] = (projection @ np.square(block)).T
+        logger.info(f'Projected subjects {i_start} to {i_stop - 1}.')
+
+    roi_aggregated = {
+        agg_name: _moment_aggregations[agg_name](moments)
+        for agg_name in aggregation}
+    return roi_aggregated
+
+
+def correlate_voxel_matrix(voxel_matrix, confounds, method='pearson',
+                           block_size=1024):
+    """
+    Correlates every voxel of the voxel matrix with every confound, streaming
+    blocks of voxels (rows) through memory. As for scipy.stats.pearsonr() on
+    the subjects without missing values, each confound is correlated with
+    the subjects for which it is available. Memory is bounded by block_size
+    x n_subjects (plus the n_voxels x n_confounds results).
+
+    Parameters
+    ----------
+    voxel_matrix : dict
+        The voxel matrix as returned by load_voxel_matrix().
+    confounds : pandas.DataFrame
+        Confounds with one row per subject in the order of the columns of the
+        voxel matrix (e.g. reindexed by voxel_matrix['subject_ids']) and one
+        column per confound. Missing values (NaN) are excluded per confound.
+    method : str or list of str
+        Correlation method for all confounds or one method per confound:
+        'pearson' (also point biserial for binary confounds) or 'spearman'.
+        Defaults to 'pearson'.
+    block_size : int
+        Number of voxels processed at once. Defaults to 1024.
+
+    Returns
+    -------
+    corr : array
+        Correlation coefficients of shape n_voxels x n_confounds (float32).
+        NaN for voxels that are constant across subjects.
+    p_vals : array
+        Two-sided p values of shape n_voxels x n_confounds (float32).
+    """
+    matrix = voxel_matrix['matrix']
+    n_voxels, n_subjects = matrix.shape
+    if confounds.shape[0] != n_subjects:
+        raise_error(
+            f'The number of confound rows ({confounds.shape[0]}) differs from '
+            f'the number of subjects in the voxel matrix ({n_subjects}).')
+    if isinstance(method, str):
+        method = [method] * confounds.shape[1]
+    if len(method) != confounds.shape[1]:
+        raise_error(
+            f'{len(method)} methods were given for {confounds.shape[1]} '
+            'confounds.')
+    invalid = [x for x in set(method) if x not in ['pearson', 'spearman']]
+    if len(invalid) > 0:
+        raise_error(
+            f'Invalid correlation methods {invalid}. Valid methods: '
+            "'pearson', 'spearman'.")
+
+    values = confounds.to_numpy(dtype=np.float64)
+    i_pearson = [i for i, x in enumerate(method) if x == 'pearson']
+    # spearman: voxels are ranked within the subjects of each pattern of
+    # missing values (confounds sharing a pattern are handled together)
+    spearman_groups = {}
+    for i_confound, x in enumerate(method):
+        if x == 'spearman':
+            valid = ~np.isnan(values[:, i_confound])
+            spearman_groups.setdefault(valid.tobytes(), []).append(i_confound)
+    spearman_groups = [
+        (np.frombuffer(key, dtype=bool), i_confounds)
+        for key, i_confounds in spearman_groups.items()]
+
+    corr = np.full((n_voxels, len(method)), np.nan, dtype=np.float32)
+    n_valid = np.count_nonzero(~np.isnan(values), axis=0)
+    logger.info(
+        f'Correlate {n_voxels} voxels with {len(method)} confounds in blocks '
+        f'of {block_size} voxels.')
+    for i_start in range(0, n_voxels, block_size):
+        i_stop = min(i_start + block_size, n_voxels)
+        block = np.asarray(matrix[i_start:i_stop], dtype=np.float64)
+        if len(i_pearson) > 0:
+            corr[i_start:i_stop, i_pearson] = _masked_pearson(
+                block, values[:, i_pearson])
+        for valid, i_confounds in spearman_groups:
+            corr[i_start:i_stop, i_confounds] = _masked_pearson(
+                stats.rankdata(block[:, valid], axis=1),
+                stats.rankdata(values[valid][:, i_confounds], axis=0))
+        if (i_start // block_size) % 100 == 0:
+            logger.info(f'Correlated voxels {i_start} to {i_stop - 1}.')
+
+    # two-sided p values of the t statistic (as scipy.stats.spearmanr)
+    dof = (n_valid - 2).astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_stat = np.abs(corr) * np.sqrt(dof / (1. - np.square(corr)))
+    p_vals = (2 * stats.t.sf(t_stat, dof)).astype(np.float32)
+    return corr, p_vals
+
+
+def voxel_matrix_to_nifti(values, voxel_matrix, fill_value=0.):
+    """
+    Writes values of the rows of the voxel matrix (e.g. voxelwise
+    correlations) back into a nifti on the grid of the voxel matrix.
+
+    Parameters
+    ----------
+    values : array
+        Values of shape n_voxels (one map) or n_voxels x n_maps (one volume
+        per map).
+    voxel_matrix : dict
+        The voxel matrix as returned by load_voxel_matrix().
+    fill_value : float
+        Value of the voxels outside of the mask. Defaults to 0.
+
+    Returns
+    -------
+    nifti : nibabel.Nifti1Image
+        3D (one map) or 4D (n_maps volumes) nifti.
+    """
+    values = np.asarray(values)
+    n_maps = values.shape[1:]
+    data = np.full(
+        (np.prod(voxel_matrix['shape']), *n_maps), fill_value,
+        dtype=values.dtype)
+    data[voxel_matrix['voxels']] = values
+    data = data.reshape((*voxel_matrix['shape'], *n_maps), order='F')
+    return nib.Nifti1Image(data, voxel_matrix['affine'])
+
+
+def _masked_pearson(x, y):
+    """
+    Pearson correlation of each row of x (n_rows x n_subjects) with each
+    column of y (n_subjects x n_columns), excluding the subjects with missing
+    values (NaN) in y per column.
+    """
+    valid = (~np.isnan(y)).astype(np.float64)
+    n_valid = valid.sum(axis=0)
+    # centering first keeps the sums of squares well conditioned
+    y = np.where(valid > 0, y - np.nanmean(y, axis=0), 0.)
+    x = x - x.mean(axis=1, keepdims=True)
+    sum_x = x @ valid
+    sum_y = y.sum(axis=0)
+    cov = x @ y - sum_x * sum_y / n_valid
+    var_x = np.square(x) @ valid - np.square(sum_x) / n_valid
+    var_y = np.square(y).sum(axis=0) - np.square(sum_y) / n_valid
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr = cov / np.sqrt(var_x * var_y)
+    return np.clip(corr, -1., 1.)
+
+
+# -----------------------------------------------------------------------------#
+# Sufficient statistics related
+# -----------------------------------------------------------------------------#
+
+# range of the histogram sketches (GMD values are densities between 0 and 1)
+_hist_value_range = (0., 1.)
+
+
+def read_roi_stats(uri, atlas_name, kind='gmd', n_bins=None,
+                   index_col=None):
+    """
+    Reads the per-ROI sufficient statistics (count, sum, sum of squares and
+    optionally the histogram sketch) of a parcellation as saved by the
+    extraction with the aggregation methods 'count', 'sum', 'sumsq' (and
+    'hist_<n_bins>').
+
+    Parameters
+    ----------
+    uri : str
+        The connection URI of the features database.
+    atlas_name : str
+        The name of the atlas (as used to save the features).
+    kind : str
+        Kind of features. Defaults to 'gmd'.
+    n_bins : int
+        Number of bins of the histogram sketch to read. If None (default), no
+        histogram is read.
+    index_col : list(str)
+        The columns to be used as index. Defaults to
+        ['SubjectID', 'Session'].
+
+    Returns
+    -------
+    stats : dict
+        Dictionary with the keys 'count', 'sum', 'sumsq' (arrays of shape
+        n_subjects x n_rois) and, if n_bins was specified, 'hist' (array of
+        shape n_subjects x n_bins x n_rois).
+    index : pandas.Index
+        Index of the subjects (first axis of the stats).
+    labels : list of str
+        ROI labels (last axis of the stats).
+    """
+    if index_col is None:
+        index_col = ['SubjectID', 'Session']
+
+    stats = {}
+    index = None
+    labels = None
+    for stat_name in ['count', 'sum', 'sumsq']:
+        stat_df = read_features(
+            uri=uri, kind=kind, atlas_name=atlas_name, index_col=index_col,
+            agg_function=stat_name).sort_index()
+        if index is None:
+            index, labels = stat_df.index, stat_df.columns.to_list()
+        elif not stat_df.index.equals(index):
+            raise_error(
+                f'The subjects of the {stat_name} table differ from the '
+                'subjects of the count table.')
+        stats[stat_name] = stat_df[labels].to_numpy(dtype=np.float64)
+
+    if n_bins is not None:
+        hist_df = read_features(
+            uri=uri, kind=kind, atlas_name=atlas_name,
+            index_col=index_col + ['Bin'],
+            agg_function=f'hist_{n_bins}').sort_index()
+        if len(hist_df) != len(index) * n_bins:
+            raise_error(
+                f'The histogram table does not contain {n_bins} bins for '
+                'each subject.')
+        stats['hist'] = hist_df[labels].to_numpy(dtype=np.float64).reshape(
+            len(index), n_bins, len(labels))
+    return stats, index, labels
+
+
+def get_parent_rois(atlas_index, parent_index):
+    """
+    Maps each ROI of a (fine) parcellation to the ROI of a coarser parent
+    parcellation it overlaps most with, e.g. Tian scale 4 to scale 1 or
+    Schaefer parcels to Yeo networks. Both indices need to be built on the
+    same grid.
+
+    Parameters
+    ----------
+    atlas_index : dict
+        Voxel-to-ROI index of the fine parcellation as returned by
+        get_atlas_index().
+    parent_index : dict
+        Voxel-to-ROI index of the parent parcellation as returned by
+        get_atlas_index().
+
+    Returns
+    -------
+    parent_rois : array
+        ROI value of the parent parcellation for each ROI of the fine
+        parcellation. ROIs without any overlap are mapped to 0 (background).
+    """
+    if atlas_index['shape'] != parent_index['shape']:
+        raise_error(
+            f'The shape of the atlas index {atlas_index["shape"]} differs '
+            f'from the shape of the parent index {parent_index["shape"]}.')
+    n_rois = len(atlas_index['rois'])
+    n_parents = len(parent_index['rois'])
+
+    # parent ROI position (+1, 0 for background) of every voxel
+    parent_flat = np.zeros(np.prod(parent_index['shape']), dtype=np.int64)
+    parent_flat[parent_index['voxels']] = \
+        np.asarray(parent_index['voxel_rois']) + 1
+    voxel_parents = parent_flat[atlas_index['voxels']]
+
+    # voxel overlap of each ROI with each parent ROI
+    overlap = np.bincount(
+        np.asarray(atlas_index['voxel_rois'], dtype=np.int64) *
+        (n_parents + 1) + voxel_parents,
+        minlength=n_rois * (n_parents + 1)).reshape(n_rois, n_parents + 1)
+    best = np.argmax(overlap[:, 1:], axis=1)
+    parent_rois = np.where(
+        overlap[np.arange(n_rois), best + 1] > 0,
+        np.asarray(parent_index['rois'])[best], 0)
+    return parent_rois
+
+
+def get_schaefer_networks(labels, hemisphere=False):
+    """
+    Yeo network of each ROI of a Schaefer parcellation derived from the ROI
+    labels (e.g. 'LH_Vis_1' or '7Networks_LH_Vis_1' -> 'Vis').
+
+    Parameters
+    ----------
+    labels : list of str
+        Schaefer ROI labels.
+    hemisphere : bool
+        If True, keep the hemisphere in the network name (e.g. 'LH_Vis').
+        Defaults to False.
+
+    Returns
+    -------
+    networks : array of str
+        Network name for each ROI.
+    """
+    networks = []
+    for label in labels:
+        parts = label.split('_')
+        if parts[0].endswith('Networks'):
+            parts = parts[1:]
+        if len(parts) < 3:
+            raise_error(f'{label} is not a valid Schaefer ROI label.')
+        networks.append('_'.join(parts[:2]) if hemisphere else parts[1])
+    return np.array(networks)
+
+
+def aggregate_roi_stats(stats, groups):
+    """
+    Aggregates per-ROI sufficient statistics to groups of ROIs (e.g. parent
+    ROIs or networks) without re-reading any voxel values.
+
+    Parameters
+    ----------
+    stats : dict
+        Sufficient statistics with the keys 'count', 'sum', 'sumsq' and
+        optionally 'hist' (see read_roi_stats()). The ROIs are the last axis
+        of every entry.
+    groups : array-like
+        Group of each ROI, e.g. as returned by get_parent_rois() or
+        get_schaefer_networks().
+
+    Returns
+    -------
+    group_names : array
+        Sorted unique groups (last axis of the aggregated statistics).
+    group_stats : dict
+        Sufficient statistics of the groups with the same keys as stats.
+    """
+    groups = np.asarray(groups)
+    n_rois = np.shape(stats['count'])[-1]
+    if len(groups) != n_rois:
+        raise_error(
+            f'The number of groups ({len(groups)}) does not match the number '
+            f'of ROIs ({n_rois}).')
+    group_names, group_pos = np.unique(groups, return_inverse=True)
+
+    # ROI-to-group indicator matrix (sums over the ROI axis)
+    indicator = np.zeros((n_rois, len(group_names)))
+    indicator[np.arange(n_rois), group_pos] = 1
+    group_stats = {
+        stat_name: np.asarray(stat_values, dtype=np.float64) @ indicator
+        for stat_name, stat_values in stats.items()}
+    return group_names, group_stats
+
+
+def get_stats_aggregation(stats, aggregation=None,
+                          value_range=_hist_value_range):
+    """
+    Derives aggregation methods from sufficient statistics. Mean and std
+    are exact; median and quantiles are approximated from the histogram
+    sketch by linear interpolation within the bins.
+
+    Parameters
+    ----------
+    stats : dict
+        Sufficient statistics with the keys 'count', 'sum', 'sumsq' and
+        optionally 'hist' (see read_roi_stats() and aggregate_roi_stats()).
+    aggregation : list
+        List with strings of aggregation methods to derive. Valid methods:
+        'mean', 'std' and, if stats contains 'hist', 'median' and
+        'quantile_<q>'. Defaults to ['mean', 'std'].
+    value_range : tuple
+        Range of values covered by the histogram sketch. Defaults to (0, 1).
+
+    Returns
+    -------
+    stats_aggregated : dict
+        Dictionary with keys being each of the chosen aggregation methods
+        and values the corresponding array (same shape as stats['count']).
+    """
+    if aggregation is None:
+        aggregation = ['mean', 'std']
+
+    stats_aggregated = {}
+    for agg_name in aggregation:
+        if agg_name in ['mean', 'std']:
+            stats_aggregated[agg_name] = _moment_aggregations[agg_name](stats)
+        elif agg_name == 'median' or re.match(r'^quantile_', agg_name):
+            if 'hist' not in stats:
+                raise_error(
+                    f'{agg_name} can only be derived from statistics with a '
+                    'histogram sketch.')
+            q = 0.5 if agg_name == 'median' else float(agg_name.split('_')[1])
+            stats_aggregated[agg_name] = _hist_quantile(
+                stats['hist'], q, value_range)
+        else:
+            raise_error(
+                f'{agg_name} cannot be derived from sufficient statistics. '
+                "Valid methods: 'mean', 'std', 'median', 'quantile_<q>'.")
+    return stats_aggregated
+
+
+def histogram_sketch(data, n_bins, value_range=_hist_value_range):
+    """
+    Fixed-size histogram of the data over value_range. Values outside the
+    range are counted in the first or last bin. Histograms of the same range
+    can be added to merge ROIs or subjects.
+
+    Parameters
+    ----------
+    data : array
+        Data to sketch.
+    n_bins : int
+        Number of bins.
+    value_range : tuple
+        Lower and upper edge of the histogram. Defaults to (0, 1).
+
+    Returns
+    -------
+    hist : array
+        Number of values in each bin.
+    """
+    bins = _sketch_bins(np.ravel(data), n_bins, value_range)
+    return np.bincount(bins, minlength=n_bins)
+
+
+def _sketch_bins(values, n_bins, value_range):
+    """Histogram sketch bin of each value"""
+    low, high = value_range
+    bins = np.floor(
+        (np.asarray(values, dtype=np.float64) - low) / (high - low) * n_bins)
+    return np.clip(bins, 0, n_bins - 1).astype(np.int64)
+
+
+def _hist_quantile(hist, q, value_range):
+    """
+    Approximate quantile q from histogram sketches with the bins on the
+    second to last axis (linear interpolation within the bin).
+    """
+    hist = np.asarray(hist, dtype=np.float64)
+    n_bins = hist.shape[-2]
+    low, high = value_range
+    width = (high - low) / n_bins
+
+    cumulative = np.cumsum(hist, axis=-2)
+    target = q * cumulative[..., -1:, :]
+    # first bin in which the cumulative count reaches the target (q=0: first
+    # bin with a count)
+    below = cumulative <= target if q == 0 else cumulative < target
+    bin_pos = np.minimum(
+        np.sum(below, axis=-2, keepdims=True), n_bins - 1)
+    in_bin = np.take_along_axis(hist, bin_pos, axis=-2)
+    before = np.take_along_axis(cumulative, bin_pos, axis=-2) - in_bin
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fraction = np.where(in_bin > 0, (target - before) / in_bin, 0)
+    out = low + (bin_pos + np.clip(fraction, 0, 1)) * width
+    out[cumulative[..., -1:, :] == 0] = np.nan
+    return out[..., 0, :]
+
+
 # -----------------------------------------------------------------------------#
 # Surface features related
 # -----------------------------------------------------------------------------#
@@ -688,7 +1986,7 @@ def ukbb_get_category_datafields(category, session=None, addSbjID=True):
 # -----------------------------------------------------------------------------#
 
 # generic way of applying any function
-def _get_funcbyname(name, func_params):
+def _get_funcbyname(name, func_params, segmented=False):
     """
     Helper function to generically apply any function. Here used to apply
     different aggregation functions for extraction of gray matter density (GMD).
@@ -698,15 +1996,28 @@ def _get_funcbyname(name, func_params):
     name : str
         Name to identify the function. Currently supported names and
         corresponding functions are:
-        'winsorized_mean' -> scipy.stats.mstats.winsorize
+        'winsorized_mean' -> scipy.stats.mstats.winsorize + mean
+        'trimmed_mean' -> scipy.stats.mstats.trimmed_mean
         'mean' -> np.mean
         'std' -> np.std
+        'median' -> np.median
+        'quantile_<q>' -> np.quantile with q between 0 and 1, e.g.
+            'quantile_0.25'
+        'count', 'sum', 'sumsq' -> number, sum and sum of squares of the
+            values (sufficient statistics, see aggregate_roi_stats())
+        'hist_<n_bins>' -> histogram_sketch with n_bins bins over
+            func_params['value_range'] (defaults to [0, 1]), e.g. 'hist_64'.
+            Returns n_bins values per ROI.
 
     func_params : dict
         Dictionary containing functions that need further parameter
         specifications. Keys are the function and values are dictionaries
         with the parameter specifications.
         E.g. 'winsorized_mean': func_params = {'limits': [0.1, 0.1]}
+    segmented : bool
+        If False (default), return a function that aggregates the values of
+        one ROI. If True, return a function that aggregates all ROIs at once
+        from the output of sort_roi_values() (sorted_values, offsets).
 
     Returns
     -------
@@ -714,29 +2025,225 @@ def _get_funcbyname(name, func_params):
     """
 
     # check validity of names
-    _valid_func_names = {'winsorized_mean', 'mean', 'std'}
+    _valid_func_names = {
+        'winsorized_mean', 'trimmed_mean', 'mean', 'std', 'median',
+        'quantile_<q>', 'count', 'sum', 'sumsq', 'hist_<n_bins>'}
 
     # apply functions
-    if name == 'winsorized_mean':
+    if name in ['winsorized_mean', 'trimmed_mean']:
         # check validity of func_params
         limits = func_params.get('limits')
         if all((lim >= 0.0 and lim <= 1) for lim in limits):
-            logger.info(f'Limits for winsorized mean are set to {limits}.')
+            logger.info(f'Limits for {name} are set to {limits}.')
         else:
             raise_error(
-                'Limits for the winsorized mean must be between 0 and 1.')
+                f'Limits for the {name} must be between 0 and 1.')
         # partially interpret func_params
-        return partial(winsorized_mean, **func_params)
+        if name == 'winsorized_mean':
+            if segmented:
+                return partial(_segmented_winsorized_mean, **func_params)
+            return partial(winsorized_mean, **func_params)
+        if segmented:
+            return partial(_segmented_trimmed_mean, **func_params)
+        return partial(trimmed_mean, **func_params)
     if name == 'mean':
+        if segmented:
+            return partial(_segmented_moments, moments_func=_moments_mean)
         return np.mean  # No func_params
     if name == 'std':
+        if segmented:
+            return partial(_segmented_moments, moments_func=_moments_std)
         return np.std
+    if name == 'median' or re.match(r'^quantile_', name):
+        q = 0.5
+        if name != 'median':
+            try:
+                q = float(name.split('_', 1)[1])
+            except ValueError:
+                raise_error(f'Quantile of {name} must be a number.')
+            if q < 0 or q > 1:
+                raise_error(f'Quantile of {name} must be between 0 and 1.')
+        if segmented:
+            return partial(_segmented_quantile, q=q)
+        return partial(np.quantile, q=q)
+    if name in ['count', 'sum', 'sumsq']:
+        if segmented:
+            return partial(
+                _segmented_moments, moments_func=_moment_aggregations[name])
+        return {'count': np.size, 'sum': np.sum, 'sumsq': _sum_of_squares}[
+            name]
+    if re.match(r'^hist_', name):
+        try:
+            n_bins = int(name.split('_', 1)[1])
+        except ValueError:
+            raise_error(f'Number of bins of {name} must be an integer.')
+        if n_bins < 1:
+            raise_error(f'Number of bins of {name} must be at least 1.')
+        value_range = (func_params or {}).get(
+            'value_range', _hist_value_range)
+        if segmented:
+            return partial(
+                _segmented_histogram, n_bins=n_bins, value_range=value_range)
+        return partial(
+            histogram_sketch, n_bins=n_bins, value_range=value_range)
 
     else:
         raise_error(f'Function {name} unknown. Please provide any of '
                     f'{_valid_func_names}')
 
 
+def _moments_mean(moments):
+    """
+    Helper function to compute the mean per ROI from ROI moments as returned
+    by get_roi_moments().
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = moments['sum'] / moments['count']
+    return mean
+
+
+def _moments_std(moments):
+    """
+    Helper function to compute the (population) standard deviation per ROI
+    from ROI moments as returned by get_roi_moments().
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = moments['sum'] / moments['count']
+        var = moments['sumsq'] / moments['count'] - mean ** 2
+    # rounding can make the variance of constant ROIs slightly negative
+    return np.sqrt(np.maximum(var, 0))
+
+
+"""
+Aggregation methods that are derived from ROI moments (count, sum, sum of
+squares) instead of the voxel values of each ROI.
+"""
+_moment_aggregations = {
+    'mean': _moments_mean,
+    'std': _moments_std,
+    'count': lambda moments: moments['count'],
+    'sum': lambda moments: moments['sum'],
+    'sumsq': lambda moments: moments['sumsq'],
+}
+
+
+def _sum_of_squares(data):
+    """Sum of squares of the data"""
+    return np.sum(np.square(data, dtype=np.float64))
+
+
+def _segment_limits(counts, limits):
+    """
+    Helper function to compute, per ROI segment, the first and last (not
+    included) position kept by winsorizing or trimming with limits. Follows
+    scipy.stats.mstats (inclusive limits).
+    """
+    low_limit, up_limit = limits
+    lowidx = np.floor(low_limit * counts).astype(np.int64) \
+        if low_limit else np.zeros_like(counts)
+    upidx = counts - np.floor(up_limit * counts).astype(np.int64) \
+        if up_limit else counts.copy()
+    return lowidx, upidx
+
+
+def _segmented_moments(sorted_values, offsets, moments_func):
+    """
+    Helper function to apply a moment-based aggregation (see
+    _moment_aggregations) to the output of sort_roi_values().
+    """
+    counts = np.diff(offsets)
+    voxel_rois = np.repeat(np.arange(len(counts)), counts)
+    values = np.asarray(sorted_values, dtype=np.float64)
+    moments = {
+        'count': counts,
+        'sum': np.bincount(voxel_rois, weights=values, minlength=len(counts)),
+        'sumsq': np.bincount(
+            voxel_rois, weights=np.square(values), minlength=len(counts)),
+    }
+    return moments_func(moments)
+
+
+def _segmented_histogram(sorted_values, offsets, n_bins,
+                         value_range=_hist_value_range):
+    """
+    Histogram sketch (see histogram_sketch()) of all ROI segments of the
+    output of sort_roi_values(). Returns an array of shape n_bins x n_rois.
+    """
+    counts = np.diff(offsets)
+    voxel_rois = np.repeat(np.arange(len(counts)), counts)
+    bins = _sketch_bins(sorted_values, n_bins, value_range)
+    hist = np.bincount(
+        bins * len(counts) + voxel_rois, minlength=n_bins * len(counts))
+    return hist.reshape(n_bins, len(counts))
+
+
+def _segmented_winsorized_mean(sorted_values, offsets, limits):
+    """
+    Winsorized mean of all ROI segments of the output of sort_roi_values().
+    Equivalent to winsorized_mean() applied to each ROI separately.
+    """
+    counts = np.diff(offsets)
+    n_rois = len(counts)
+    out = np.ones(shape=(n_rois)) * np.nan
+    valid = counts > 0
+    counts, starts = counts[valid], offsets[:-1][valid]
+    lowidx, upidx = _segment_limits(counts, limits)
+    # scipy replaces the lowest values with the value at lowidx first
+    lowidx = np.minimum(lowidx, counts - 1)
+    low_value = sorted_values[starts + lowidx]
+    # ... and then the highest values with the value at upidx - 1
+    up_value = np.where(
+        upidx - 1 >= lowidx,
+        sorted_values[starts + np.maximum(upidx - 1, 0)], low_value)
+    cumsum = np.concatenate(
+        [[0], np.cumsum(sorted_values, dtype=np.float64)])
+    kept = np.maximum(upidx, lowidx)
+    middle = cumsum[starts + kept] - cumsum[starts + lowidx]
+    total = lowidx * low_value + middle + (counts - kept) * up_value
+    out[valid] = total / counts
+    return out
+
+
+def _segmented_trimmed_mean(sorted_values, offsets, limits):
+    """
+    Trimmed mean of all ROI segments of the output of sort_roi_values().
+    Equivalent to trimmed_mean() applied to each ROI separately.
+    """
+    counts = np.diff(offsets)
+    starts = offsets[:-1]
+    lowidx, upidx = _segment_limits(counts, limits)
+    cumsum = np.concatenate(
+        [[0], np.cumsum(sorted_values, dtype=np.float64)])
+    n_kept = upidx - lowidx
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = (cumsum[starts + np.maximum(upidx, lowidx)]
+               - cumsum[starts + lowidx]) / n_kept
+    out[n_kept <= 0] = np.nan
+    return out
+
+
+def _segmented_quantile(sorted_values, offsets, q):
+    """
+    Quantile q (linear interpolation as in np.quantile) of all ROI segments
+    of the output of sort_roi_values().
+    """
+    counts = np.diff(offsets)
+    n_rois = len(counts)
+    out = np.ones(shape=(n_rois)) * np.nan
+    valid = counts > 0
+    counts, starts = counts[valid], offsets[:-1][valid]
+    position = q * (counts - 1)
+    below = np.floor(position).astype(np.int64)
+    above = np.minimum(below + 1, counts - 1)
+    gamma = position - below
+    a = sorted_values[starts + below].astype(np.float64)
+    b = sorted_values[starts + above].astype(np.float64)
+    # same interpolation as numpy's _lerp
+    out[valid] = np.where(
+        gamma >= 0.5, b - (b - a) * (1 - gamma), a + (b - a) * gamma)
+    return out
+
+
 def winsorized_mean(data, axis=None, **win_params):
     """
     Helper function to chain winsorization and mean to compute winsorized
@@ -760,3 +2267,25 @@ def winsorized_mean(data, axis=None, **win_params):
     win_mean = win_dat.mean(axis=axis)
 
     return win_mean
+
+
+def trimmed_mean(data, axis=None, **trim_params):
+    """
+    Helper function to compute the trimmed mean (mean without the lowest and
+    highest values).
+
+    Parameters
+    ----------
+    data : array
+        Data to calculate trimmed mean on.
+    trim_params : dict
+        Dictionary containing the keyword arguments for the
+        scipy.stats.mstats.trimmed_mean function. E.g. {'limits': [0.1, 0.1]}
+
+    Returns
+    -------
+    Trimmed mean of the inputted data with the trimming settings applied as
+    specified in trim_params.
+    """
+
+    return mstats.trimmed_mean(data, axis=axis, **trim_params)
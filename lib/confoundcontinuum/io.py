@@ -1,77 +1,355 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+import itertools
+import json
+import os
+from pathlib import Path
+import socket
+import threading
+import uuid
+
 import pandas as pd
-# from pandas.core.base import NoNewAttributesMixin
-# from pandas.io.sql import pandasSQL_builder
 import numpy as np
-from sqlalchemy import create_engine, inspect
+from sqlalchemy import (
+    Column, MetaData, String, Table, bindparam, create_engine, event, inspect,
+    select, text, tuple_)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
 
 from . logging import logger
 
+# pragmas applied to every new SQLite connection: wait for locks of other
+# jobs instead of failing, 64 MB page cache, temporary tables in memory
+_sqlite_pragmas = {
+    'busy_timeout': 60000,
+    'cache_size': -64000,
+    'temp_store': 'MEMORY',
+}
+
+# pragmas for scratch databases that can be recreated if the machine
+# crashes: write-ahead log and no syncing to disk
+_scratch_pragmas = {
+    'journal_mode': 'WAL',
+    'synchronous': 'OFF',
+}
+
+# engines by URI and pragmas, least recently used first. Each engine keeps
+# its connections open, so the number of engines is bounded (e.g. when
+# merging thousands of single subject databases)
+_max_engines = 32
+_engines = OrderedDict()
+_engines_lock = threading.Lock()
+_engines_pid = os.getpid()
+
+
+def _get_sqlite_fname(url):
+    """Path of the database file of a SQLite URL (None if in memory)"""
+    if url.get_backend_name() != 'sqlite' or \
+            url.database in [None, '', ':memory:']:
+        return None
+    return Path(url.database)
+
+
+def _get_file_id(fname):
+    """Identity of a database file, to notice files replaced on disk"""
+    if fname is None or not fname.exists():
+        return None
+    stat = fname.stat()
+    return stat.st_dev, stat.st_ino
+
+
+def _set_sqlite_pragmas(dbapi_con, pragmas):
+    cursor = dbapi_con.cursor()
+    for t_pragma, t_value in pragmas.items():
+        cursor.execute(f'PRAGMA {t_pragma} = {t_value}')
+    cursor.close()
+
+
+def get_engine(uri, pragmas=None):
+    """Get a pooled SQLAlchemy engine for a database
+
+    Engines are cached per process by URI (and pragmas), so that repeated
+    reads and writes reuse the engine and its open connections. The least
+    recently used engine is disposed if more than `_max_engines` are cached.
+    New SQLite connections get the pragmas in `_sqlite_pragmas`. If a SQLite
+    database file was removed or replaced since the engine was created, a
+    new engine is created.
+
+    Parameters
+    ----------
+    uri : str
+        The connection URI.
+        Easy options:
+            'sqlite://' for an in memory sqlite database
+            'sqlite:///<path_to_file>' to save in a file
+
+        Check https://docs.sqlalchemy.org/en/14/core/engines.html for more
+        options
+    pragmas : dict
+        Pragmas to apply to new SQLite connections in addition to (or
+        instead of) `_sqlite_pragmas` (defaults to None).
 
-def _get_existing_pk(con, table_name, index_col):
-    pk_cols = ','.join(index_col)
-    query = f'SELECT {pk_cols} FROM {table_name};'
-    pk_indb = pd.read_sql(query, con=con)
-    return pk_indb
+    Returns
+    -------
+    engine : sqlalchemy.engine.Engine
+        The engine
+    """
+    global _engines_pid
+    pragmas = {**_sqlite_pragmas, **(pragmas or {})}
+    key = (str(uri), tuple(sorted(pragmas.items())))
+    url = make_url(uri)
+    fname = _get_sqlite_fname(url)
+    with _engines_lock:
+        if os.getpid() != _engines_pid:
+            # connections inherited from the parent process must not be used
+            for engine, _ in _engines.values():
+                engine.dispose(close=False)
+            _engines.clear()
+            _engines_pid = os.getpid()
+        if key in _engines:
+            engine, file_id = _engines[key]
+            if file_id is None or file_id == _get_file_id(fname):
+                _engines.move_to_end(key)
+                return engine
+            logger.debug(f'DB file of {uri} changed, create a new engine')
+            engine.dispose()
+            del _engines[key]
+
+        logger.debug(f'Creating engine for DB {uri}')
+        if fname is not None:
+            # pool the connections of file databases (SQLAlchemy < 2 opens
+            # a new connection for each use)
+            engine = create_engine(
+                url, echo=False, poolclass=QueuePool,
+                connect_args={'check_same_thread': False})
+        else:
+            engine = create_engine(url, echo=False)
+        if url.get_backend_name() == 'sqlite':
+            event.listen(
+                engine, 'connect',
+                lambda dbapi_con, _: _set_sqlite_pragmas(dbapi_con, pragmas))
+            if fname is not None and not fname.exists():
+                # create the file now to know its identity
+                with engine.connect():
+                    pass
+        _engines[key] = (engine, _get_file_id(fname))
+        while len(_engines) > _max_engines:
+            _, (old_engine, _) = _engines.popitem(last=False)
+            old_engine.dispose()
+    return engine
 
 
-def _split_incoming_data(df, pk_indb, index_col):
-    incoming_pk = df.reset_index()[index_col]
-    exists_mask = (
-        incoming_pk[index_col]
-        .apply(tuple, axis=1)
-        .isin(pk_indb[index_col].apply(tuple, axis=1))
-    )
-    existing, new = df.loc[exists_mask.values], df.loc[~exists_mask.values]
-    return existing, new
+def dispose_engines():
+    """Dispose all cached engines and close their connections"""
+    with _engines_lock:
+        for engine, _ in _engines.values():
+            engine.dispose()
+        _engines.clear()
 
 
-def _generate_update_statements(table, index_col, rows_to_update):
-    from sqlalchemy import and_
+def _get_index_names(df):
+    """Names of the index columns as written by pandas (e.g. 'index')"""
+    return list(pd.DataFrame(index=df.index[:0]).reset_index().columns)
 
-    new_records = rows_to_update.to_dict(orient="records")
-    pk_indb = rows_to_update.reset_index()[index_col]
-    pk_cols = [table.c[key] for key in index_col]
 
-    stmts = []
-    for i, (_, keys) in enumerate(pk_indb.iterrows()):
-        stmt = (
-            table.update()
-            .where(and_(col == keys[j]
-                        for j, col in enumerate(pk_cols)))  # type: ignore
-            .values(new_records[i])
-        )
-        stmts.append(stmt)
-    return stmts
+def _to_python_values(values):
+    """Python values of a column that the DBAPI drivers can bind"""
+    if isinstance(values.dtype, np.dtype) and values.dtype.kind in 'biufO':
+        return np.asarray(values).tolist()
+    if values.dtype.kind == 'M':
+        values = pd.Series(pd.to_datetime(values).to_pydatetime(),
+                           dtype=object)
+    # nullable and extension dtypes: missing values as None
+    values = pd.Series(values, dtype=object)
+    return values.where(values.notna(), None).tolist()
 
 
-def _save_upsert(df, name, engine, upsert='ignore', if_exist='append'):
+def _insert_rows(con, name, df):
+    """Insert the rows of df (with its index) with one executemany"""
+    if len(df) == 0:
+        return
+    paramstyle = con.dialect.paramstyle
+    if paramstyle not in ['qmark', 'format', 'pyformat']:
+        raise ValueError(f'Driver paramstyle {paramstyle} not supported')
+    preparer = con.dialect.identifier_preparer
+    columns = ', '.join(
+        preparer.quote(str(x)) for x in [*_get_index_names(df), *df.columns])
+    placeholder = '?' if paramstyle == 'qmark' else '%s'
+    placeholders = ', '.join([placeholder] * (df.index.nlevels + df.shape[1]))
+    stmt = (f'INSERT INTO {preparer.quote(name)} ({columns}) '
+            f'VALUES ({placeholders})')
+    # python values (DBAPI drivers do not take numpy scalars), converted per
+    # dtype block, much faster than pandas per row or per column
+    values = [None] * df.shape[1]
+    for dtype in df.dtypes.unique():
+        positions = np.flatnonzero(df.dtypes == dtype)
+        if isinstance(dtype, np.dtype) and dtype.kind in 'biufO':
+            block_values = df.iloc[:, positions].to_numpy().T.tolist()
+        else:
+            block_values = [_to_python_values(df.iloc[:, x])
+                            for x in positions]
+        for t_pos, t_values in zip(positions, block_values):
+            values[t_pos] = t_values
+    levels = [_to_python_values(df.index.get_level_values(x))
+              for x in range(df.index.nlevels)]
+    rows = list(zip(*levels, *values))
+    con.exec_driver_sql(stmt, rows)
+
+
+def _create_table(con, name, df):
+    """Create a table for df with the index columns as primary key"""
+    schema = pd.io.sql.get_schema(
+        df.iloc[:0].reset_index(), name, keys=_get_index_names(df), con=con)
+    con.exec_driver_sql(schema)
+
+
+def _ensure_unique_index(con, name, index_col, keep=None):
+    """
+    Make sure the index columns of a table are unique, as needed as conflict
+    target of the upsert. Tables written before (by pandas, without primary
+    key) get a unique index. If the table has duplicated rows, they are only
+    deleted if keep is 'first' or 'last' (the first or most recently inserted
+    row is kept, SQLite); otherwise a ValueError is raised.
+    """
+    preparer = con.dialect.identifier_preparer
+    quoted_name = preparer.quote(name)
+    if con.dialect.name == 'sqlite':
+        # primary keys are unique indexes in SQLite; reflecting the primary
+        # key would read all (e.g. 1000) columns of the table
+        unique_keys = [
+            [x[2] for x in con.exec_driver_sql(
+                f'PRAGMA index_info({preparer.quote(t_index[1])})')]
+            for t_index in con.exec_driver_sql(
+                f'PRAGMA index_list({quoted_name})') if t_index[2]]
+    else:
+        inspector = inspect(con)
+        unique_keys = [
+            inspector.get_pk_constraint(name)['constrained_columns'],
+            *[x['column_names'] for x in inspector.get_indexes(name)
+              if x['unique']]]
+    if any(sorted(x) == sorted(index_col) for x in unique_keys):
+        return
+    columns = ', '.join(preparer.quote(x) for x in index_col)
+    stmt = (f'CREATE UNIQUE INDEX {preparer.quote(f"ux_{name}")} ON '
+            f'{quoted_name} ({columns})')
+    try:
+        with con.begin_nested():
+            con.exec_driver_sql(stmt)
+    except IntegrityError:
+        if keep is None:
+            raise ValueError(
+                f'Table {name} contains duplicated rows of {index_col}. Save '
+                'with deduplicate=True to delete them.')
+        if con.dialect.name != 'sqlite':
+            raise
+        logger.warning(
+            f'Table {name} contains duplicated rows of {index_col}, only the '
+            f'{"first" if keep == "first" else "most recently"} inserted '
+            'ones are kept.')
+        con.exec_driver_sql(
+            f'DELETE FROM {quoted_name} WHERE rowid NOT IN (SELECT '
+            f'{"MIN" if keep == "first" else "MAX"}(rowid) FROM '
+            f'{quoted_name} GROUP BY {columns})')
+        con.exec_driver_sql(stmt)
+
+
+def _upsert_rows(con, name, df, upsert):
+    """
+    Insert the rows of df through a temporary staging table with a single
+    INSERT ... ON CONFLICT: rows with existing index values are updated
+    (upsert='delete') or left unchanged (upsert='ignore').
+    """
+    preparer = con.dialect.identifier_preparer
+    quoted_name = preparer.quote(name)
+    staging_name = f'staging_{uuid.uuid4().hex}'
+    quoted_staging = preparer.quote(staging_name)
+    index_col = _get_index_names(df)
+    columns = [preparer.quote(str(x)) for x in [*index_col, *df.columns]]
+    values_columns = columns[len(index_col):]
+    con.exec_driver_sql(
+        f'CREATE TEMPORARY TABLE {quoted_staging} AS SELECT '
+        f'{", ".join(columns)} FROM {quoted_name} WHERE 1 = 0')
+    try:
+        _insert_rows(con, staging_name, df)
+        if upsert == 'delete' and len(values_columns) > 0:
+            on_conflict = 'DO UPDATE SET ' + ', '.join(
+                f'{x} = excluded.{x}' for x in values_columns)
+        else:
+            on_conflict = 'DO NOTHING'
+        # WHERE true: ON CONFLICT is otherwise parsed as a join (SQLite)
+        con.exec_driver_sql(
+            f'INSERT INTO {quoted_name} ({", ".join(columns)}) SELECT '
+            f'{", ".join(columns)} FROM {quoted_staging} WHERE true '
+            f'ON CONFLICT ({", ".join(columns[:len(index_col)])}) '
+            f'{on_conflict}')
+    finally:
+        con.exec_driver_sql(f'DROP TABLE {quoted_staging}')
+
+
+def _save_upsert(df, name, engine, upsert='ignore', if_exist='append',
+                 manifest=None, chunksize=None, features=None,
+                 deduplicate=False):
+    """
+    Save df (with its index as key) to the table name. The table is created
+    with the index columns as primary key. Rows with index values that are
+    already in the table are updated (upsert='delete') or ignored
+    (upsert='ignore'), so saving the same rows again does not duplicate them.
+    Duplicated rows of an existing table without key are only deleted with
+    deduplicate=True, keeping the most recent (upsert='delete') or the first
+    (upsert='ignore') row. If the table is replaced, the manifest rows of its
+    features (kind, atlas_name, agg_function) are deleted in the same
+    transaction.
+    """
     if upsert not in ['delete', 'ignore']:
         raise ValueError('upsert must be either "delete" or "ignore"')
+    if if_exist not in ['append', 'replace']:
+        raise ValueError('if_exist must be either "append" or "replace"')
+    if chunksize is not None and chunksize < 1:
+        raise ValueError('chunksize must be at least 1')
 
-    # index_col = df.index.names
-    with engine.begin() as con:
-        if if_exist == 'replace':
-            df.to_sql(name, con=con, if_exists='replace')
-        else:
-            df.to_sql(name, con=con, if_exists='append')
-        # elif not inspect(engine).has_table(name):
-        #     print('table does not exists')
-        #     df.to_sql(name, con=con, if_exists='append')
-        # else:
-        #     pk_indb = _get_existing_pk(
-        #         con, table_name=name, index_col=index_col)
-        #     existing, new = _split_incoming_data(df, pk_indb, index_col)
-        #     pandas_sql = pandasSQL_builder(con)
-        #     pandas_sql.meta.reflect(only=[name])
-        #     table = pandas_sql.get_table(name)
-        #     update_stmts = NoNewAttributesMixin
-        #     if upsert == 'delete':
-        #         update_stmts = _generate_update_statements(
-        #             table, index_col, existing)
-        #         for stmt in update_stmts:
-        #             con.execute(stmt)
-
-        #     new.to_sql(name, con=con, if_exists='append')
+    if chunksize is None:
+        chunksize = max(len(df), 1)
+    for start in range(0, max(len(df), 1), chunksize):
+        batch = df.iloc[start:start + chunksize]
+        # one transaction per batch
+        with engine.begin() as con:
+            new_table = False
+            if start == 0:
+                if if_exist == 'replace':
+                    con.exec_driver_sql(
+                        'DROP TABLE IF EXISTS '
+                        f'{con.dialect.identifier_preparer.quote(name)}')
+                    if features is not None:
+                        # the replaced work is not completed anymore
+                        _delete_manifest(con, *features)
+                # (has_table would read all columns of the table in SQLite)
+                if if_exist == 'replace' or \
+                        name not in inspect(con).get_table_names():
+                    _create_table(con, name, df)
+                    new_table = True
+                else:
+                    # duplicates kept as the upsert would keep them
+                    keep = None
+                    if deduplicate:
+                        keep = 'last' if upsert == 'delete' else 'first'
+                    _ensure_unique_index(
+                        con, name, _get_index_names(df), keep=keep)
+            if new_table and not batch.index.has_duplicates:
+                # nothing to conflict with
+                _insert_rows(con, name, batch)
+            else:
+                _upsert_rows(con, name, batch, upsert)
+            # completed work, in the same transaction as the features
+            if manifest is not None:
+                subjects = set(batch.index.to_frame(index=False)[
+                    ['SubjectID', 'Session']].itertuples(
+                        index=False, name=None))
+                _insert_manifest(con, [
+                    x for x in manifest
+                    if (x['SubjectID'], x['Session']) in subjects])
 
 
 def _validate_names(kind, atlas_name, agg_function):
@@ -120,9 +398,11 @@ def list_features(uri):
         The DataFrame with the features list
     """
     logger.debug(f'Listing features from DB {uri}')
-    engine = create_engine(uri, echo=False)
+    engine = get_engine(uri)
     features = {'kind': [], 'atlas_name': [], 'agg_function': []}
     for t_name in inspect(engine).get_table_names():
+        if t_name == _manifest_table_name:
+            continue
         t_k, t_a, t_f = _from_table_name(t_name)
         features['kind'].append(t_k)
         features['atlas_name'].append(t_a)
@@ -130,7 +410,60 @@ def list_features(uri):
     return pd.DataFrame(features)
 
 
-def read_features(uri, kind, atlas_name, index_col, agg_function=None):
+# ID lists longer than this are matched against a temporary table instead
+# of bound as parameters of IN (...) (SQLite allows 999 or 32766 parameters)
+_max_in_values = 500
+
+
+@contextmanager
+def _features_query(con, table_name, index_col, columns=None, subjects=None,
+                    sessions=None):
+    """
+    SELECT statement and parameters of a feature table, with the columns
+    and the rows of subjects and sessions selected in the database.
+    Temporary tables of long ID lists are dropped on exit.
+    """
+    preparer = con.dialect.identifier_preparer
+    if columns is None:
+        select_columns = '*'
+    else:
+        select_columns = ', '.join(
+            preparer.quote(str(x))
+            for x in [*index_col, *[x for x in columns if x not in index_col]])
+    conditions = []
+    params = {}
+    ids_names = []
+    try:
+        for level, values in [('SubjectID', subjects), ('Session', sessions)]:
+            if values is None:
+                continue
+            values = list(dict.fromkeys(values))
+            if len(values) > _max_in_values:
+                ids_names.append(f'ids_{uuid.uuid4().hex}')
+                con.exec_driver_sql(
+                    f'CREATE TEMPORARY TABLE {preparer.quote(ids_names[-1])} '
+                    '(id)')
+                _insert_rows(con, ids_names[-1], pd.DataFrame(
+                    index=pd.Index(values, dtype=object, name='id')))
+                conditions.append(
+                    f'{preparer.quote(level)} IN (SELECT id FROM '
+                    f'{preparer.quote(ids_names[-1])})')
+            else:
+                conditions.append(f'{preparer.quote(level)} IN :{level}')
+                params[level] = values
+        query = f'SELECT {select_columns} FROM {preparer.quote(table_name)}'
+        if len(conditions) > 0:
+            query = f'{query} WHERE {" AND ".join(conditions)}'
+        query = text(query).bindparams(
+            *[bindparam(x, expanding=True) for x in params])
+        yield query, params
+    finally:
+        for t_name in ids_names:
+            con.exec_driver_sql(f'DROP TABLE {preparer.quote(t_name)}')
+
+
+def read_features(uri, kind, atlas_name, index_col, agg_function=None,
+                  columns=None, subjects=None, sessions=None):
     """Read features from a SQL Database
 
     Parameters
@@ -151,6 +484,15 @@ def read_features(uri, kind, atlas_name, index_col, agg_function=None):
         The columns to be used as index
     agg_function : str
         The aggregation function used (defaults to None)
+    columns : list(str)
+        The columns to read besides index_col (defaults to None, i.e. all
+        columns)
+    subjects : list
+        If not None, read only the rows of these subjects (column
+        'SubjectID'). Defaults to None.
+    sessions : list
+        If not None, read only the rows of these sessions (column 'Session',
+        e.g. ['ses-2']). Defaults to None.
 
     Returns
     -------
@@ -159,19 +501,133 @@ def read_features(uri, kind, atlas_name, index_col, agg_function=None):
     """
     table_name = _to_table_name(kind, atlas_name, agg_function)
     logger.debug(f'Reading data from DB {uri} - table {table_name}')
-    engine = create_engine(uri, echo=False)
-    df = pd.read_sql(table_name, con=engine, index_col=index_col)
+    engine = get_engine(uri)
+    if table_name not in inspect(engine).get_table_names():
+        raise ValueError(f'Table {table_name} not found in DB {uri}')
+    # a query does not reflect the (wide) table as pd.read_sql(table_name)
+    with engine.connect() as con:
+        with _features_query(con, table_name, index_col, columns, subjects,
+                             sessions) as (query, params):
+            df = pd.read_sql_query(
+                query, con=con, index_col=index_col, params=params)
     return df
 
 
+def _get_column_dtypes(con, table_name, index_col, columns=None):
+    """
+    Dtypes of the numeric (non-index) columns of a table from their declared
+    types: float64 for real and Int64 (nullable) for integer columns, so that
+    they do not depend on the values (e.g. NULLs) of a chunk.
+    """
+    if con.dialect.name == 'sqlite':
+        # type affinity of the declared type (as SQLite determines it);
+        # reflecting the columns would be slow for wide tables
+        declared = {
+            x[1]: x[2].upper() for x in con.exec_driver_sql(
+                'PRAGMA table_info('
+                f'{con.dialect.identifier_preparer.quote(table_name)})')}
+        python_types = {}
+        for t_name, t_type in declared.items():
+            if 'INT' in t_type:
+                python_types[t_name] = int
+            elif any(x in t_type for x in ['REAL', 'FLOA', 'DOUB']):
+                python_types[t_name] = float
+    else:
+        python_types = {}
+        for t_column in inspect(con).get_columns(table_name):
+            try:
+                python_types[t_column['name']] = t_column['type'].python_type
+            except NotImplementedError:
+                pass
+    if columns is not None:
+        python_types = {
+            k: v for k, v in python_types.items() if k in columns}
+    dtypes = {}
+    for t_name, t_type in python_types.items():
+        if t_name in index_col:
+            continue
+        if t_type is int:
+            dtypes[t_name] = 'Int64'
+        elif t_type is float:
+            dtypes[t_name] = 'float64'
+    return dtypes
+
+
+def iter_features(uri, kind, atlas_name, index_col, agg_function=None,
+                  chunksize=10000, columns=None, subjects=None,
+                  sessions=None):
+    """Iterate over the features of a SQL Database in chunks of rows
+
+    Parameters
+    ----------
+    uri : str
+        The connection URI (see read_features).
+    kind : str
+        kind of features
+    altas_name : str
+        the name of the atlas
+    index_col : list(str)
+        The columns to be used as index
+    agg_function : str
+        The aggregation function used (defaults to None)
+    chunksize : int
+        Number of rows per chunk (defaults to 10000)
+    columns : list(str)
+        The columns to read besides index_col (defaults to None, i.e. all
+        columns)
+    subjects : list
+        If not None, read only the rows of these subjects (column
+        'SubjectID'). Defaults to None.
+    sessions : list
+        If not None, read only the rows of these sessions (column 'Session',
+        e.g. ['ses-2']). Defaults to None.
+
+    Yields
+    ------
+    df : pandas.DataFrame
+        The features of (at most) chunksize rows, in the order of the table.
+        All chunks have the same index levels and columns, and the dtypes of
+        the declared column types (float64 for real and the nullable Int64
+        for integer columns). If no rows are selected, a single empty
+        DataFrame is yielded.
+    """
+    if chunksize is None or chunksize < 1:
+        raise ValueError('chunksize must be at least 1')
+    table_name = _to_table_name(kind, atlas_name, agg_function)
+    logger.debug(
+        f'Reading data from DB {uri} - table {table_name} in chunks of '
+        f'{chunksize} rows')
+    engine = get_engine(uri)
+    if table_name not in inspect(engine).get_table_names():
+        raise ValueError(f'Table {table_name} not found in DB {uri}')
+    with engine.connect() as con:
+        dtypes = _get_column_dtypes(con, table_name, index_col, columns)
+        with _features_query(con, table_name, index_col, columns, subjects,
+                             sessions) as (query, params):
+            chunks = pd.read_sql_query(
+                query, con=con, index_col=index_col, params=params,
+                chunksize=chunksize, dtype=dtypes)
+            try:
+                for df in chunks:
+                    if len(df) == 0:
+                        # pandas does not apply the dtypes to empty results
+                        df = df.astype(dtypes)
+                    yield df
+            finally:
+                # release the cursor before the temporary tables are dropped
+                chunks.close()
+
+
 def save_features(df, uri, kind, atlas_name, agg_function=None,
-                  if_exist='append'):
+                  if_exist='append', manifest=None, chunksize=None,
+                  scratch=False, deduplicate=False):
     """Save features to a SQL Database
 
     Parameters
     ----------
     df : pandas.DataFrame
-        The Pandas DataFrame to save. Must have the index set.
+        The Pandas DataFrame to save. Must have the index set. The index is
+        the primary key of the table.
     uri : str
         The connection URI.
         Easy options:
@@ -188,13 +644,476 @@ def save_features(df, uri, kind, atlas_name, agg_function=None,
         The aggregation function used (defaults to None)
     if_exist : str
         How to behave if the table already exists. Options are:
-        'replace': Drop the table before inserting new values.
-        'append': Insert new values to the existing table (default).
+        'replace': Drop the table (and its rows of the manifest) before
+        inserting new values.
+        'append': Insert new values to the existing table (default). Rows
+        with an index already in the table replace the existing rows, so
+        saving the same subjects again does not duplicate them.
+    manifest : dict
+        If not None, the saved subjects and sessions (index levels
+        'SubjectID' and 'Session') are marked as completed in the completion
+        manifest of the database (see `get_missing_features`), in the same
+        transaction as the features. The dict holds the further parameters of
+        the computation ({} if there are none). Defaults to None.
+    chunksize : int
+        If not None, the rows are written in batches of chunksize rows, each
+        in its own transaction (and with its rows of the manifest), to bound
+        the size of transactions of large tables. Defaults to None (one
+        transaction).
+    scratch : bool
+        If True, write with a write-ahead log and without syncing to disk
+        (SQLite pragmas journal_mode=WAL, synchronous=OFF). Much faster for
+        many small writes, but the database can be corrupted if the machine
+        crashes: only use for scratch databases that can be recreated.
+        Defaults to False.
+    deduplicate : bool
+        If True, the duplicated rows of an existing table written without
+        primary key (e.g. by earlier versions) are deleted before appending,
+        keeping the most recently inserted ones. If False (default), appending
+        to such a table raises a ValueError.
     """
     table_name = _to_table_name(kind, atlas_name, agg_function)
     logger.debug(f'Saving data from DB {uri} - table {table_name}')
-    engine = create_engine(uri, echo=False)
-    _save_upsert(df, table_name, engine, upsert='delete')
+    engine = get_engine(uri, pragmas=_scratch_pragmas if scratch else None)
+    if manifest is not None:
+        manifest = _get_manifest_rows(
+            df.index, kind, atlas_name, agg_function, manifest)
+    _save_upsert(df, table_name, engine, upsert='delete', if_exist=if_exist,
+                 manifest=manifest, chunksize=chunksize,
+                 features=(kind, atlas_name, agg_function),
+                 deduplicate=deduplicate)
+
+
+_manifest_table_name = 'manifest'
+_manifest_key = [
+    'SubjectID', 'Session', 'kind', 'atlas_name', 'agg_function', 'params']
+
+
+def _get_manifest_table(metadata):
+    return Table(
+        _manifest_table_name, metadata,
+        *[Column(x, String, primary_key=True) for x in _manifest_key],
+        Column('completed', String))
+
+
+def _to_manifest_params(params):
+    return json.dumps({} if params is None else params, sort_keys=True)
+
+
+def _get_manifest_rows(index, kind, atlas_name, agg_function, params):
+    subjects = index.to_frame(index=False)[
+        ['SubjectID', 'Session']].drop_duplicates()
+    completed = datetime.now().isoformat()
+    return [
+        {'SubjectID': t_sub, 'Session': t_ses, 'kind': kind,
+         'atlas_name': atlas_name, 'agg_function': agg_function or '',
+         'params': _to_manifest_params(params), 'completed': completed}
+        for t_sub, t_ses in subjects.itertuples(index=False)]
+
+
+# INSERT ... ON CONFLICT constructs per dialect
+_dialect_inserts = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+
+def _insert_manifest(con, rows):
+    manifest_table = _get_manifest_table(MetaData())
+    manifest_table.create(con, checkfirst=True)
+    if len(rows) == 0:
+        return
+    # keep the first completion of work that was saved again
+    if con.dialect.name in _dialect_inserts:
+        con.execute(
+            _dialect_inserts[con.dialect.name](
+                manifest_table).on_conflict_do_nothing(), rows)
+        return
+    key = [manifest_table.c[x] for x in _manifest_key]
+    completed = set(con.execute(select(*key).where(tuple_(*key).in_(
+        [tuple(x[k] for k in _manifest_key) for x in rows]))))
+    rows = [x for x in rows
+            if tuple(x[k] for k in _manifest_key) not in completed]
+    if len(rows) > 0:
+        con.execute(manifest_table.insert(), rows)
+
+
+def _delete_manifest(con, kind, atlas_name, agg_function):
+    if _manifest_table_name not in inspect(con).get_table_names():
+        return
+    manifest_table = _get_manifest_table(MetaData())
+    con.execute(manifest_table.delete().where(
+        (manifest_table.c.kind == kind) &
+        (manifest_table.c.atlas_name == atlas_name) &
+        (manifest_table.c.agg_function == (agg_function or ''))))
+
+
+def read_manifest(uri):
+    """Read the completion manifest of a SQL Database
+
+    Parameters
+    ----------
+    uri : str
+        The connection URI.
+        Easy options:
+            'sqlite://' for an in memory sqlite database
+            'sqlite:///<path_to_file>' to save in a file
+
+        Check https://docs.sqlalchemy.org/en/14/core/engines.html for more
+        options
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        The DataFrame with the completed work, one row per subject, session,
+        kind, atlas_name, agg_function and params (as JSON)
+    """
+    engine = get_engine(uri)
+    if not inspect(engine).has_table(_manifest_table_name):
+        return pd.DataFrame(columns=[*_manifest_key, 'completed'])
+    with engine.connect() as con:
+        manifest_table = _get_manifest_table(MetaData())
+        return pd.read_sql(select(manifest_table), con=con)
+
+
+def get_missing_features(uri, index, kind, atlas_names, agg_functions,
+                         params=None):
+    """Get the work that is not yet completed in a SQL Database
+
+    Parameters
+    ----------
+    uri : str
+        The connection URI.
+        Easy options:
+            'sqlite://' for an in memory sqlite database
+            'sqlite:///<path_to_file>' to save in a file
+
+        Check https://docs.sqlalchemy.org/en/14/core/engines.html for more
+        options
+    index : pandas.MultiIndex
+        The subjects and sessions (levels 'SubjectID' and 'Session') to
+        compute.
+    kind : str
+        kind of features
+    atlas_names : list(str)
+        the names of the atlases
+    agg_functions : list(str)
+        The aggregation functions
+    params : dict
+        The further parameters of the computation, as passed on to
+        `save_features` (defaults to None, i.e. {}).
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        The DataFrame with the missing work, one row per SubjectID, Session,
+        atlas_name and agg_function
+    """
+    manifest = read_manifest(uri)
+    missing = _get_missing_features(
+        manifest, index, kind, atlas_names, agg_functions, params)
+    logger.debug(f'{len(missing)} features missing in DB {uri}')
+    return missing
+
+
+def _get_missing_features(manifest, index, kind, atlas_names, agg_functions,
+                          params):
+    """Get the work of index, atlas_names and agg_functions not in manifest"""
+    manifest = manifest[
+        (manifest['kind'] == kind) &
+        (manifest['params'] == _to_manifest_params(params))]
+    completed = set(manifest[
+        ['SubjectID', 'Session', 'atlas_name', 'agg_function']].itertuples(
+            index=False, name=None))
+    subjects = index.to_frame(index=False)[
+        ['SubjectID', 'Session']].drop_duplicates()
+    missing = [
+        (t_sub, t_ses, t_atlas, t_agg) for (t_sub, t_ses), t_atlas, t_agg
+        in itertools.product(
+            subjects.itertuples(index=False, name=None), atlas_names,
+            agg_functions)
+        if (t_sub, t_ses, t_atlas, t_agg or '') not in completed]
+    return pd.DataFrame(
+        missing,
+        columns=['SubjectID', 'Session', 'atlas_name', 'agg_function'])
+
+
+class FeatureShardWriter():
+    """Append features to sharded Parquet files
+
+    Each writer (e.g. one per extraction job or worker) writes one shard per
+    feature table to <shard_dir>/<table name>/<shard_name>.parquet. Every
+    call of `write` appends the DataFrame as one row group, e.g. the features
+    of one subject. A shard is only visible under its final name once the
+    writer is closed, so that `compact_feature_shards` never reads a shard
+    that is still written. The work marked as completed (see `write`) is
+    saved as manifest shard <shard_dir>/manifest/<shard_name>.parquet once
+    the shards of the writer are visible.
+
+    Parameters
+    ----------
+    shard_dir : str or Path
+        The directory of the shards.
+    shard_name : str
+        The name of the shards of this writer. Defaults to None (unique name
+        from host name, process ID and a random suffix).
+    """
+
+    def __init__(self, shard_dir, shard_name=None):
+        if shard_name is None:
+            shard_name = (
+                f'{socket.gethostname()}_{os.getpid()}_{uuid.uuid4().hex[:8]}')
+        self.shard_dir = Path(shard_dir)
+        self.shard_name = shard_name
+        self._writers = {}  # table name: (ParquetWriter, shard file name)
+        self._manifest = []  # rows of the manifest shard
+
+    def write(self, df, kind, atlas_name, agg_function=None, manifest=None):
+        """Append features to the shard of their table
+
+        Parameters
+        ----------
+        df : pandas.DataFrame
+            The Pandas DataFrame to save. Must have the index set.
+        kind : str
+            kind of features
+        altas_name : str
+            the name of the atlas
+        agg_function : str
+            The aggregation function used (defaults to None)
+        manifest : dict
+            If not None, the written subjects and sessions (index levels
+            'SubjectID' and 'Session') are marked as completed in the
+            manifest of the shards (see `get_missing_feature_shards`). The
+            dict holds the further parameters of the computation ({} if there
+            are none). Defaults to None.
+        """
+        # imported here, so that worker processes forked by the extraction
+        # do not inherit the threads of pyarrow
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table_name = _to_table_name(kind, atlas_name, agg_function)
+        table = pa.Table.from_pandas(df, preserve_index=True)
+        if table_name not in self._writers:
+            fname = self.shard_dir / table_name / f'{self.shard_name}.parquet'
+            if fname.exists():
+                raise ValueError(f'The shard {fname} already exists.')
+            fname.parent.mkdir(exist_ok=True, parents=True)
+            logger.debug(f'Writing shard {fname}')
+            self._writers[table_name] = (
+                pq.ParquetWriter(_get_tmp_shard_fname(fname), table.schema),
+                fname)
+        writer, _ = self._writers[table_name]
+        if not table.schema.equals(writer.schema):
+            raise ValueError(
+                f'The columns of the features do not match the ones of '
+                f'table {table_name} in this shard.')
+        writer.write_table(table)
+        if manifest is not None:
+            self._manifest.extend(_get_manifest_rows(
+                df.index, kind, atlas_name, agg_function, manifest))
+
+    def close(self):
+        """Close all shards of this writer"""
+        for writer, fname in self._writers.values():
+            writer.close()
+            os.replace(_get_tmp_shard_fname(fname), fname)
+        self._writers = {}
+        if len(self._manifest) > 0:
+            # only once the features of the manifest are visible
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            fname = (self.shard_dir / _manifest_table_name /
+                     f'{self.shard_name}.parquet')
+            fname.parent.mkdir(exist_ok=True, parents=True)
+            pq.write_table(
+                pa.Table.from_pandas(
+                    pd.DataFrame(self._manifest), preserve_index=False),
+                _get_tmp_shard_fname(fname))
+            os.replace(_get_tmp_shard_fname(fname), fname)
+            self._manifest = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _get_tmp_shard_fname(fname):
+    return fname.with_name(f'{fname.name}.tmp')
+
+
+def list_feature_shards(shard_dir):
+    """List features from sharded Parquet files
+
+    Parameters
+    ----------
+    shard_dir : str or Path
+        The directory of the shards (see FeatureShardWriter).
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        The DataFrame with the features list and the number of shards
+    """
+    features = {
+        'kind': [], 'atlas_name': [], 'agg_function': [], 'n_shards': []}
+    for t_dir in sorted(Path(shard_dir).iterdir()):
+        t_shards = list(t_dir.glob('*.parquet')) if t_dir.is_dir() else []
+        if len(t_shards) == 0 or t_dir.name == _manifest_table_name:
+            continue
+        t_k, t_a, t_f = _from_table_name(t_dir.name)
+        features['kind'].append(t_k)
+        features['atlas_name'].append(t_a)
+        features['agg_function'].append(t_f)
+        features['n_shards'].append(len(t_shards))
+    return pd.DataFrame(features)
+
+
+def read_feature_shards(shard_dir, kind, atlas_name, agg_function=None):
+    """Read features of all shards of a table
+
+    If a row (index) was written to several shards, e.g. by a rerun of a
+    job, the row of the most recent shard is kept.
+
+    Parameters
+    ----------
+    shard_dir : str or Path
+        The directory of the shards (see FeatureShardWriter).
+    kind : str
+        kind of features
+    altas_name : str
+        the name of the atlas
+    agg_function : str
+        The aggregation function used (defaults to None)
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        The DataFrame with the features (index as written)
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table_name = _to_table_name(kind, atlas_name, agg_function)
+    fnames = sorted(
+        (Path(shard_dir) / table_name).glob('*.parquet'),
+        key=lambda x: x.stat().st_mtime)
+    if len(fnames) == 0:
+        raise ValueError(f'No shards of table {table_name} in {shard_dir}.')
+    logger.debug(f'Reading {len(fnames)} shards of table {table_name}')
+    df = pa.concat_tables([pq.read_table(x) for x in fnames]).to_pandas()
+    return df[~df.index.duplicated(keep='last')]
+
+
+def read_shard_manifest(shard_dir):
+    """Read the completion manifest of sharded Parquet files
+
+    Parameters
+    ----------
+    shard_dir : str or Path
+        The directory of the shards (see FeatureShardWriter).
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        The DataFrame with the completed work, one row per subject, session,
+        kind, atlas_name, agg_function and params (as JSON), as
+        `read_manifest`
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    fnames = sorted(
+        (Path(shard_dir) / _manifest_table_name).glob('*.parquet'),
+        key=lambda x: x.stat().st_mtime)
+    if len(fnames) == 0:
+        return pd.DataFrame(columns=[*_manifest_key, 'completed'])
+    manifest = pa.concat_tables([pq.read_table(x) for x in fnames]).to_pandas()
+    # keep the first completion of work that was written again
+    return manifest.drop_duplicates(
+        subset=_manifest_key, keep='first').reset_index(drop=True)
+
+
+def get_missing_feature_shards(shard_dir, index, kind, atlas_names,
+                               agg_functions, params=None):
+    """Get the work that is not yet completed in sharded Parquet files
+
+    Parameters
+    ----------
+    shard_dir : str or Path
+        The directory of the shards (see FeatureShardWriter).
+    index : pandas.MultiIndex
+        The subjects and sessions (levels 'SubjectID' and 'Session') to
+        compute.
+    kind : str
+        kind of features
+    atlas_names : list(str)
+        the names of the atlases
+    agg_functions : list(str)
+        The aggregation functions
+    params : dict
+        The further parameters of the computation, as passed on to
+        `FeatureShardWriter.write` (defaults to None, i.e. {}).
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        The DataFrame with the missing work, one row per SubjectID, Session,
+        atlas_name and agg_function
+    """
+    missing = _get_missing_features(
+        read_shard_manifest(shard_dir), index, kind, atlas_names,
+        agg_functions, params)
+    logger.debug(f'{len(missing)} features missing in shards {shard_dir}')
+    return missing
+
+
+def compact_feature_shards(shard_dir, uri):
+    """Write the cohort-wide tables of sharded features to a SQL Database
+
+    Each table of the shards is read once (see `read_feature_shards`) and
+    replaces the table of the same name in the database, together with its
+    rows of the manifest of the database, which are replaced by the ones of
+    the manifest of the shards (see `read_shard_manifest`).
+
+    Parameters
+    ----------
+    shard_dir : str or Path
+        The directory of the shards (see FeatureShardWriter).
+    uri : str
+        The connection URI.
+        Easy options:
+            'sqlite://' for an in memory sqlite database
+            'sqlite:///<path_to_file>' to save in a file
+
+        Check https://docs.sqlalchemy.org/en/14/core/engines.html for more
+        options
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        The DataFrame with the list of compacted features and the number of
+        rows per table
+    """
+    features = list_feature_shards(shard_dir)
+    manifest = read_shard_manifest(shard_dir)
+    engine = get_engine(uri)
+    n_rows = []
+    for _, t_feature in features.iterrows():
+        t_k, t_a, t_f = t_feature[['kind', 'atlas_name', 'agg_function']]
+        df = read_feature_shards(shard_dir, t_k, t_a, t_f)
+        t_manifest = manifest[
+            (manifest['kind'] == t_k) & (manifest['atlas_name'] == t_a) &
+            (manifest['agg_function'] == (t_f or ''))]
+        _save_upsert(
+            df, _to_table_name(t_k, t_a, t_f), engine, upsert='delete',
+            if_exist='replace',
+            manifest=t_manifest.to_dict('records') or None,
+            features=(t_k, t_a, t_f))
+        n_rows.append(len(df))
+    features['n_rows'] = n_rows
+    return features.drop(columns='n_shards')
 
 
 def read_prs(fname):
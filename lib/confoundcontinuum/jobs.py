@@ -0,0 +1,594 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import os
+from pathlib import Path
+import re
+import shlex
+import subprocess
+import time
+
+import numpy as np
+import pandas as pd
+
+from confoundcontinuum.logging import logger, raise_error
+
+# resources of the HTCondor job event log: name in log -> column
+_condor_resources = {
+    'Cpus': 'cpus',
+    'Disk (KB)': 'disk_kb',
+    'Memory (MB)': 'memory_mb',
+}
+
+# requests when no resource profile was recorded yet (values previously
+# hard-coded in the submit files)
+_default_requests = {
+    'request_cpus': 1,
+    'request_memory': 1639,  # MB
+    'request_disk': 500,  # KB
+}
+
+
+def _parse_condor_event(lines):
+    """Parse the resource usage of a 'Job terminated' event"""
+    resources = {}
+    return_value = re.search(r'return value (-?\d+)', ''.join(lines))
+    resources['return_value'] = (
+        np.nan if return_value is None else int(return_value.group(1)))
+    for line in lines:
+        if ':' not in line:
+            continue
+        name, values = line.split(':', 1)
+        column = _condor_resources.get(name.strip())
+        if column is None:
+            continue
+        values = values.split()
+        # Usage Request Allocated (usage is left empty if not measured)
+        resources[column] = float(values[0]) if len(values) == 3 else np.nan
+        resources[f'{column}_request'] = float(values[-2])
+    return resources
+
+
+def read_job_resources(logs_dir, pattern='*.log'):
+    """Read the resources used by the jobs of earlier runs
+
+    The usage is read from the 'Job terminated' events of the HTCondor job
+    event logs ('log' in the submit file).
+
+    Parameters
+    ----------
+    logs_dir : str or pathlib.Path
+        The directory of the HTCondor job event logs.
+    pattern : str
+        The glob pattern of the log file names. Defaults to '*.log'.
+
+    Returns
+    -------
+    resources : pandas.DataFrame
+        The DataFrame with one row per terminated job and the columns log,
+        return_value, cpus, disk_kb and memory_mb (measured usage) and
+        cpus_request, disk_kb_request and memory_mb_request (requests).
+    """
+    columns = ['log', 'return_value']
+    for t_column in _condor_resources.values():
+        columns.extend([t_column, f'{t_column}_request'])
+    resources = []
+    for t_fname in sorted(Path(logs_dir).glob(pattern)):
+        event = None
+        with open(t_fname, 'r') as f:
+            for line in f:
+                if event is None:
+                    # events start with their 3-digit code, 005: terminated
+                    if line.startswith('005 '):
+                        event = []
+                elif line.startswith('...'):
+                    resources.append(
+                        {'log': t_fname.name, **_parse_condor_event(event)})
+                    event = None
+                else:
+                    event.append(line)
+    logger.info(
+        f'Read the resources of {len(resources)} terminated jobs in '
+        f'{logs_dir}.')
+    return pd.DataFrame(resources, columns=columns)
+
+
+def get_resource_requests(resources, quantile=0.95, margin=1.2,
+                          defaults=None):
+    """Get the resource requests of jobs from the resources of earlier runs
+
+    Memory and disk are requested as quantile of the measured peak usage of
+    successful jobs plus a safety margin, CPUs as the rounded up quantile of
+    the measured CPU usage.
+
+    Parameters
+    ----------
+    resources : pandas.DataFrame
+        The resources of earlier jobs as returned by `read_job_resources`.
+    quantile : float
+        The quantile of the measured usage to request. Defaults to 0.95.
+    margin : float
+        The factor applied to the quantile of the memory and disk usage.
+        Defaults to 1.2.
+    defaults : dict or None
+        The requests used if no usage was measured, with the keys
+        request_cpus, request_memory (in MB) and request_disk (in KB).
+        Defaults to None (1 CPU, 1639 MB memory, 500 KB disk).
+
+    Returns
+    -------
+    requests : dict
+        The requests with the keys request_cpus, request_memory (in MB) and
+        request_disk (in KB), as integers to be used in HTCondor submit
+        files.
+    """
+    if not 0 < quantile <= 1:
+        raise_error(f'quantile ({quantile}) needs to be in (0, 1].')
+    if margin < 1:
+        raise_error(f'margin ({margin}) needs to be at least 1.')
+    requests = dict(_default_requests)
+    if defaults is not None:
+        requests.update(defaults)
+
+    successful = resources[resources['return_value'] == 0]
+    for t_request, t_column, t_margin in [
+            ('request_cpus', 'cpus', 1),
+            ('request_memory', 'memory_mb', margin),
+            ('request_disk', 'disk_kb', margin)]:
+        usage = successful[t_column].dropna()
+        if len(usage) == 0:
+            logger.info(
+                f'No {t_column} usage measured, {t_request} defaults to '
+                f'{requests[t_request]}.')
+            continue
+        requests[t_request] = max(
+            1, int(np.ceil(usage.quantile(quantile) * t_margin)))
+        logger.info(
+            f'{t_request} = {requests[t_request]} from {len(usage)} jobs '
+            f'(quantile {quantile}, margin {t_margin}).')
+    return requests
+
+
+# environment variables limiting the threads of a job to its CPUs
+_thread_variables = [
+    'OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+    'NUMEXPR_NUM_THREADS']
+
+
+def _expand_macros(value, macros):
+    """Expand the HTCondor $(name) and $ENV(name) macros of a value"""
+    def _get_macro(match):
+        name = match.group(1).lower()
+        if name not in macros:
+            raise_error(f'Undefined macro $({match.group(1)}) in "{value}".')
+        return macros[name]
+
+    expanded = value
+    for _ in range(10):  # macros can be nested
+        t_expanded = re.sub(
+            r'\$ENV\((\w+)\)', lambda x: os.environ.get(x.group(1), ''),
+            expanded)
+        t_expanded = re.sub(r'\$\((\w+)\)', _get_macro, t_expanded)
+        if t_expanded == expanded:
+            return expanded
+        expanded = t_expanded
+    raise_error(f'Recursive macros in "{value}".')
+
+
+def _parse_memory(value):
+    """Parse a HTCondor memory request to MB (default unit)"""
+    match = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?)B?\s*', str(value).upper())
+    if match is None:
+        raise_error(f'Invalid memory request: {value}')
+    factors = {'K': 1 / 1024, '': 1, 'M': 1, 'G': 1024, 'T': 1024**2}
+    return float(match.group(1)) * factors[match.group(2)]
+
+
+def _parse_arguments(value):
+    """Split the arguments of a submit file (old or new syntax)"""
+    value = value.strip()
+    if value.startswith('"') and value.endswith('"'):
+        # new syntax: '' groups arguments with spaces, "" is a quote
+        return shlex.split(value[1:-1].replace('""', '"'))
+    return value.split()
+
+
+def read_submit(submit_fname):
+    """Read the commands of a HTCondor submit file
+
+    Parameters
+    ----------
+    submit_fname : str or pathlib.Path
+        The path of the submit file.
+
+    Returns
+    -------
+    commands : dict
+        The submit commands (names in lower case) and their values (not
+        expanded). The queue statement is stored under 'queue' (arguments
+        only).
+    """
+    commands = {}
+    with open(submit_fname, 'r') as f:
+        text = f.read().replace('\\\n', ' ')
+    for line in text.splitlines():
+        line = line.strip()
+        if len(line) == 0 or line.startswith('#'):
+            continue
+        if re.match(r'queue\b', line, re.IGNORECASE):
+            commands['queue'] = line[5:].strip()
+            continue
+        if '=' not in line:
+            raise_error(f'Invalid line in {submit_fname}: {line}')
+        name, value = line.split('=', 1)
+        commands[name.strip().lower()] = value.strip()
+    if 'queue' not in commands:
+        raise_error(f'No queue statement in {submit_fname}.')
+    return commands
+
+
+def get_submit_jobs(submit_fname, variables=None, name=None):
+    """Get the jobs queued by a HTCondor submit file
+
+    Supports the statements `queue`, `queue <N>` and
+    `queue <variables> from <file>` (e.g. the job options of
+    4_prediction/1_create_pipeline_options.py).
+
+    Parameters
+    ----------
+    submit_fname : str or pathlib.Path
+        The path of the submit file.
+    variables : dict or None
+        Further macros (e.g. the VARS of a DAG node). Defaults to None.
+    name : str or None
+        The name of the jobs (suffixed by the process number if several jobs
+        are queued). Defaults to None (name of the submit file).
+
+    Returns
+    -------
+    jobs : list(dict)
+        The jobs with the keys name, executable, arguments, initial_dir,
+        output, error, request_cpus and request_memory (in MB).
+    """
+    submit_fname = Path(submit_fname)
+    commands = read_submit(submit_fname)
+    macros = {k: v for k, v in commands.items() if k != 'queue'}
+    if variables is not None:
+        macros.update({k.lower(): v for k, v in variables.items()})
+    macros.setdefault('initial_dir', macros.get('initialdir', os.getcwd()))
+    macros.update({'cluster': '0', 'clusterid': '0'})
+
+    # items of the queue statement
+    queue = commands['queue']
+    match = re.fullmatch(
+        r'(.*?)\s+from\s+(.+)', queue, re.IGNORECASE)
+    if match is not None:
+        queue_names = [
+            x.lower() for x in re.split(r'[\s,]+', match.group(1).strip())]
+        items_fname = _expand_macros(match.group(2), macros)
+        with open(items_fname, 'r') as f:
+            queue_items = [
+                dict(zip(queue_names, re.split(
+                    r'[\s,]+', x.strip(), maxsplit=len(queue_names) - 1)))
+                for x in f if len(x.strip()) > 0]
+    elif re.fullmatch(r'\d*', queue):
+        queue_items = [{}] * (1 if queue == '' else int(queue))
+    else:
+        raise_error(f'Unsupported queue statement in {submit_fname}: {queue}')
+
+    if name is None:
+        name = submit_fname.stem
+    jobs = []
+    for i_process, t_items in enumerate(queue_items):
+        t_macros = {
+            **macros, **t_items, 'process': str(i_process),
+            'procid': str(i_process)}
+
+        def _get(key, default=None):
+            if key not in t_macros:
+                return default
+            return _expand_macros(t_macros[key], t_macros)
+
+        initial_dir = Path(_get('initial_dir'))
+        jobs.append({
+            'name': name if len(queue_items) == 1 else f'{name}.{i_process}',
+            'executable': initial_dir / _get('executable'),
+            'arguments': _parse_arguments(_get('arguments', '')),
+            'initial_dir': initial_dir,
+            'output': initial_dir / _get('output', os.devnull),
+            'error': initial_dir / _get('error', os.devnull),
+            'request_cpus': int(_get('request_cpus', '1')),
+            'request_memory': _parse_memory(_get('request_memory', '128')),
+        })
+    return jobs
+
+
+def get_dag_jobs(dag_fname, variables=None):
+    """Get the jobs of a HTCondor DAG file
+
+    Supports the commands JOB, VARS, RETRY and PARENT ... CHILD.
+
+    Parameters
+    ----------
+    dag_fname : str or pathlib.Path
+        The path of the DAG file.
+    variables : dict or None
+        Further macros for all nodes (e.g. another initial_dir), overridden
+        by the VARS of the nodes. Defaults to None.
+
+    Returns
+    -------
+    jobs : list(dict)
+        The jobs as returned by `get_submit_jobs` with the additional keys
+        node (name of the DAG node), retries and parents (names of the
+        parent nodes).
+    """
+    nodes = {}
+    dependencies = []
+    with open(dag_fname, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            command, *values = line.split(None, 2)
+            command = command.upper()
+            if command == 'JOB':
+                nodes[values[0]] = {
+                    'submit': values[1].split()[0], 'variables': {},
+                    'retries': 0, 'parents': []}
+            elif command == 'VARS':
+                nodes[values[0]]['variables'].update(
+                    re.findall(r'(\w+)\s*=\s*"((?:[^"\\]|\\.)*)"', values[1]))
+            elif command == 'RETRY':
+                nodes[values[0]]['retries'] = int(values[1].split()[0])
+            elif command == 'PARENT':
+                dependencies.append(line)
+            else:
+                raise_error(f'Unsupported DAG command in {dag_fname}: {line}')
+    for t_dependency in dependencies:
+        match = re.fullmatch(
+            r'PARENT\s+(.+?)\s+CHILD\s+(.+)', t_dependency, re.IGNORECASE)
+        if match is None:
+            raise_error(f'Invalid DAG dependency: {t_dependency}')
+        for t_child in match.group(2).split():
+            nodes[t_child]['parents'].extend(match.group(1).split())
+
+    jobs = []
+    for t_node, t_spec in nodes.items():
+        t_jobs = get_submit_jobs(
+            t_spec['submit'], {**(variables or {}), **t_spec['variables']},
+            name=t_node)
+        for t_job in t_jobs:
+            t_job.update({
+                'node': t_node, 'retries': t_spec['retries'],
+                'parents': t_spec['parents']})
+        jobs.extend(t_jobs)
+    logger.info(f'Read {len(jobs)} jobs of {len(nodes)} nodes from '
+                f'{dag_fname}.')
+    return jobs
+
+
+def _get_tree_rss(process):
+    """Get the resident memory of a process and its children in bytes"""
+    import psutil
+    rss = 0
+    try:
+        for t_process in [process, *process.children(recursive=True)]:
+            rss += t_process.memory_info().rss
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+        pass
+    return rss
+
+
+def _kill_tree(process):
+    import psutil
+    try:
+        for t_process in [*process.children(recursive=True), process]:
+            t_process.kill()
+    except psutil.NoSuchProcess:
+        pass
+
+
+def _run_job(job, cpus, poll_interval, enforce_memory):
+    """Run a job pinned to its CPUs and measure its wall time and peak RSS"""
+    import psutil
+
+    env = dict(os.environ)
+    env.update({x: str(len(cpus)) for x in _thread_variables})
+
+    for t_fname in [job['output'], job['error']]:
+        Path(t_fname).parent.mkdir(exist_ok=True, parents=True)
+    start_time = time.time()
+    with open(job['output'], 'w') as f_out, open(job['error'], 'w') as f_err:
+        try:
+            process = subprocess.Popen(
+                [str(job['executable']), *job['arguments']],
+                cwd=job['initial_dir'], stdout=f_out, stderr=f_err, env=env)
+        except OSError as e:
+            # e.g. a missing executable or one without exec permission
+            logger.error(f'Job {job["name"]} could not be started: {e}')
+            f_err.write(f'{e}\n')
+            return {
+                'status': 'failed', 'returncode': None,
+                'wall_time': time.time() - start_time, 'peak_rss_mb': 0.}
+        ps_process = psutil.Process(process.pid)
+        # pin to the CPUs of the job (inherited by the processes it starts;
+        # not in preexec_fn, which is unsafe with threads)
+        if hasattr(os, 'sched_setaffinity'):
+            try:
+                os.sched_setaffinity(process.pid, cpus)
+            except ProcessLookupError:
+                pass
+        peak_rss = 0
+        exceeded = False
+        # poll often at the start for short jobs
+        t_interval = min(0.01, poll_interval)
+        while process.poll() is None:
+            # (ru_maxrss of the child also counts the memory of this process
+            # before exec, so the memory is measured by polling)
+            peak_rss = max(peak_rss, _get_tree_rss(ps_process))
+            if (enforce_memory and not exceeded and
+                    peak_rss > job['request_memory'] * 2**20):
+                exceeded = True
+                _kill_tree(ps_process)
+            time.sleep(t_interval)
+            t_interval = min(2 * t_interval, poll_interval)
+    wall_time = time.time() - start_time
+    peak_rss /= 2**20
+
+    if exceeded:
+        status = 'memory_exceeded'
+    else:
+        status = 'done' if process.returncode == 0 else 'failed'
+    return {
+        'status': status, 'returncode': process.returncode,
+        'wall_time': wall_time, 'peak_rss_mb': peak_rss}
+
+
+def run_jobs(jobs, n_cpus=None, memory=None, retries=0, enforce_memory=True,
+             poll_interval=1.):
+    """Run HTCondor jobs locally in parallel
+
+    Jobs are started (in order and once their parents are done) as long as
+    their requested CPUs and memory fit the free resources. Each job is
+    pinned to its requested CPUs and, if enforce_memory, killed once the
+    resident memory of its processes exceeds its memory request. Failed jobs
+    are retried.
+
+    Parameters
+    ----------
+    jobs : list(dict)
+        The jobs as returned by `get_submit_jobs` or `get_dag_jobs`.
+    n_cpus : int or None
+        The number of CPUs to use. Defaults to None (all available CPUs).
+    memory : float or None
+        The memory to use in MB. Defaults to None (total memory).
+    retries : int
+        The number of retries of failed jobs (unless specified per job, e.g.
+        by RETRY in a DAG). Defaults to 0.
+    enforce_memory : bool
+        Whether to kill jobs exceeding their memory request.
+        Defaults to True.
+    poll_interval : float
+        The interval in seconds to measure the memory of the jobs.
+        Defaults to 1.
+
+    Returns
+    -------
+    results : pandas.DataFrame
+        The DataFrame with one row per job and the columns name, status
+        ('done', 'failed', 'memory_exceeded' or 'skipped' if a parent
+        failed), returncode (missing if the job could not be started),
+        attempts, wall_time (in s, last attempt), peak_rss_mb (last
+        attempt, sampled every poll_interval), request_cpus and
+        request_memory.
+    """
+    import psutil
+
+    if hasattr(os, 'sched_getaffinity'):
+        available_cpus = sorted(os.sched_getaffinity(0))
+    else:
+        available_cpus = list(range(os.cpu_count()))
+    if n_cpus is None:
+        n_cpus = len(available_cpus)
+    if n_cpus < 1 or n_cpus > len(available_cpus):
+        raise_error(
+            f'n_cpus ({n_cpus}) needs to be between 1 and the number of '
+            f'available CPUs ({len(available_cpus)}).')
+    if memory is None:
+        memory = psutil.virtual_memory().total / 2**20
+    if retries < 0:
+        raise_error(f'retries ({retries}) needs to be at least 0.')
+    names = [x['name'] for x in jobs]
+    if len(set(names)) != len(names):
+        raise_error('The names of the jobs are not unique.')
+
+    # parents are DAG nodes, which queue one or several jobs
+    node_jobs = {}
+    for t_job in jobs:
+        node_jobs.setdefault(t_job.get('node', t_job['name']), []).append(
+            t_job['name'])
+
+    # requests larger than the resources run alone
+    requests = {}
+    for t_job in jobs:
+        t_cpus = min(t_job['request_cpus'], n_cpus)
+        t_memory = min(t_job['request_memory'], memory)
+        if (t_cpus, t_memory) != (
+                t_job['request_cpus'], t_job['request_memory']):
+            logger.warning(
+                f'Job {t_job["name"]} requests more resources than available '
+                f'({t_job["request_cpus"]} CPUs, {t_job["request_memory"]} '
+                'MB), it is run alone.')
+        requests[t_job['name']] = (t_cpus, t_memory)
+
+    logger.info(
+        f'Run {len(jobs)} jobs with {n_cpus} CPUs and {memory:.0f} MB '
+        'memory.')
+    free_cpus = available_cpus[:n_cpus]
+    free_memory = memory
+    pending = list(jobs)
+    attempts = {x: 0 for x in names}
+    results = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=n_cpus) as pool:
+        while len(pending) > 0 or len(running) > 0:
+            # start the jobs that are ready and fit the free resources
+            for t_job in list(pending):
+                t_parents = [
+                    results.get(y, {}).get('status')
+                    for x in t_job.get('parents', [])
+                    for y in node_jobs.get(x, [x])]
+                if any(x not in [None, 'done'] for x in t_parents):
+                    pending.remove(t_job)
+                    results[t_job['name']] = {'status': 'skipped'}
+                    continue
+                if any(x is None for x in t_parents):
+                    continue
+                t_cpus, t_memory = requests[t_job['name']]
+                if t_cpus > len(free_cpus) or t_memory > free_memory:
+                    continue
+                pending.remove(t_job)
+                job_cpus = free_cpus[:t_cpus]
+                free_cpus = free_cpus[t_cpus:]
+                free_memory -= t_memory
+                attempts[t_job['name']] += 1
+                future = pool.submit(
+                    _run_job, t_job, job_cpus, poll_interval, enforce_memory)
+                running[future] = (t_job, job_cpus)
+            if len(running) == 0:
+                # remaining jobs wait for parents that never finish
+                for t_job in pending:
+                    results[t_job['name']] = {'status': 'skipped'}
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                t_job, job_cpus = running.pop(future)
+                free_cpus = sorted(free_cpus + job_cpus)
+                free_memory += requests[t_job['name']][1]
+                t_result = future.result()
+                t_name = t_job['name']
+                logger.info(
+                    f'Job {t_name} {t_result["status"]} (attempt '
+                    f'{attempts[t_name]}, return code '
+                    f'{t_result["returncode"]}, '
+                    f'{t_result["wall_time"]:.1f} s, peak RSS '
+                    f'{t_result["peak_rss_mb"]:.0f} MB).')
+                t_retries = t_job.get('retries', retries) or retries
+                if (t_result['status'] != 'done' and
+                        attempts[t_name] <= t_retries):
+                    pending.insert(0, t_job)
+                else:
+                    results[t_name] = t_result
+
+    results = pd.DataFrame([
+        {'name': x['name'], 'returncode': np.nan, 'wall_time': np.nan,
+         'peak_rss_mb': np.nan, **results[x['name']],
+         'attempts': attempts[x['name']],
+         'request_cpus': x['request_cpus'],
+         'request_memory': x['request_memory']}
+        for x in jobs],
+        columns=['name', 'status', 'returncode', 'attempts', 'wall_time',
+                 'peak_rss_mb', 'request_cpus', 'request_memory'])
+    logger.info(
+        f'{(results["status"] == "done").sum()} of {len(results)} jobs done.')
+    return results
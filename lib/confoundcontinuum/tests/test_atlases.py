@@ -0,0 +1,100 @@
+from pathlib import Path
+import shutil
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+import confoundcontinuum.atlases as atl
+from confoundcontinuum.atlases import (
+    get_atlas, get_atlas_kwargs, get_features_atlas_name, import_atlases,
+    verify_atlas_store)
+
+
+def test_get_atlas_kwargs():
+    assert get_atlas_kwargs('Schaefer400x17') == {
+        'resolution': 1, 'n_rois': 400, 'yeo_network': 17}
+    assert get_atlas_kwargs('Tian4x3TxMNInonlinear2009cAsym') == {
+        'resolution': 2, 'scale': 4, 'magneticfield': '3T',
+        'space': 'MNInonlinear2009cAsym'}
+    assert get_atlas_kwargs('SUITxMNI') == {'space': 'MNI'}
+
+    with pytest.raises(ValueError, match='not available'):
+        get_atlas_kwargs('Schaefer150x7')
+
+
+def test_get_features_atlas_name():
+    assert get_features_atlas_name('Schaefer400x7') == \
+        'schaefer2018_400parcels'
+    assert get_features_atlas_name('Schaefer400x17') == 'Schaefer400x17'
+    assert get_features_atlas_name('SUITxMNI') == 'SUITxMNI'
+
+
+def test_get_atlas(monkeypatch, tmpdir):
+    atlas_fname = Path(tmpdir) / 'custom_atlas.nii.gz'
+    atlas_data = np.zeros((4, 5, 6), dtype=np.int16)
+    atlas_data[:2] = 3
+    atlas_data[2:, :2] = 1
+    nib.save(nib.Nifti1Image(atlas_data, np.eye(4)), atlas_fname)
+    monkeypatch.setitem(atl._available_atlases, 'Custom', {
+        'family': 'CustomUserAtlas', 'path': atlas_fname,
+        'labels': ['a', 'b', 'c']})
+    loaded = []
+    load_atlas = atl.load_atlas
+    monkeypatch.setattr(
+        atl, 'load_atlas',
+        lambda **kwargs: loaded.append(kwargs) or load_atlas(**kwargs))
+
+    atlas_img, atlas_labels, atlas_rois = get_atlas('Custom', tmpdir)
+    assert atlas_labels == ('a', 'b', 'c')
+    np.testing.assert_array_equal(atlas_img.get_fdata(), atlas_data)
+    np.testing.assert_array_equal(atlas_rois, [1, 3])
+    assert not atlas_img.dataobj.flags.writeable
+    assert not atlas_rois.flags.writeable
+
+    # loaded once per process
+    assert get_atlas('Custom', str(tmpdir))[0] is atlas_img
+    assert len(loaded) == 1
+    atl._get_atlas.cache_clear()
+    assert get_atlas('Custom', tmpdir)[0] is not atlas_img
+    assert len(loaded) == 2
+    atl._get_atlas.cache_clear()
+
+
+def test_import_atlases(monkeypatch, tmpdir):
+    # SUIT atlas files as if downloaded before
+    atlas_dir = Path(tmpdir) / 'atlas'
+    (atlas_dir / 'SUIT').mkdir(parents=True)
+    atlas_data = np.zeros((4, 5, 6), dtype=np.int16)
+    atlas_data[:2] = 1
+    atlas_data[2:] = 2
+    nib.save(nib.Nifti1Image(atlas_data, np.eye(4)),
+             atlas_dir / 'SUIT' / 'SUIT_MNISpace_1mm.nii')
+    with open(atlas_dir / 'SUIT' / 'SUIT_MNISpace_1mm.tsv', 'w') as f:
+        f.write('name\nLeft_I_IV\nRight_I_IV\n')
+
+    store_dir = Path(tmpdir) / 'store'
+    index = import_atlases(store_dir, ['SUITxMNI'], atlas_dir)
+    assert sorted(index) == [
+        'SUIT/SUIT_MNISpace_1mm.nii', 'SUIT/SUIT_MNISpace_1mm.tsv']
+    assert verify_atlas_store(store_dir) == []
+    # importing again keeps the store
+    assert import_atlases(store_dir, ['SUITxMNI'], atlas_dir) == index
+
+    # resolved from the store only (no network, no source files)
+    shutil.rmtree(atlas_dir)
+    monkeypatch.setattr(atl.requests, 'get', None)
+    atlas_img, atlas_labels, atlas_rois = get_atlas('SUITxMNI', store_dir)
+    assert atlas_labels == ('Left_I_IV', 'Right_I_IV')
+    np.testing.assert_array_equal(atlas_img.get_fdata(), atlas_data)
+    np.testing.assert_array_equal(atlas_rois, [1, 2])
+    with pytest.raises(ValueError, match='missing in the atlas store'):
+        get_atlas('SUITxSUIT', store_dir)
+    atl._get_atlas.cache_clear()
+
+    # corrupted files are found by their checksum
+    tsv_fname = store_dir / 'atlases' / 'SUIT' / 'SUIT_MNISpace_1mm.tsv'
+    tsv_fname.resolve().chmod(0o644)
+    with open(tsv_fname, 'a') as f:
+        f.write('Vermis_VI\n')
+    assert verify_atlas_store(store_dir) == ['SUIT/SUIT_MNISpace_1mm.tsv']
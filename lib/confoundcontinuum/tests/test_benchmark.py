@@ -0,0 +1,126 @@
+import nibabel as nib
+import numpy as np
+import pytest
+from numpy.testing import assert_array_almost_equal, assert_array_equal
+
+from confoundcontinuum.benchmark import (
+    benchmark_gmd, benchmark_save_features, make_synthetic_atlas,
+    make_synthetic_features, make_synthetic_vbm, summarize_benchmark)
+from confoundcontinuum.features import get_gmd
+from confoundcontinuum.io import read_features
+
+
+def test_make_synthetic_volumes():
+    vbm_nifti = make_synthetic_vbm()
+    assert vbm_nifti.shape == (121, 145, 121)
+    assert_array_equal(np.diag(vbm_nifti.affine), [1.5, 1.5, 1.5, 1.])
+    vbm_data = vbm_nifti.get_fdata()
+    assert vbm_data.min() >= 0 and vbm_data.max() <= 1
+    assert 0 < np.mean(vbm_data > 0) < 1
+
+    for kind, n_rois in [('schaefer', 100), ('tian', 16), ('suit', 34)]:
+        atlas_nifti = make_synthetic_atlas(kind, n_rois, voxel_size=3.)
+        assert_array_equal(
+            np.unique(atlas_nifti.get_fdata()), np.arange(n_rois + 1))
+        # the atlas is within the brain of the VBM (few voxels have no GM)
+        atlas_re = make_synthetic_atlas(kind, n_rois, voxel_size=1.5)
+        assert np.mean(vbm_data[atlas_re.get_fdata() > 0] > 0) > 0.99
+    # seeded
+    assert_array_equal(
+        make_synthetic_atlas('tian', voxel_size=3.).get_fdata(),
+        make_synthetic_atlas('tian', voxel_size=3.).get_fdata())
+
+    with pytest.raises(ValueError, match='unknown'):
+        make_synthetic_atlas('aal')
+    with pytest.raises(ValueError, match='less than'):
+        make_synthetic_atlas('tian', n_rois=10 ** 6, voxel_size=3.)
+
+
+def test_benchmark_gmd(tmp_path):
+    vbm_fnames = []
+    for i_subject in range(2):
+        vbm_fnames.append(tmp_path / f'sub-{i_subject}.nii.gz')
+        nib.save(
+            make_synthetic_vbm(voxel_size=3., seed=i_subject),
+            vbm_fnames[-1])
+    atlas_niftis = {
+        'schaefer': make_synthetic_atlas('schaefer', 50, voxel_size=2.),
+        'suit': make_synthetic_atlas('suit', 10, voxel_size=2.),
+    }
+    aggregation = ['winsorized_mean', 'mean', 'median']
+    uri = f'sqlite:///{(tmp_path / "results.sqlite").as_posix()}'
+    results = benchmark_gmd(
+        vbm_fnames, atlas_niftis, uri, aggregation=aggregation, qc=True)
+
+    stages = ['resample', 'index', 'mask', 'moments', 'sort', *aggregation,
+              'qc', 'save']
+    assert len(results) == 2 * 2 * len(stages)
+    assert list(results.query(
+        'SubjectID == "sub-0" and atlas_name == "suit"')['stage']) == stages
+    assert np.all(results['time_s'] > 0)
+    assert np.all(results['peak_mb'] >= 0)
+    assert_array_almost_equal(
+        results['voxels_per_s'], results['n_voxels'] / results['time_s'])
+    assert np.all(results.query('stage == "resample"')['n_voxels'] ==
+                  np.prod(nib.load(vbm_fnames[0]).shape))
+
+    # the saved features are those of get_gmd()
+    for atlas_name, atlas_nifti in atlas_niftis.items():
+        gmd, _ = get_gmd(
+            atlas_nifti, nib.load(vbm_fnames[1]), aggregation=aggregation)
+        for agg_name in aggregation:
+            gmd_df = read_features(
+                uri, 'gmd', atlas_name, ['SubjectID', 'Session'],
+                agg_function=agg_name)
+            assert len(gmd_df) == 2
+            assert_array_almost_equal(
+                gmd_df.loc[('sub-1', 'ses-2')].to_numpy(dtype=float),
+                gmd[agg_name])
+        assert len(read_features(
+            uri, 'gmd', atlas_name, ['SubjectID', 'Session'],
+            agg_function='qc_n_voxels')) == 2
+
+    summary = summarize_benchmark(results)
+    assert len(summary) == 2 * (len(stages) + 1)
+    assert np.all(summary['n_subjects'] == 2)
+    totals = results.groupby(['atlas_name', 'SubjectID'])['time_s'].sum()
+    assert_array_almost_equal(
+        summary.loc[('suit', 'total'), 'time_s_total'],
+        totals.loc['suit'].sum())
+
+    results = benchmark_gmd(
+        vbm_fnames[:1], atlas_niftis, uri, aggregation=['mean'],
+        subject_ids=['sub-9'], track_memory=False)
+    assert 'sort' not in list(results['stage'])
+    assert results['peak_mb'].isna().all()
+    with pytest.raises(ValueError, match='One subject ID'):
+        benchmark_gmd(vbm_fnames, atlas_niftis, uri, subject_ids=['sub-9'])
+
+
+def test_benchmark_save_features(tmp_path):
+    df = make_synthetic_features(n_subjects=5, n_rois=20)
+    assert df.shape == (5, 20)
+    assert df.index.names == ['SubjectID', 'Session']
+
+    results = benchmark_save_features(
+        tmp_path, n_subjects=50, n_rois=100, n_single=5)
+    assert results['method'].tolist() == [
+        'to_sql', 'save_features', 'save_features_scratch', 'save_features',
+        'save_features_scratch']
+    assert results['n_rows'].tolist() == [50, 50, 50, 5, 5]
+    assert np.all(results['values_per_s'] > 0)
+    # the target only applies to whole-table saves
+    assert results['meets_target'].iloc[3:].isna().all()
+    for target in [0, np.inf]:
+        target_results = benchmark_save_features(
+            tmp_path / f'target_{target}', n_subjects=5, n_rois=10,
+            n_single=1, target=target)
+        assert target_results['meets_target'].iloc[:3].tolist() == [
+            target == 0] * 3
+    # all cases wrote the synthetic features
+    df = make_synthetic_features(n_subjects=50, n_rois=100)
+    for i_case, n_rows in enumerate([50, 50, 50, 5, 5]):
+        uri = f'sqlite:///{(tmp_path / f"save_{i_case}.sqlite").as_posix()}'
+        saved = read_features(
+            uri, 'gmd', 'bench', ['SubjectID', 'Session'], 'mean')
+        assert_array_almost_equal(saved, df.iloc[:n_rows])
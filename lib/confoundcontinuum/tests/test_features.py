@@ -0,0 +1,728 @@
+import fcntl
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+import nibabel as nib
+from numpy.testing import assert_array_almost_equal, assert_array_equal
+from nilearn import image, masking
+from scipy import stats
+
+import confoundcontinuum
+
+from confoundcontinuum.features import (
+    get_atlas_index, get_cached_atlas_index, get_roi_values, get_roi_moments,
+    get_roi_qc,
+    get_atlas_bbox, load_vbm_bbox, cache_vbm, get_dataset,
+    get_dataset_files, drop_dataset_files, _get_dataset_lock_fname,
+    _share_array, _attach_array,
+    sort_roi_values, get_gmd, get_gmd_atlases, get_gmd_subjects,
+    build_voxel_matrix, load_voxel_matrix, get_roi_projection,
+    project_voxel_matrix, correlate_voxel_matrix, voxel_matrix_to_nifti,
+    read_roi_stats, get_parent_rois,
+    get_schaefer_networks, aggregate_roi_stats, get_stats_aggregation,
+    histogram_sketch, winsorized_mean, trimmed_mean, _get_funcbyname)
+from confoundcontinuum.io import save_features
+
+rng = np.random.RandomState(42)
+
+# synthetic VBM (2 mm) and atlas (1 mm) on the same field of view
+vbm_affine = np.diag([2., 2., 2., 1.])
+atlas_affine = np.diag([1., 1., 1., 1.])
+vbm_data = rng.uniform(0, 1, size=(10, 12, 8)).astype(np.float32)
+atlas_data = rng.randint(0, 6, size=(20, 24, 16)).astype(np.int16)
+vbm_nifti = nib.Nifti1Image(vbm_data, vbm_affine)
+atlas_nifti = nib.Nifti1Image(atlas_data, atlas_affine)
+
+
+def _get_gmd_masked(atlas_nifti, vbm_nifti, limits):
+    """Per-ROI mask implementation the engine has to reproduce"""
+    atlas_re = image.resample_to_img(
+        atlas_nifti, vbm_nifti, interpolation='nearest')
+    rois = np.unique(image.get_data(atlas_nifti))[1:]
+    out = {'winsorized_mean': [], 'mean': [], 'std': []}
+    for roi in rois:
+        mask = image.math_img(f'img=={roi}', img=atlas_re)
+        gmd = masking.apply_mask(imgs=vbm_nifti, mask_img=mask)
+        out['winsorized_mean'].append(winsorized_mean(gmd, limits=limits))
+        out['mean'].append(gmd.mean())
+        out['std'].append(gmd.std())
+    return {k: np.array(v) for k, v in out.items()}
+
+
+def test_atlas_index():
+    atlas_index = get_atlas_index(atlas_nifti, vbm_nifti)
+    assert_array_equal(atlas_index['rois'], [1, 2, 3, 4, 5])
+    assert atlas_index['shape'] == vbm_data.shape
+    # voxels are grouped by ROI
+    assert np.all(np.diff(atlas_index['voxel_rois']) >= 0)
+
+    atlas_re = image.get_data(image.resample_to_img(
+        atlas_nifti, vbm_nifti, interpolation='nearest')).ravel(order='F')
+    assert_array_equal(
+        atlas_re[atlas_index['voxels']],
+        atlas_index['rois'][atlas_index['voxel_rois']])
+    assert atlas_index['voxels'].size == np.count_nonzero(atlas_re)
+
+
+def test_cached_atlas_index():
+    atlas_index = get_atlas_index(atlas_nifti, vbm_nifti)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for _ in range(2):  # build and cache, then memory-map
+            cached_index = get_cached_atlas_index(
+                'atlas', atlas_nifti, vbm_nifti, tmpdir)
+            assert len(list(Path(tmpdir).iterdir())) == 1
+            assert isinstance(cached_index['voxels'], np.memmap)
+            assert cached_index['shape'] == atlas_index['shape']
+            for key in ['rois', 'voxels', 'voxel_rois']:
+                assert_array_equal(cached_index[key], atlas_index[key])
+            assert_array_equal(
+                cached_index['labels'],
+                image.get_data(image.resample_to_img(
+                    atlas_nifti, vbm_nifti, interpolation='nearest')))
+
+        # the cache is keyed by the grid of the target
+        shifted_affine = vbm_affine.copy()
+        shifted_affine[:3, 3] = 2
+        vbm_shifted = nib.Nifti1Image(vbm_data, shifted_affine)
+        get_cached_atlas_index('atlas', atlas_nifti, vbm_shifted, tmpdir)
+        assert len(list(Path(tmpdir).iterdir())) == 2
+
+        # and by the data and affine of the atlas (not only by its name)
+        atlas_changed = nib.Nifti1Image(
+            np.where(atlas_data == 1, 2, atlas_data).astype(np.int16),
+            atlas_affine)
+        changed_index = get_cached_atlas_index(
+            'atlas', atlas_changed, vbm_nifti, tmpdir)
+        assert len(list(Path(tmpdir).iterdir())) == 3
+        assert_array_equal(
+            changed_index['rois'],
+            get_atlas_index(atlas_changed, vbm_nifti)['rois'])
+        atlas_moved = nib.Nifti1Image(atlas_data, shifted_affine)
+        get_cached_atlas_index('atlas', atlas_moved, vbm_nifti, tmpdir)
+        assert len(list(Path(tmpdir).iterdir())) == 4
+
+        gmd, _ = get_gmd(
+            atlas_nifti, vbm_nifti, atlas_name='atlas', cache_dir=tmpdir)
+        gmd_expected, _ = get_gmd(atlas_nifti, vbm_nifti)
+        for agg_name, agg_values in gmd_expected.items():
+            assert_array_almost_equal(gmd[agg_name], agg_values, 6)
+
+
+def test_load_vbm_bbox():
+    # atlas covering only a small part of the grid
+    small_data = np.zeros(atlas_data.shape, dtype=np.int16)
+    small_data[4:10, 6:14, 2:6] = atlas_data[4:10, 6:14, 2:6]
+    small_index = get_atlas_index(
+        nib.Nifti1Image(small_data, atlas_affine), vbm_nifti)
+    bbox = get_atlas_bbox([small_index])
+    assert bbox == (slice(2, 5), slice(3, 7), slice(1, 3))
+    # union with a second atlas
+    assert get_atlas_bbox(
+        [small_index, get_atlas_index(atlas_nifti, vbm_nifti)]) == \
+        tuple(slice(0, x) for x in vbm_data.shape)
+
+    expected = get_roi_values(vbm_nifti, small_index)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        vbm_fname = Path(tmpdir) / 'vbm.nii.gz'
+        nib.save(nib.Nifti1Image(vbm_data.astype(np.float64), vbm_affine),
+                 vbm_fname)
+        vbm_crop = load_vbm_bbox(vbm_fname, bbox)
+        assert vbm_crop['data'].dtype == np.float32
+        assert vbm_crop['data'].shape == (3, 4, 2)
+        assert vbm_crop['shape'] == vbm_data.shape
+
+        # read lazily from the path or a not yet loaded nifti
+        for vbm in [vbm_crop, vbm_fname, nib.load(vbm_fname)]:
+            values = get_roi_values(vbm, small_index)
+            assert values.dtype == np.float32
+            assert_array_equal(values, expected)
+        lazy_nifti = nib.load(vbm_fname)
+        get_gmd(None, lazy_nifti, atlas_index=small_index)
+        assert not lazy_nifti.in_memory
+
+
+def test_cache_vbm(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        vbm_fnames = []
+        for i_sub in range(3):
+            vbm_fnames.append(
+                Path(tmpdir) / f'm0wp1sub-{i_sub}_ses-2_T1w.nii.gz')
+            nib.save(nib.Nifti1Image(vbm_data + i_sub, vbm_affine),
+                     vbm_fnames[-1])
+        cache_dir = Path(tmpdir) / 'cache'
+        cached_fnames = cache_vbm(vbm_fnames[:2], cache_dir)
+        assert [x.name for x in cached_fnames] == [
+            'm0wp1sub-0_ses-2_T1w.nii', 'm0wp1sub-1_ses-2_T1w.nii']
+        cached_nifti = nib.load(cached_fnames[1])
+        assert_array_equal(cached_nifti.affine, vbm_affine)
+        assert_array_equal(cached_nifti.get_fdata(), vbm_data + 1)
+
+        # room for 2 niftis: the least recently used one is removed
+        entry_size = cached_fnames[0].stat().st_size
+        os.utime(cached_fnames[0], (0, 0))
+        cached_fnames = cache_vbm(
+            vbm_fnames[2:], cache_dir, cache_size=2.5 * entry_size)
+        assert sorted(x.name for x in cache_dir.glob('*.nii')) == [
+            'm0wp1sub-1_ses-2_T1w.nii', 'm0wp1sub-2_ses-2_T1w.nii']
+
+        # niftis used recently (e.g. by another job) are kept
+        cache_vbm([], cache_dir, cache_size=0, keep=cached_fnames)
+        assert sorted(x.name for x in cache_dir.glob('*.nii')) == [
+            'm0wp1sub-1_ses-2_T1w.nii', 'm0wp1sub-2_ses-2_T1w.nii']
+
+        # niftis in use are kept
+        monkeypatch.setattr(
+            'confoundcontinuum.features._vbm_cache_grace', 0.)
+        cache_vbm([], cache_dir, cache_size=0, keep=cached_fnames)
+        assert [x.name for x in cache_dir.glob('*.nii')] == [
+            'm0wp1sub-2_ses-2_T1w.nii']
+
+        # niftis removed (by another job) before they were marked as used
+        cached_fnames[0].unlink()
+        with pytest.raises(FileNotFoundError, match='not in the cache'):
+            cache_vbm([], cache_dir, cache_size=0, keep=cached_fnames)
+        assert cache_vbm(vbm_fnames[2:], cache_dir, cache_size=0,
+                         keep=cached_fnames) == cached_fnames
+        assert not any(x.suffix == '.tmp' for x in cache_dir.iterdir())
+
+
+def _create_cat_standin(monkeypatch, tmpdir, vbm_niftis):
+    """Local DataLad stand-in of the CAT dataset with the given niftis"""
+    import datalad.api as dl
+    for var in ['GIT_AUTHOR', 'GIT_COMMITTER']:
+        monkeypatch.setenv(f'{var}_NAME', 'confoundcontinuum')
+        monkeypatch.setenv(f'{var}_EMAIL', 'confoundcontinuum@example.com')
+    origin_dir = Path(tmpdir) / 'origin'
+    origin = dl.create(path=origin_dir)
+    (origin_dir / 'm0wp1').mkdir()
+    for i_sub, t_vbm in enumerate(vbm_niftis):
+        nib.save(t_vbm,
+                 origin_dir / 'm0wp1' / f'm0wp1sub-{i_sub}_ses-2_T1w.nii.gz')
+    origin.save()
+    return origin_dir
+
+
+@pytest.mark.skipif(
+    shutil.which('git-annex') is None, reason='git-annex is not installed')
+def test_dataset_files(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # distinct content (identical files share one annexed copy)
+        origin_dir = _create_cat_standin(
+            monkeypatch, tmpdir,
+            [vbm_nifti, nib.Nifti1Image(vbm_data + 1, vbm_affine)])
+
+        dataset_dir = Path(tmpdir) / 'node' / 'cat_m0wp1'
+        assert get_dataset(origin_dir.as_posix(), dataset_dir) == dataset_dir
+        # second job reuses the clone
+        get_dataset(origin_dir.as_posix(), dataset_dir)
+        fnames = sorted((dataset_dir / 'm0wp1').glob('*.nii.gz'))
+        assert not any(x.exists() for x in fnames)  # content not fetched
+        get_dataset_files(dataset_dir, fnames)
+        assert all(x.exists() for x in fnames)
+
+        # another job uses the first file: only the second one is dropped
+        fd = os.open(_get_dataset_lock_fname(dataset_dir, fnames[0]),
+                     os.O_RDWR)
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        assert drop_dataset_files(dataset_dir, fnames) == [fnames[1]]
+        assert fnames[0].exists() and not fnames[1].exists()
+        os.close(fd)
+        get_dataset_files(dataset_dir, fnames[:1])
+        assert drop_dataset_files(dataset_dir, fnames[:1]) == fnames[:1]
+        assert not fnames[0].exists()
+
+
+def test_roi_moments():
+    atlas_index = get_atlas_index(atlas_nifti, vbm_nifti)
+    values = get_roi_values(vbm_nifti, atlas_index)
+    moments = get_roi_moments(values, atlas_index)
+    for i_roi in range(len(atlas_index['rois'])):
+        roi_values = values[atlas_index['voxel_rois'] == i_roi]
+        assert moments['count'][i_roi] == roi_values.size
+        assert_array_almost_equal(moments['sum'][i_roi], roi_values.sum(), 4)
+        assert_array_almost_equal(
+            moments['sumsq'][i_roi], np.square(roi_values).sum(), 4)
+
+
+def test_get_gmd():
+    limits = [0.1, 0.1]
+    gmd, agg_func_params = get_gmd(atlas_nifti, vbm_nifti, limits=limits)
+    expected = _get_gmd_masked(atlas_nifti, vbm_nifti, limits)
+    assert agg_func_params['winsorized_mean']['limits'] == limits
+    for agg_name, agg_values in expected.items():
+        assert_array_almost_equal(gmd[agg_name], agg_values, 6)
+
+
+def test_get_gmd_order_statistics():
+    aggregation = [
+        'winsorized_mean', 'trimmed_mean', 'median', 'quantile_0.05',
+        'quantile_0.9']
+    for limits in [[0.1, 0.1], [0.05, 0.2], [0, 0.3], [0.25, 0]]:
+        atlas_index = get_atlas_index(atlas_nifti, vbm_nifti)
+        gmd, _ = get_gmd(
+            atlas_nifti, vbm_nifti, aggregation=aggregation, limits=limits,
+            atlas_index=atlas_index)
+        values = get_roi_values(vbm_nifti, atlas_index)
+        for i_roi in range(len(atlas_index['rois'])):
+            roi_values = values[atlas_index['voxel_rois'] == i_roi]
+            assert_array_almost_equal(
+                gmd['winsorized_mean'][i_roi],
+                winsorized_mean(roi_values, limits=limits), 6)
+            assert_array_almost_equal(
+                gmd['trimmed_mean'][i_roi],
+                trimmed_mean(roi_values, limits=limits), 6)
+            assert_array_almost_equal(
+                gmd['median'][i_roi], np.median(roi_values), 6)
+            assert_array_almost_equal(
+                gmd['quantile_0.05'][i_roi],
+                np.quantile(roi_values, 0.05), 6)
+            assert_array_almost_equal(
+                gmd['quantile_0.9'][i_roi], np.quantile(roi_values, 0.9), 6)
+
+
+def test_get_gmd_qc():
+    limits = [0.1, 0.2]
+    qc_data = vbm_data.copy()
+    qc_data[:3] = 0
+    qc_data[5, :4] = np.nan
+    qc_nifti = nib.Nifti1Image(qc_data, vbm_affine)
+    atlas_index = get_atlas_index(atlas_nifti, qc_nifti)
+    gmd, _ = get_gmd(
+        atlas_nifti, qc_nifti, limits=limits, atlas_index=atlas_index,
+        qc=True)
+    assert_array_almost_equal(
+        gmd['mean'], get_gmd(atlas_nifti, qc_nifti, limits=limits)[0]['mean'])
+
+    raw_values = qc_data.ravel(order='F')[atlas_index['voxels']]
+    for i_roi in range(len(atlas_index['rois'])):
+        roi_raw = raw_values[atlas_index['voxel_rois'] == i_roi]
+        roi_values = np.nan_to_num(roi_raw)
+        assert gmd['qc_n_voxels'][i_roi] == roi_raw.size
+        assert_array_almost_equal(
+            gmd['qc_zero_fraction'][i_roi], np.mean(roi_raw == 0))
+        assert_array_almost_equal(
+            gmd['qc_nonfinite_fraction'][i_roi], np.mean(np.isnan(roi_raw)))
+        assert gmd['qc_min'][i_roi] == roi_values.min()
+        assert gmd['qc_max'][i_roi] == roi_values.max()
+        # positions replaced by scipy (inclusive limits)
+        n_low = int(np.floor(limits[0] * roi_values.size))
+        n_up = int(np.floor(limits[1] * roi_values.size))
+        assert gmd['qc_n_winsorized'][i_roi] == n_low + n_up
+
+    # ungrouped index and empty ROIs
+    values = np.array([3., 1., 0., 2.])
+    index = {'rois': np.array([1, 2, 3]), 'voxel_rois': np.array([1, 0, 1, 0])}
+    roi_qc = get_roi_qc(values, index)
+    assert_array_equal(roi_qc['n_voxels'], [2, 2, 0])
+    assert_array_equal(roi_qc['min'], [1, 0, np.nan])
+    assert_array_equal(roi_qc['max'], [2, 3, np.nan])
+    assert_array_equal(roi_qc['zero_fraction'], [0, 0.5, np.nan])
+    assert 'n_winsorized' not in roi_qc
+
+
+def test_sort_roi_values():
+    atlas_index = get_atlas_index(atlas_nifti, vbm_nifti)
+    values = get_roi_values(vbm_nifti, atlas_index)
+    sorted_values, offsets = sort_roi_values(values, atlas_index)
+    assert offsets[-1] == values.size
+    for i_roi in range(len(atlas_index['rois'])):
+        assert_array_equal(
+            sorted_values[offsets[i_roi]:offsets[i_roi + 1]],
+            np.sort(values[atlas_index['voxel_rois'] == i_roi]))
+
+
+def test_get_gmd_atlases():
+    atlas_2mm = image.resample_to_img(
+        atlas_nifti, vbm_nifti, interpolation='nearest')
+    atlas_niftis = {'atlas_1mm': atlas_nifti, 'atlas_2mm': atlas_2mm}
+    aggregation = ['winsorized_mean', 'mean', 'std', 'median']
+    gmd_atlases, agg_func_params = get_gmd_atlases(
+        atlas_niftis, vbm_nifti, aggregation=aggregation, limits=[0.1, 0.2])
+    assert list(gmd_atlases.keys()) == list(atlas_niftis.keys())
+    assert agg_func_params['winsorized_mean']['limits'] == [0.1, 0.2]
+    for atlas_name, t_atlas in atlas_niftis.items():
+        gmd, _ = get_gmd(
+            t_atlas, vbm_nifti, aggregation=aggregation, limits=[0.1, 0.2])
+        for agg_name in aggregation:
+            assert_array_almost_equal(
+                gmd_atlases[atlas_name][agg_name], gmd[agg_name], 6)
+
+
+def test_get_gmd_subjects():
+    atlas_indexes = {'atlas': get_atlas_index(atlas_nifti, vbm_nifti)}
+    aggregation = ['winsorized_mean', 'mean', 'std']
+    with tempfile.TemporaryDirectory() as tmpdir:
+        vbm_fnames = []
+        expected = []
+        for i_sub in range(3):
+            t_vbm = nib.Nifti1Image(
+                rng.uniform(0, 1, size=vbm_data.shape).astype(np.float32),
+                vbm_affine)
+            vbm_fnames.append(Path(tmpdir) / f'vbm_{i_sub}.nii.gz')
+            nib.save(t_vbm, vbm_fnames[-1])
+            expected.append(get_gmd(
+                atlas_nifti, t_vbm, aggregation=aggregation)[0])
+
+        for n_jobs in [1, 2]:
+            gmd_subjects, agg_func_params = get_gmd_subjects(
+                vbm_fnames, atlas_indexes, aggregation=aggregation,
+                n_jobs=n_jobs)
+            assert agg_func_params['winsorized_mean']['limits'] == [0.1, 0.1]
+            assert len(gmd_subjects) == len(vbm_fnames)
+            for gmd_atlases, t_expected in zip(gmd_subjects, expected):
+                for agg_name in aggregation:
+                    assert_array_almost_equal(
+                        gmd_atlases['atlas'][agg_name], t_expected[agg_name],
+                        6)
+
+
+def test_get_gmd_subjects_main_script(tmp_path):
+    # the extraction scripts call get_gmd_subjects from __main__; the workers
+    # are forked (not started from the platform default, e.g. a fork server
+    # from Python 3.14) and must not run the script again
+    nib.save(atlas_nifti, tmp_path / 'atlas.nii.gz')
+    for i_sub in range(3):
+        nib.save(nib.Nifti1Image(
+            rng.uniform(0, 1, size=vbm_data.shape).astype(np.float32),
+            vbm_affine), tmp_path / f'vbm_{i_sub}.nii.gz')
+    script = tmp_path / 'extract.py'
+    script.write_text(textwrap.dedent(f"""
+        import multiprocessing
+        from pathlib import Path
+        import nibabel as nib
+        from confoundcontinuum.features import (
+            get_atlas_index, get_gmd_subjects)
+
+        if __name__ == '__main__':
+            multiprocessing.set_start_method('forkserver')
+            tmp_path = Path({str(tmp_path)!r})
+            with open(tmp_path / 'runs.txt', 'a') as f:
+                f.write('run\\n')
+            vbm_fnames = sorted(tmp_path.glob('vbm_*.nii.gz'))
+            atlas_indexes = {{'atlas': get_atlas_index(
+                nib.load(tmp_path / 'atlas.nii.gz'),
+                nib.load(vbm_fnames[0]))}}
+            gmd_subjects, _ = get_gmd_subjects(
+                vbm_fnames, atlas_indexes, aggregation=['mean'], n_jobs=2)
+            assert len(gmd_subjects) == 3
+    """))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [str(Path(confoundcontinuum.__file__).parents[1]),
+         os.environ.get('PYTHONPATH', '')]))
+    result = subprocess.run(
+        [sys.executable, str(script)], cwd=tmp_path, env=env,
+        capture_output=True, text=True, timeout=300)
+    assert result.returncode == 0, result.stderr
+    assert (tmp_path / 'runs.txt').read_text() == 'run\n'
+
+
+@pytest.mark.skipif(
+    shutil.which('git-annex') is None, reason='git-annex is not installed')
+def test_get_gmd_subjects_prefetch(monkeypatch):
+    atlas_indexes = {'atlas': get_atlas_index(atlas_nifti, vbm_nifti)}
+    vbm_niftis = [
+        nib.Nifti1Image(
+            rng.uniform(0, 1, size=vbm_data.shape).astype(np.float32),
+            vbm_affine)
+        for _ in range(4)]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        origin_dir = _create_cat_standin(monkeypatch, tmpdir, vbm_niftis)
+        dataset_dir = get_dataset(origin_dir.as_posix(), Path(tmpdir) / 'ds')
+        vbm_fnames = sorted((dataset_dir / 'm0wp1').glob('*.nii.gz'))
+
+        for n_jobs, prefetch in [(1, 0), (1, 2), (2, 1)]:
+            gmd_subjects, _ = get_gmd_subjects(
+                vbm_fnames, atlas_indexes, aggregation=['mean'],
+                n_jobs=n_jobs, dataset_dir=dataset_dir, prefetch=prefetch)
+            # all niftis were fetched, processed and dropped again
+            assert not any(x.exists() for x in vbm_fnames)
+            for gmd_atlases, t_vbm in zip(gmd_subjects, vbm_niftis):
+                assert_array_almost_equal(
+                    gmd_atlases['atlas']['mean'],
+                    get_gmd(None, t_vbm, aggregation=['mean'],
+                            atlas_index=atlas_indexes['atlas'])[0]['mean'],
+                    6)
+
+
+def test_shared_array():
+    shm, spec = _share_array(np.arange(10, dtype=np.int32))
+    try:
+        attached_shm, array = _attach_array(spec)
+        assert_array_equal(array, np.arange(10))
+        assert not array.flags.writeable
+        attached_shm.close()
+        # a process with its own resource tracker attaches untracked and
+        # exits: the block is neither reported as leaked nor unlinked by its
+        # tracker
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+            [str(Path(confoundcontinuum.__file__).parents[1]),
+             os.environ.get('PYTHONPATH', '')]))
+        result = subprocess.run(
+            [sys.executable, '-c',
+             'from confoundcontinuum.features import _attach_array; '
+             f'shm, array = _attach_array({spec!r}, track=False); '
+             'shm.close()'],
+            env=env, capture_output=True, text=True, timeout=300)
+        assert result.returncode == 0, result.stderr
+        assert 'leaked shared_memory' not in result.stderr
+        attached_shm, array = _attach_array(spec)
+        assert_array_equal(array, np.arange(10))
+        attached_shm.close()
+        # the register function of the tracker is not replaced while other
+        # threads may create resources
+        if sys.version_info < (3, 13):
+            thread = threading.Thread(target=time.sleep, args=(1, ))
+            thread.start()
+            try:
+                with pytest.raises(ValueError, match='single-threaded'):
+                    _attach_array(spec, track=False)
+            finally:
+                thread.join()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def test_map_vbm_fnames_failure(monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    import confoundcontinuum.features as ccfeatures
+
+    # niftis got and not dropped (fetches cancelled are never got)
+    in_use = set()
+    monkeypatch.setattr(
+        ccfeatures, 'get_dataset_files', lambda _, x: in_use.update(x))
+    monkeypatch.setattr(
+        ccfeatures, 'drop_dataset_files',
+        lambda _, x: in_use.difference_update(x))
+
+    def _process(fname):
+        if fname.name == 'vbm_2.nii.gz':
+            raise RuntimeError('processing failed')
+        return fname.name
+
+    vbm_fnames = [Path(f'vbm_{i_sub}.nii.gz') for i_sub in range(6)]
+    assert ccfeatures._map_vbm_fnames(
+        _process, vbm_fnames[:2], None, 1, 'ds', 2) == [
+            'vbm_0.nii.gz', 'vbm_1.nii.gz']
+    assert len(in_use) == 0
+    # the niftis fetched ahead and in process are dropped as well
+    for n_jobs in [1, 2]:
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            with pytest.raises(RuntimeError, match='processing failed'):
+                ccfeatures._map_vbm_fnames(
+                    _process, vbm_fnames, None if n_jobs == 1 else pool,
+                    n_jobs, 'ds', 2)
+        assert len(in_use) == 0
+
+
+def test_roi_stats_hierarchy():
+    atlas_index = get_atlas_index(atlas_nifti, vbm_nifti)
+    values = get_roi_values(vbm_nifti, atlas_index)
+    # parent parcellation merging ROIs 1, 2 and 3, 4, 5
+    parent_data = np.where(atlas_data == 0, 0, np.where(atlas_data < 3, 1, 2))
+    parent_nifti = nib.Nifti1Image(parent_data.astype(np.int16), atlas_affine)
+    parent_index = get_atlas_index(parent_nifti, vbm_nifti)
+    parent_rois = get_parent_rois(atlas_index, parent_index)
+    assert_array_equal(parent_rois, [1, 1, 2, 2, 2])
+
+    n_bins = 256
+    stats, _ = get_gmd(
+        atlas_nifti, vbm_nifti, atlas_index=atlas_index,
+        aggregation=['count', 'sum', 'sumsq', f'hist_{n_bins}'])
+    assert stats[f'hist_{n_bins}'].shape == (n_bins, 5)
+    assert_array_equal(stats[f'hist_{n_bins}'].sum(axis=0), stats['count'])
+    assert_array_equal(
+        stats[f'hist_{n_bins}'][:, 0],
+        histogram_sketch(values[atlas_index['voxel_rois'] == 0], n_bins))
+    stats['hist'] = stats.pop(f'hist_{n_bins}')
+
+    group_names, group_stats = aggregate_roi_stats(stats, parent_rois)
+    assert_array_equal(group_names, [1, 2])
+    stats_aggregated = get_stats_aggregation(
+        group_stats, ['mean', 'std', 'median', 'quantile_0.9'])
+    parent_values = get_roi_values(vbm_nifti, parent_index)
+    for i_parent in range(2):
+        roi_values = parent_values[parent_index['voxel_rois'] == i_parent]
+        assert_array_almost_equal(
+            stats_aggregated['mean'][i_parent], roi_values.mean(), 6)
+        assert_array_almost_equal(
+            stats_aggregated['std'][i_parent], roi_values.std(), 6)
+        # quantiles are exact up to the width of a bin
+        for agg_name, q in [('median', 0.5), ('quantile_0.9', 0.9)]:
+            assert abs(stats_aggregated[agg_name][i_parent] -
+                       np.quantile(roi_values, q)) <= 1 / n_bins
+
+    # the minimum is the lower edge of the first bin with a count
+    hist = histogram_sketch([0.5, 0.6, 0.9], 10)[:, None]
+    stats_aggregated = get_stats_aggregation(
+        {'hist': hist}, ['quantile_0', 'quantile_1'])
+    assert_array_almost_equal(stats_aggregated['quantile_0'], [0.5])
+    assert_array_almost_equal(stats_aggregated['quantile_1'], [1.])
+
+    # sketches of another value range
+    sorted_values, offsets = sort_roi_values(values, atlas_index)
+    hist_func = _get_funcbyname(
+        'hist_16', {'value_range': (-1., 3.)}, segmented=True)
+    assert_array_equal(
+        hist_func(sorted_values, offsets)[:, 0],
+        histogram_sketch(
+            values[atlas_index['voxel_rois'] == 0], 16, (-1., 3.)))
+
+
+def test_read_roi_stats():
+    atlas_index = get_atlas_index(atlas_nifti, vbm_nifti)
+    labels = ['LH_Vis_1', 'LH_Vis_2', 'LH_Default_1', 'RH_Vis_1',
+              'RH_Default_1']
+    aggregation = ['count', 'sum', 'sumsq', 'hist_8']
+    with tempfile.TemporaryDirectory() as tmpdir:
+        uri = f'sqlite:///{tmpdir}/stats.sqlite'
+        expected = {}
+        for subid in ['sub-2', 'sub-1']:
+            stats, _ = get_gmd(
+                atlas_nifti, vbm_nifti, atlas_index=atlas_index,
+                aggregation=aggregation)
+            expected[subid] = stats
+            for agg_name, agg_values in stats.items():
+                agg_values = np.reshape(agg_values, (-1, len(labels)))
+                index = pd.MultiIndex.from_product(
+                    [[subid], ['ses-2'], range(len(agg_values))],
+                    names=['SubjectID', 'Session', 'Bin'])
+                stat_df = pd.DataFrame(agg_values, index=index, columns=labels)
+                if agg_name != 'hist_8':
+                    stat_df = stat_df.droplevel('Bin')
+                save_features(
+                    stat_df, uri=uri, kind='gmd', atlas_name='test',
+                    agg_function=agg_name)
+
+        stats, index, t_labels = read_roi_stats(uri, 'test', n_bins=8)
+        assert t_labels == labels
+        assert index.get_level_values('SubjectID').to_list() == [
+            'sub-1', 'sub-2']
+        assert stats['hist'].shape == (2, 8, 5)
+        for i_sub, subid in enumerate(['sub-1', 'sub-2']):
+            for stat_name in ['count', 'sum', 'sumsq']:
+                assert_array_almost_equal(
+                    stats[stat_name][i_sub], expected[subid][stat_name])
+            assert_array_equal(stats['hist'][i_sub], expected[subid]['hist_8'])
+
+    networks = get_schaefer_networks(labels)
+    assert_array_equal(networks, ['Vis', 'Vis', 'Default', 'Vis', 'Default'])
+    assert_array_equal(
+        get_schaefer_networks(['7Networks_LH_Vis_1'], hemisphere=True),
+        ['LH_Vis'])
+    group_names, group_stats = aggregate_roi_stats(stats, networks)
+    assert_array_equal(group_names, ['Default', 'Vis'])
+    assert group_stats['hist'].shape == (2, 8, 2)
+    assert_array_almost_equal(
+        group_stats['sum'][:, 1], stats['sum'][:, [0, 1, 3]].sum(axis=1))
+
+
+def test_voxel_matrix():
+    atlas_index = get_atlas_index(atlas_nifti, vbm_nifti)
+    # mask without the first slice of the grid
+    mask_data = np.ones(vbm_data.shape, dtype=np.int8)
+    mask_data[0] = 0
+    mask_nifti = nib.Nifti1Image(mask_data, vbm_affine)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        vbm_fnames = []
+        expected = []
+        for i_sub in range(5):
+            t_data = rng.uniform(0, 1, size=vbm_data.shape).astype(np.float32)
+            t_data[0] = 0
+            t_vbm = nib.Nifti1Image(t_data, vbm_affine)
+            vbm_fnames.append(Path(tmpdir) / f'vbm_{i_sub}.nii.gz')
+            nib.save(t_vbm, vbm_fnames[-1])
+            expected.append(get_gmd(
+                atlas_nifti, t_vbm, aggregation=['mean', 'std'],
+                atlas_index=atlas_index)[0])
+        subject_ids = [(f'sub-{i_sub}', 'ses-2') for i_sub in range(5)]
+
+        build_voxel_matrix(
+            iter(vbm_fnames), subject_ids, mask_nifti, Path(tmpdir) / 'vm')
+        voxel_matrix = load_voxel_matrix(Path(tmpdir) / 'vm')
+        assert voxel_matrix['subject_ids'] == subject_ids
+        assert voxel_matrix['matrix'].shape == (mask_data.sum(), 5)
+        assert voxel_matrix['matrix'].flags.f_contiguous
+
+        projection = get_roi_projection(atlas_index, voxel_matrix)
+        # voxels outside of the mask are 0 in all VBM niftis
+        roi_aggregated = project_voxel_matrix(
+            voxel_matrix, projection, aggregation=['sum', 'sumsq'],
+            block_size=2)
+        for i_sub in range(5):
+            values = get_roi_values(
+                nib.load(vbm_fnames[i_sub]), atlas_index)
+            moments = get_roi_moments(values, atlas_index)
+            assert_array_almost_equal(
+                roi_aggregated['sum'][i_sub], moments['sum'], 4)
+            assert_array_almost_equal(
+                roi_aggregated['sumsq'][i_sub], moments['sumsq'], 4)
+
+        # all atlas voxels inside the mask -> identical to get_gmd
+        mask_data[0] = 1
+        build_voxel_matrix(
+            vbm_fnames, subject_ids, nib.Nifti1Image(mask_data, vbm_affine),
+            Path(tmpdir) / 'vm_all')
+        voxel_matrix = load_voxel_matrix(Path(tmpdir) / 'vm_all')
+        roi_aggregated = project_voxel_matrix(
+            voxel_matrix, get_roi_projection(atlas_index, voxel_matrix),
+            block_size=3)
+        for i_sub in range(5):
+            for agg_name in ['mean', 'std']:
+                assert_array_almost_equal(
+                    roi_aggregated[agg_name][i_sub],
+                    expected[i_sub][agg_name], 6)
+
+
+def test_correlate_voxel_matrix():
+    n_voxels, n_subjects = 7, 30
+    mask_data = (np.arange(vbm_data.size) < n_voxels).reshape(
+        vbm_data.shape, order='F')
+    matrix = rng.uniform(0, 1, size=(n_voxels, n_subjects))
+    matrix[3] = 0.5  # constant voxel
+    voxel_matrix = {
+        'matrix': np.asfortranarray(matrix, dtype=np.float32),
+        'voxels': np.arange(n_voxels), 'shape': vbm_data.shape,
+        'affine': vbm_affine}
+    confounds = pd.DataFrame({
+        'cont': rng.normal(size=n_subjects),
+        'binary': rng.randint(0, 2, size=n_subjects).astype(float),
+        'rank': rng.randint(0, 4, size=n_subjects).astype(float),
+    })
+    confounds.iloc[[1, 5], 0] = np.nan
+    confounds.iloc[[2, 7, 9], 2] = np.nan
+
+    corr, p_vals = correlate_voxel_matrix(
+        voxel_matrix, confounds, method=['pearson', 'pearson', 'spearman'],
+        block_size=3)
+    assert corr.shape == (n_voxels, 3)
+    assert np.isnan(corr[3]).all()
+    for i_voxel in [0, 1, 2, 4, 5, 6]:
+        for i_cnfd, corr_func in enumerate(
+                [stats.pearsonr, stats.pointbiserialr, stats.spearmanr]):
+            y = confounds.iloc[:, i_cnfd].to_numpy()
+            valid = ~np.isnan(y)
+            expected = corr_func(
+                voxel_matrix['matrix'][i_voxel, valid].astype(np.float64),
+                y[valid])
+            assert_array_almost_equal(corr[i_voxel, i_cnfd], expected[0], 5)
+            assert_array_almost_equal(p_vals[i_voxel, i_cnfd], expected[1], 5)
+
+    corr_nifti = voxel_matrix_to_nifti(corr, voxel_matrix)
+    assert corr_nifti.shape == (*vbm_data.shape, 3)
+    corr_data = corr_nifti.get_fdata()
+    for i_voxel in range(n_voxels):
+        assert_array_equal(
+            corr_data[np.unravel_index(i_voxel, vbm_data.shape, order='F')],
+            corr[i_voxel])
+    assert (corr_data[~mask_data] == 0).all()
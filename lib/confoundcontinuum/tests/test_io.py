@@ -1,8 +1,16 @@
+import os
 import pandas as pd
 from pandas.testing import assert_frame_equal
 import tempfile
 from sqlalchemy import create_engine
-from confoundcontinuum.io import _save_upsert, save_features, read_features
+import pytest
+import confoundcontinuum.io as ccio
+from confoundcontinuum.io import (
+    _save_upsert, save_features, read_features, FeatureShardWriter,
+    compact_feature_shards, list_feature_shards, read_feature_shards,
+    list_features, read_manifest, get_missing_features, get_engine,
+    dispose_engines, iter_features, read_shard_manifest,
+    get_missing_feature_shards)
 
 df1 = pd.DataFrame({
     'pk1': [1, 2, 3, 4, 5],
@@ -81,6 +89,49 @@ def test_upsert_delete():
         assert_frame_equal(c_dfupdate, df_update)
 
 
+def test_upsert_duplicates():
+    with tempfile.TemporaryDirectory() as _tmpdir:
+        uri = f'sqlite:///{_tmpdir}/test.db'
+        engine = create_engine(uri, echo=False)
+        # table appended twice without key
+        df1.to_sql(name=table_name, con=engine, if_exists='replace')
+        df1.iloc[:2].assign(col1=0).to_sql(
+            name=table_name, con=engine, if_exists='append')
+
+        # duplicated rows are only deleted on request
+        with pytest.raises(ValueError, match='deduplicate=True'):
+            _save_upsert(df2, table_name, engine, upsert='ignore')
+        c_df = pd.read_sql(table_name, con=engine, index_col=index_col)
+        assert len(c_df) == 7
+
+        # the first duplicates are kept (as by upsert='ignore'), then rows
+        # are upserted
+        _save_upsert(df2, table_name, engine, upsert='ignore',
+                     deduplicate=True)
+        c_df = pd.read_sql(table_name, con=engine, index_col=index_col)
+        assert_frame_equal(c_df.sort_index(), df_ignore)
+
+        # duplicated rows of one frame: the last one is saved
+        _save_upsert(pd.concat([df2, df2.assign(col1=0)]), table_name,
+                     engine, upsert='delete')
+        c_df = pd.read_sql(table_name, con=engine, index_col=index_col)
+        assert len(c_df) == 6
+        assert c_df.loc[df2.index, 'col1'].tolist() == [0, 0, 0]
+
+        with pytest.raises(ValueError, match='if_exist'):
+            _save_upsert(df2, table_name, engine, if_exist='fail')
+
+        # the most recent duplicates are kept by save_features
+        df1.to_sql(name='vbm$atlas1$mean', con=engine, if_exists='replace')
+        df1.iloc[:2].assign(col1=0).to_sql(
+            name='vbm$atlas1$mean', con=engine, if_exists='append')
+        save_features(df2, uri, 'vbm', 'atlas1', 'mean', deduplicate=True)
+        assert_frame_equal(
+            read_features(uri, 'vbm', 'atlas1', index_col=index_col,
+                          agg_function='mean').sort_index(),
+            df_update.assign(col1=[0, 2222, 33, 44, 5555, 66]))
+
+
 def test_io_features():
     with tempfile.TemporaryDirectory() as _tmpdir:
         uri = f'sqlite:///{_tmpdir}/test.db'
@@ -98,3 +149,361 @@ def test_io_features():
             uri, 'vbm', 'schaefer_2010_100', index_col=index_col,
             agg_function='mean')
         assert_frame_equal(c_dfupdate, df_update)
+
+
+def test_engines(monkeypatch):
+    monkeypatch.setattr(ccio, '_max_engines', 2)
+    dispose_engines()
+    with tempfile.TemporaryDirectory() as _tmpdir:
+        uris = [f'sqlite:///{_tmpdir}/test{i}.db' for i in range(3)]
+        engine = get_engine(uris[0])
+        assert get_engine(uris[0]) is engine
+        with engine.connect() as con:
+            assert con.exec_driver_sql(
+                'PRAGMA busy_timeout').scalar() == 60000
+        # other pragmas are another engine
+        engine_wal = get_engine(uris[0], pragmas={'journal_mode': 'WAL'})
+        assert engine_wal is not engine
+        with engine_wal.connect() as con:
+            assert con.exec_driver_sql(
+                'PRAGMA journal_mode').scalar() == 'wal'
+
+        # the least recently used engine is disposed
+        get_engine(uris[0])
+        get_engine(uris[1])
+        assert list(ccio._engines) == [
+            (uris[0], tuple(sorted(ccio._sqlite_pragmas.items()))),
+            (uris[1], tuple(sorted(ccio._sqlite_pragmas.items())))]
+        save_features(df1, uris[2], 'vbm', 'atlas1', 'mean')
+        assert len(ccio._engines) == 2
+        assert_frame_equal(
+            read_features(uris[2], 'vbm', 'atlas1', index_col, 'mean'), df1)
+        with pytest.raises(ValueError, match='not found'):
+            read_features(uris[2], 'vbm', 'atlas1', index_col, 'std')
+
+        # a replaced database file is not read through the old engine
+        engine = get_engine(uris[2])
+        os.remove(f'{_tmpdir}/test2.db')
+        save_features(df2, uris[2], 'vbm', 'atlas1', 'mean')
+        assert get_engine(uris[2]) is not engine
+        assert_frame_equal(
+            read_features(uris[2], 'vbm', 'atlas1', index_col, 'mean'), df2)
+
+        dispose_engines()
+        assert len(ccio._engines) == 0
+
+
+def test_save_features_batches(monkeypatch):
+    df_subjects = pd.DataFrame({
+        'SubjectID': ['sub-1', 'sub-2', 'sub-3'],
+        'Session': ['ses-2', 'ses-2', 'ses-2'],
+        'col1': [1., float('nan'), 3.],
+        'col2': [1, 2, 3],
+        'col3': ['a', None, 'c'],
+    }).set_index(['SubjectID', 'Session'])
+    with tempfile.TemporaryDirectory() as _tmpdir:
+        uri = f'sqlite:///{_tmpdir}/test.db'
+        save_features(df_subjects, uri, 'vbm', 'atlas1', 'mean',
+                      chunksize=2, manifest={})
+        assert_frame_equal(
+            read_features(uri, 'vbm', 'atlas1', ['SubjectID', 'Session'],
+                          'mean'), df_subjects)
+        assert len(read_manifest(uri)) == 3
+
+        # the manifest is written with the batch of its subjects
+        insert_rows = ccio._insert_rows
+
+        def _fail(con, name, df):
+            if 'sub-3' in df.index.get_level_values('SubjectID'):
+                raise RuntimeError('failed batch')
+            insert_rows(con, name, df)
+        with monkeypatch.context() as m:
+            m.setattr(ccio, '_insert_rows', _fail)
+            with pytest.raises(RuntimeError, match='failed batch'):
+                save_features(df_subjects, uri, 'vbm', 'atlas1', 'std',
+                              chunksize=2, manifest={})
+        manifest = read_manifest(uri).query('agg_function == "std"')
+        assert manifest['SubjectID'].tolist() == ['sub-1', 'sub-2']
+        assert len(read_features(uri, 'vbm', 'atlas1',
+                                 ['SubjectID', 'Session'], 'std')) == 2
+
+        with pytest.raises(ValueError, match='chunksize'):
+            save_features(df_subjects, uri, 'vbm', 'atlas1', 'mean',
+                          chunksize=0)
+
+        # scratch databases are written with a write-ahead log
+        uri = f'sqlite:///{_tmpdir}/scratch.db'
+        save_features(df_subjects, uri, 'vbm', 'atlas1', 'mean',
+                      scratch=True)
+        with get_engine(uri).connect() as con:
+            assert con.exec_driver_sql(
+                'PRAGMA journal_mode').scalar() == 'wal'
+        assert_frame_equal(
+            read_features(uri, 'vbm', 'atlas1', ['SubjectID', 'Session'],
+                          'mean'), df_subjects)
+
+
+def test_read_features_selection(monkeypatch):
+    df_subjects = pd.DataFrame({
+        'SubjectID': ['sub-1', 'sub-1', 'sub-2', 'sub-3'],
+        'Session': ['ses-2', 'ses-3', 'ses-2', 'ses-2'],
+        'col1': [1., 2., 3., 4.],
+        'col2': [5., 6., 7., 8.],
+        'col 3': [9., 10., 11., 12.],
+    }).set_index(['SubjectID', 'Session'])
+    index_names = ['SubjectID', 'Session']
+    with tempfile.TemporaryDirectory() as _tmpdir:
+        uri = f'sqlite:///{_tmpdir}/test.db'
+        save_features(df_subjects, uri, 'vbm', 'atlas1', 'mean')
+
+        assert_frame_equal(
+            read_features(uri, 'vbm', 'atlas1', index_names, 'mean',
+                          columns=['col 3', 'col1']),
+            df_subjects[['col 3', 'col1']])
+        assert_frame_equal(
+            read_features(uri, 'vbm', 'atlas1', index_names, 'mean',
+                          sessions=['ses-2']),
+            df_subjects.query('Session == "ses-2"'))
+        assert_frame_equal(
+            read_features(uri, 'vbm', 'atlas1', index_names, 'mean',
+                          subjects=['sub-3', 'sub-1', 'sub-9'],
+                          sessions=['ses-2'], columns=['col2']),
+            df_subjects.loc[[('sub-1', 'ses-2'), ('sub-3', 'ses-2')],
+                            ['col2']])
+        assert len(read_features(uri, 'vbm', 'atlas1', index_names, 'mean',
+                                 subjects=[])) == 0
+
+        # long ID lists are matched against a temporary table
+        monkeypatch.setattr(ccio, '_max_in_values', 1)
+        assert_frame_equal(
+            read_features(uri, 'vbm', 'atlas1', index_names, 'mean',
+                          subjects=['sub-3', 'sub-1', 'sub-1'],
+                          sessions=['ses-2']),
+            df_subjects.loc[[('sub-1', 'ses-2'), ('sub-3', 'ses-2')]])
+        with get_engine(uri).connect() as con:
+            assert con.exec_driver_sql(
+                'SELECT count(*) FROM sqlite_temp_master').scalar() == 0
+
+
+def test_iter_features(monkeypatch):
+    df_subjects = pd.DataFrame({
+        'SubjectID': [f'sub-{i}' for i in range(7)],
+        'Session': ['ses-2'] * 6 + ['ses-3'],
+        'col1': [1., None, None, None, 5., 6., 7.],
+        'col2': [1, 2, 3, 4, 5, 6, 7],
+    }).set_index(['SubjectID', 'Session'])
+    index_names = ['SubjectID', 'Session']
+    with tempfile.TemporaryDirectory() as _tmpdir:
+        uri = f'sqlite:///{_tmpdir}/test.db'
+        save_features(df_subjects, uri, 'vbm', 'atlas1', 'mean')
+
+        chunks = list(iter_features(
+            uri, 'vbm', 'atlas1', index_names, 'mean', chunksize=3))
+        assert [len(x) for x in chunks] == [3, 3, 1]
+        # the dtypes do not depend on the values of a chunk
+        for t_chunk in chunks:
+            assert t_chunk.index.names == index_names
+            assert t_chunk.dtypes.to_dict() == {
+                'col1': 'float64', 'col2': 'Int64'}
+        assert_frame_equal(
+            pd.concat(chunks),
+            df_subjects.astype({'col2': 'Int64'}))
+
+        chunks = list(iter_features(
+            uri, 'vbm', 'atlas1', index_names, 'mean', chunksize=2,
+            sessions=['ses-2'], columns=['col1']))
+        assert_frame_equal(
+            pd.concat(chunks), df_subjects.iloc[:6, :1])
+        empty = list(iter_features(
+            uri, 'vbm', 'atlas1', index_names, 'mean', subjects=[]))
+        assert len(empty) == 1 and len(empty[0]) == 0
+        assert empty[0].dtypes.to_dict() == {
+            'col1': 'float64', 'col2': 'Int64'}
+
+        # temporary tables are dropped when the iteration is stopped early
+        monkeypatch.setattr(ccio, '_max_in_values', 1)
+        chunks = iter_features(
+            uri, 'vbm', 'atlas1', index_names, 'mean', chunksize=1,
+            subjects=['sub-1', 'sub-2'])
+        assert_frame_equal(next(chunks), df_subjects.iloc[[1]].astype(
+            {'col2': 'Int64'}))
+        chunks.close()
+        with get_engine(uri).connect() as con:
+            assert con.exec_driver_sql(
+                'SELECT count(*) FROM sqlite_temp_master').scalar() == 0
+
+        with pytest.raises(ValueError, match='chunksize'):
+            next(iter_features(
+                uri, 'vbm', 'atlas1', index_names, 'mean', chunksize=0))
+        with pytest.raises(ValueError, match='not found'):
+            next(iter_features(uri, 'vbm', 'atlas2', index_names, 'mean'))
+
+
+def test_feature_shards():
+    with tempfile.TemporaryDirectory() as _tmpdir:
+        shard_dir = f'{_tmpdir}/shards'
+        # two workers, one row group per subject
+        with FeatureShardWriter(shard_dir, 'worker1') as writer:
+            for i in range(3):
+                writer.write(df1.iloc[[i]], 'vbm', 'schaefer_2010_100', 'mean')
+            writer.write(df1, 'vbm', 'schaefer_2010_100', 'std')
+            with pytest.raises(ValueError, match='do not match'):
+                writer.write(
+                    df1[['col1']], 'vbm', 'schaefer_2010_100', 'std')
+        # not visible before closing
+        writer = FeatureShardWriter(shard_dir, 'worker2')
+        writer.write(df1.iloc[3:], 'vbm', 'schaefer_2010_100', 'mean')
+        writer.write(df2, 'vbm', 'schaefer_2010_100', 'mean')
+        assert list_feature_shards(shard_dir)['n_shards'].tolist() == [1, 1]
+        writer.close()
+        with pytest.raises(ValueError, match='already exists'):
+            with FeatureShardWriter(shard_dir, 'worker2') as writer:
+                writer.write(df2, 'vbm', 'schaefer_2010_100', 'mean')
+
+        features = list_feature_shards(shard_dir)
+        assert features['agg_function'].tolist() == ['mean', 'std']
+        assert features['n_shards'].tolist() == [2, 1]
+        # rows of the most recent shard are kept
+        assert_frame_equal(
+            read_feature_shards(
+                shard_dir, 'vbm', 'schaefer_2010_100', 'mean').sort_index(),
+            df_update)
+
+        uri = f'sqlite:///{_tmpdir}/test.db'
+        save_features(df2, uri, 'vbm', 'schaefer_2010_100', 'std')
+        compacted = compact_feature_shards(shard_dir, uri)
+        assert compacted['n_rows'].tolist() == [6, 5]
+        assert_frame_equal(
+            read_features(uri, 'vbm', 'schaefer_2010_100',
+                          index_col=index_col, agg_function='std'),
+            df1)
+
+
+def test_manifest():
+    df_subjects = pd.DataFrame({
+        'SubjectID': ['sub-1', 'sub-1', 'sub-2'],
+        'Session': ['ses-2', 'ses-3', 'ses-2'],
+        'col1': [1., 2., 3.],
+    }).set_index(['SubjectID', 'Session'])
+    params = {'limits': [0.1, 0.1]}
+    with tempfile.TemporaryDirectory() as _tmpdir:
+        uri = f'sqlite:///{_tmpdir}/test.db'
+        assert len(read_manifest(uri)) == 0
+        missing = get_missing_features(
+            uri, df_subjects.index, 'vbm', ['atlas1', 'atlas2'], ['mean'],
+            params)
+        assert len(missing) == 6
+
+        save_features(df_subjects.iloc[:2], uri, 'vbm', 'atlas1', 'mean',
+                      manifest=params)
+        # saving again keeps the manifest unique
+        save_features(df_subjects.iloc[:2], uri, 'vbm', 'atlas1', 'mean',
+                      if_exist='replace', manifest=params)
+        manifest = read_manifest(uri)
+        assert len(manifest) == 2
+        assert manifest['params'].unique().tolist() == [
+            '{"limits": [0.1, 0.1]}']
+        # the manifest is not a feature table
+        assert list_features(uri)['atlas_name'].tolist() == ['atlas1']
+
+        missing = get_missing_features(
+            uri, df_subjects.index, 'vbm', ['atlas1', 'atlas2'], ['mean'],
+            params)
+        assert missing[['SubjectID', 'atlas_name']].values.tolist() == [
+            ['sub-1', 'atlas2'], ['sub-1', 'atlas2'], ['sub-2', 'atlas1'],
+            ['sub-2', 'atlas2']]
+        # other parameters are missing completely
+        missing = get_missing_features(
+            uri, df_subjects.index, 'vbm', ['atlas1'], ['mean'])
+        assert len(missing) == 3
+
+        # replacing the table with fewer subjects forgets the replaced ones
+        save_features(df_subjects, uri, 'vbm', 'atlas2', 'mean',
+                      manifest=params)
+        save_features(df_subjects.iloc[2:], uri, 'vbm', 'atlas1', 'mean',
+                      if_exist='replace', manifest=params)
+        missing = get_missing_features(
+            uri, df_subjects.index, 'vbm', ['atlas1', 'atlas2'], ['mean'],
+            params)
+        assert missing[['SubjectID', 'Session', 'atlas_name']].values.tolist(
+            ) == [['sub-1', 'ses-2', 'atlas1'], ['sub-1', 'ses-3', 'atlas1']]
+        # also without a manifest of the new table
+        save_features(df_subjects.iloc[:1], uri, 'vbm', 'atlas2', 'mean',
+                      if_exist='replace')
+        assert read_manifest(uri)['atlas_name'].tolist() == ['atlas1']
+
+
+def test_insert_manifest(monkeypatch):
+    rows = ccio._get_manifest_rows(
+        pd.MultiIndex.from_tuples(
+            [('sub-1', 'ses-2'), ('sub-2', 'ses-2')],
+            names=['SubjectID', 'Session']), 'vbm', 'atlas1', 'mean', {})
+    later_rows = [dict(x, completed='later') for x in rows]
+    # the ON CONFLICT construct of the dialect, or of no dialect
+    for dialect_inserts in [ccio._dialect_inserts, {}]:
+        monkeypatch.setattr(ccio, '_dialect_inserts', dialect_inserts)
+        with tempfile.TemporaryDirectory() as _tmpdir:
+            uri = f'sqlite:///{_tmpdir}/test.db'
+            with get_engine(uri).begin() as con:
+                ccio._insert_manifest(con, rows[:1])
+                ccio._insert_manifest(con, later_rows)
+            # the first completion is kept
+            assert read_manifest(uri)['completed'].tolist() == [
+                rows[0]['completed'], 'later']
+    monkeypatch.undo()
+    sql = str(ccio._dialect_inserts['postgresql'](
+        ccio._get_manifest_table(ccio.MetaData())).on_conflict_do_nothing(
+        ).compile(dialect=ccio.postgresql.dialect()))
+    assert sql.endswith('ON CONFLICT DO NOTHING')
+
+
+def test_shard_manifest():
+    df_subjects = pd.DataFrame({
+        'SubjectID': ['sub-1', 'sub-1', 'sub-2'],
+        'Session': ['ses-2', 'ses-3', 'ses-2'],
+        'col1': [1., 2., 3.],
+    }).set_index(['SubjectID', 'Session'])
+    params = {'atlas_resolution': 1}
+    with tempfile.TemporaryDirectory() as _tmpdir:
+        shard_dir = f'{_tmpdir}/shards'
+        assert len(read_shard_manifest(shard_dir)) == 0
+        with FeatureShardWriter(shard_dir, 'worker1') as writer:
+            writer.write(df_subjects.iloc[:2], 'vbm', 'atlas1', 'mean',
+                         manifest=params)
+            # not visible before closing
+            assert len(read_shard_manifest(shard_dir)) == 0
+        with FeatureShardWriter(shard_dir, 'worker2') as writer:
+            writer.write(df_subjects.iloc[1:], 'vbm', 'atlas1', 'mean',
+                         manifest=params)
+            writer.write(df_subjects, 'vbm', 'atlas2', 'mean')
+        # the manifest is not a feature table
+        assert list_feature_shards(shard_dir)['atlas_name'].tolist() == [
+            'atlas1', 'atlas2']
+        manifest = read_shard_manifest(shard_dir)
+        assert len(manifest) == 3
+        assert manifest['params'].unique().tolist() == [
+            '{"atlas_resolution": 1}']
+
+        missing = get_missing_feature_shards(
+            shard_dir, df_subjects.index, 'vbm', ['atlas1', 'atlas2'],
+            ['mean'], params)
+        assert missing['atlas_name'].tolist() == ['atlas2'] * 3
+        missing = get_missing_feature_shards(
+            shard_dir, df_subjects.index, 'vbm', ['atlas1'], ['mean'],
+            {'atlas_resolution': 2})
+        assert len(missing) == 3
+
+        # the compacted database continues with the manifest of the shards
+        uri = f'sqlite:///{_tmpdir}/test.db'
+        save_features(df_subjects.iloc[:1], uri, 'vbm', 'atlas2', 'mean',
+                      manifest=params)
+        compact_feature_shards(shard_dir, uri)
+        assert_frame_equal(
+            read_manifest(uri).drop(columns='completed').sort_values(
+                ['SubjectID', 'Session']).reset_index(drop=True),
+            manifest.drop(columns='completed').sort_values(
+                ['SubjectID', 'Session']).reset_index(drop=True))
+        missing = get_missing_features(
+            uri, df_subjects.index, 'vbm', ['atlas1', 'atlas2'], ['mean'],
+            params)
+        assert missing['atlas_name'].tolist() == ['atlas2'] * 3
@@ -0,0 +1,193 @@
+import sys
+
+import pytest
+
+from confoundcontinuum.jobs import (
+    get_dag_jobs, get_resource_requests, get_submit_jobs, read_job_resources,
+    run_jobs)
+
+_log = """000 (101.000.000) 2023-03-02 10:35:40 Job submitted from host: <host>
+...
+001 (101.000.000) 2023-03-02 10:35:41 Job executing on host: <host>
+...
+006 (101.000.000) 2023-03-02 10:36:41 Image size of job updated: 1000
+\t1000  -  MemoryUsage of job (MB)
+...
+005 (101.000.000) 2023-03-02 10:37:46 Job terminated.
+\t(1) Normal termination (return value {return_value})
+\t\tUsr 0 00:02:06, Sys 0 00:00:05  -  Run Remote Usage
+\tPartitionable Resources :    Usage  Request Allocated
+\t   Cpus                 :     0.98         1         1
+\t   Disk (KB)            :   {disk}       500    123456
+\t   Memory (MB)          :   {memory}      1639      1664
+
+\tJob terminated of its own accord at 2023-03-02T09:37:46Z.
+...
+"""
+
+
+def test_job_resources(tmp_path):
+    resources = read_job_resources(tmp_path)
+    assert len(resources) == 0
+    assert get_resource_requests(resources) == {
+        'request_cpus': 1, 'request_memory': 1639, 'request_disk': 500}
+
+    for i_job, memory in enumerate([900, 1000, 1100, 5000]):
+        with open(tmp_path / f'job{i_job}.log', 'w') as f:
+            f.write(_log.format(
+                return_value=0 if memory < 5000 else 1, disk=100 * (i_job + 1),
+                memory=memory))
+    resources = read_job_resources(tmp_path)
+    assert resources['memory_mb'].tolist() == [900, 1000, 1100, 5000]
+    assert resources['return_value'].tolist() == [0, 0, 0, 1]
+    assert resources['cpus_request'].tolist() == [1, 1, 1, 1]
+
+    # failed jobs are not used
+    assert get_resource_requests(resources, quantile=1, margin=1.5) == {
+        'request_cpus': 1, 'request_memory': 1650, 'request_disk': 450}
+    assert get_resource_requests(
+        resources, quantile=0.5, margin=1)['request_memory'] == 1000
+
+    with pytest.raises(ValueError, match='margin'):
+        get_resource_requests(resources, margin=0.5)
+
+
+_job_script = """import sys
+import time
+from pathlib import Path
+name, n_mb = sys.argv[1], int(sys.argv[2])
+data = bytearray(n_mb * 2**20)
+if name == 'memory':
+    time.sleep(2)  # killed before
+# fail on the first attempt
+marker = Path(f'{name}.attempt')
+if name == 'retry' and not marker.exists():
+    marker.touch()
+    sys.exit(3)
+print(name, n_mb)
+sys.exit(1 if name == 'fail' else 0)
+"""
+
+_submit = """# The environment
+universe = vanilla
+getenv = True
+
+# Resources
+request_cpus = 1
+request_memory = {memory}
+
+initial_dir = {tmp_path}
+executable = {python}
+arguments = "job.py '$(name)' $(n_mb)"
+
+output = $(initial_dir)/$(name).out
+error = $(initial_dir)/$(name).err
+queue {queue}
+"""
+
+
+def test_get_jobs(tmp_path):
+    with open(tmp_path / 'job_options.txt', 'w') as f:
+        f.write('a 10\nb 20\n')
+    with open(tmp_path / 'job.submit', 'w') as f:
+        f.write(_submit.format(
+            memory='1.5G', tmp_path=tmp_path, python=sys.executable,
+            queue='name n_mb from $(initial_dir)/job_options.txt'))
+    jobs = get_submit_jobs(tmp_path / 'job.submit')
+    assert [x['name'] for x in jobs] == ['job.0', 'job.1']
+    assert jobs[1]['arguments'] == ['job.py', 'b', '20']
+    assert jobs[1]['output'] == tmp_path / 'b.out'
+    assert jobs[0]['request_memory'] == 1536
+
+    with open(tmp_path / 'job.dag', 'w') as f:
+        f.write(
+            f'JOB job0 {tmp_path}/single.submit\n'
+            'VARS job0 name="a" n_mb="10"\n'
+            f'JOB job1 {tmp_path}/single.submit\n'
+            'VARS job1 name="b" n_mb="20"\n'
+            'RETRY job1 2\n'
+            'PARENT job0 CHILD job1\n')
+    with open(tmp_path / 'single.submit', 'w') as f:
+        f.write(_submit.format(
+            memory=100, tmp_path=tmp_path, python=sys.executable, queue=''))
+    jobs = get_dag_jobs(tmp_path / 'job.dag')
+    assert [x['name'] for x in jobs] == ['job0', 'job1']
+    assert jobs[1]['arguments'] == ['job.py', 'b', '20']
+    assert jobs[1]['retries'] == 2
+    assert jobs[1]['parents'] == ['job0']
+
+    with open(tmp_path / 'job.dag', 'a') as f:
+        f.write('SUBDAG EXTERNAL job2 other.dag\n')
+    with pytest.raises(ValueError, match='Unsupported DAG command'):
+        get_dag_jobs(tmp_path / 'job.dag')
+
+
+def test_run_jobs(tmp_path):
+    with open(tmp_path / 'job.py', 'w') as f:
+        f.write(_job_script)
+    with open(tmp_path / 'single.submit', 'w') as f:
+        f.write(_submit.format(
+            memory=200, tmp_path=tmp_path, python=sys.executable, queue=''))
+    with open(tmp_path / 'job.dag', 'w') as f:
+        for name, n_mb in [
+                ('ok', 10), ('retry', 10), ('fail', 10), ('child', 10),
+                ('memory', 400)]:
+            f.write(f'JOB {name} {tmp_path}/single.submit\n'
+                    f'VARS {name} name="{name}" n_mb="{n_mb}"\n')
+        f.write('PARENT fail CHILD child\n')
+    jobs = get_dag_jobs(tmp_path / 'job.dag')
+
+    results = run_jobs(
+        jobs, n_cpus=1, memory=1000, retries=1, poll_interval=0.05)
+    results = results.set_index('name')
+    assert results['status'].to_dict() == {
+        'ok': 'done', 'retry': 'done', 'fail': 'failed', 'child': 'skipped',
+        'memory': 'memory_exceeded'}
+    assert results['attempts'].to_dict() == {
+        'ok': 1, 'retry': 2, 'fail': 2, 'child': 0, 'memory': 2}
+    assert results.loc['ok', 'peak_rss_mb'] > 10
+    assert results.loc['memory', 'peak_rss_mb'] > 200
+    assert results.loc['ok', 'wall_time'] > 0
+    with open(tmp_path / 'ok.out') as f:
+        assert f.read() == 'ok 10\n'
+
+
+def test_run_jobs_dag_nodes(tmp_path):
+    with open(tmp_path / 'job.py', 'w') as f:
+        f.write(_job_script)
+    with open(tmp_path / 'queue.submit', 'w') as f:
+        f.write(_submit.format(
+            memory=200, tmp_path=tmp_path, python=sys.executable,
+            queue='2').replace("$(name)'", "$(name)$(process)'"))
+    with open(tmp_path / 'missing.submit', 'w') as f:
+        f.write(_submit.format(
+            memory=200, tmp_path=tmp_path, python=tmp_path / 'nonexistent',
+            queue=''))
+    with open(tmp_path / 'job.dag', 'w') as f:
+        f.write(f'JOB parent {tmp_path}/queue.submit\n'
+                'VARS parent name="ok" n_mb="10"\n'
+                f'JOB child {tmp_path}/queue.submit\n'
+                'VARS child name="child" n_mb="10"\n'
+                f'JOB missing {tmp_path}/missing.submit\n'
+                'VARS missing name="missing" n_mb="10"\n'
+                'RETRY missing 1\n'
+                f'JOB after {tmp_path}/queue.submit\n'
+                'VARS after name="after" n_mb="10"\n'
+                'PARENT parent CHILD child\n'
+                'PARENT missing CHILD after\n')
+    jobs = get_dag_jobs(tmp_path / 'job.dag')
+
+    results = run_jobs(jobs, n_cpus=1, memory=1000, poll_interval=0.05)
+    results = results.set_index('name')
+    # the children of a node wait for all jobs queued by the node
+    assert results['status'].to_dict() == {
+        'parent.0': 'done', 'parent.1': 'done', 'child.0': 'done',
+        'child.1': 'done', 'missing': 'failed', 'after.0': 'skipped',
+        'after.1': 'skipped'}
+    # an executable that cannot be started fails (and is retried)
+    assert results.loc['missing', 'attempts'] == 2
+    assert results['returncode'].isna().to_dict() == {
+        'parent.0': False, 'parent.1': False, 'child.0': False,
+        'child.1': False, 'missing': True, 'after.0': True, 'after.1': True}
+    with open(tmp_path / 'missing.err') as f:
+        assert 'nonexistent' in f.read()
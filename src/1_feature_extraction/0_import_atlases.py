@@ -0,0 +1,98 @@
+# %%
+# import packages
+import os
+from pathlib import Path
+import time
+from argparse import ArgumentParser
+
+from confoundcontinuum.logging import configure_logging, log_versions
+from confoundcontinuum.logging import logger, raise_error
+import confoundcontinuum.atlases as atl
+
+# %%
+# configure logging
+
+configure_logging()
+log_versions()
+
+# %%
+# set up
+
+# RUN THINGS IN ROOT DIRECTORY OF PROJECT!
+project_dir = Path(os.getcwd())
+default_store_dir = project_dir / 'data' / 'masks' / 'atlas_store'
+
+# pipeline help (parser)
+parser = ArgumentParser(
+    description='Import atlases once into a local content-addressed atlas '
+    'store (files stored by their SHA-256 checksum). Pass the store as '
+    '--atlasdir to the feature extraction scripts to resolve the atlases '
+    'from it without network access and without copying them per job. '
+    'INPUT parameters optional: --store, --atlasnames, --atlasdir, '
+    '--verify. '
+    'See parameter help for more information.'
+)
+
+# atlas store
+parser.add_argument(
+    '--store', metavar='store', type=str, default=default_store_dir,
+    help='Path of the atlas store (created if missing). '
+         f'Defaults to {default_store_dir}')
+
+# atlas names
+parser.add_argument(
+    '--atlasnames', metavar='atlasnames', type=str, nargs='+', default=None,
+    help='Atlas names to import. Specify by name of atlas as listed in '
+         'confoundcontinuum.atlases.list_atlases(), e.g. Schaefer100x7 '
+         'Tian4x3TxMNInonlinear2009cAsym SUITxMNI. Defaults to all atlases.')
+
+# atlas directory
+parser.add_argument(
+    '--atlasdir', metavar='atlasdir', type=str, default=None,
+    help='Path where to find (or download) the atlases to import. Defaults '
+         'to $HOME/junifer/data/atlas.')
+
+# only verify the store
+parser.add_argument(
+    '--verify', action='store_true',
+    help='Only verify the checksums of all files in the store.')
+
+# pass input parameters to variables
+args = parser.parse_args()
+store_dir = Path(args.store)
+atlas_names = args.atlasnames
+atlas_dir = None if args.atlasdir is None else Path(args.atlasdir)
+verify_only = args.verify
+
+# check parsed arguments and give user info
+if atlas_names is None:
+    atlas_names = atl.list_atlases()
+invalid_atlases = [x for x in atlas_names if x not in atl.list_atlases()]
+if len(invalid_atlases) > 0:
+    raise_error(
+        f'Invalid atlas names {invalid_atlases}. Valid atlases: '
+        f'{atl.list_atlases()}.')
+
+# %%
+# import atlases and verify the store
+
+start_time = time.time()
+
+if not verify_only:
+    logger.info(f'Import atlases {atlas_names} into {store_dir}.')
+    index = atl.import_atlases(store_dir, atlas_names, atlas_dir)
+    logger.info(f'{len(index)} files in the atlas store.')
+
+invalid_fnames = atl.verify_atlas_store(store_dir)
+if len(invalid_fnames) > 0:
+    raise_error(
+        f'Files missing or not matching their checksum in the atlas store '
+        f'{store_dir}: {invalid_fnames}. Import the atlases again.')
+logger.info(f'Checksums of the atlas store {store_dir} verified.')
+
+# info and compute time
+elapsed_time = time.time() - start_time
+logger.info(f'PROCESSING DONE for the atlas store. Elapsed time: '
+            f'{elapsed_time} s.\n')
+
+# %%
@@ -0,0 +1,165 @@
+# %%
+# import packages
+import os
+from pathlib import Path
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import nibabel as nib
+import pandas as pd
+
+from confoundcontinuum.logging import configure_logging, log_versions
+from confoundcontinuum.logging import logger, raise_error
+import confoundcontinuum.atlases as atl
+from confoundcontinuum.features import (
+    get_cached_atlas_index, get_roi_projection, load_voxel_matrix,
+    project_voxel_matrix)
+from confoundcontinuum.io import save_features
+
+# %%
+# configure logging
+
+configure_logging()
+log_versions()
+
+# %%
+# set up
+
+# RUN THINGS IN ROOT DIRECTORY OF PROJECT!
+project_dir = Path(os.getcwd())
+default_input_dir = project_dir / 'data' / 'voxel_matrix'
+default_cache_dir = project_dir / 'data' / 'masks' / 'atlas_index'
+default_agg_methods = ['mean', 'std']
+default_block_size = 512
+
+# pipeline help (parser)
+parser = ArgumentParser(
+    description='Aggregate grey matter density (GMD) per ROI for the whole '
+    'cohort from the voxel matrix written by 9_build_voxel_matrix.py. Each '
+    'atlas is applied as one sparse label-indicator matrix to blocks of '
+    'subjects. '
+    'INPUT parameters required: --results, --atlasnames. '
+    'INPUT parameters optional: --input, --aggmethod, --atlasdir, '
+    '--cachedir, --blocksize. '
+    'See parameter help for more information.'
+)
+
+# atlas names
+parser.add_argument(
+    '--atlasnames', metavar='atlasnames', type=str, nargs='+', required=True,
+    help='Atlas names to use for parcellation of gray matter density (GMD). '
+         'Specify by name of atlas as listed in '
+         'confoundcontinuum.atlases.list_atlases(), e.g. Schaefer100x7 '
+         'Tian4x3TxMNInonlinear2009cAsym SUITxMNI.')
+
+# results
+parser.add_argument(
+    '--results', metavar='results', type=str, required=True,
+    help='Path where to store the results as SQLite database, '
+         'containing chosen aggregation_methods of GMD per ROI for all '
+         'atlases and subjects. Specify as '
+         '</path/to/results>/<name_of_database.sqlite>. ')
+
+# voxel matrix
+parser.add_argument(
+    '--input', metavar='input', type=str, default=default_input_dir,
+    help='Directory of the voxel matrix written by 9_build_voxel_matrix.py. '
+         f'Defaults to {default_input_dir}')
+
+# aggregation methods
+parser.add_argument(
+    '--aggmethod', metavar='aggmethod', type=str, nargs='+',
+    default=default_agg_methods,
+    help='Aggregation method to summarize gray matter density per ROI. Valid '
+         'inputs: mean, std, count, sum, sumsq. '
+         f'Defaults to {default_agg_methods}.')
+
+# atlas directory
+parser.add_argument(
+    '--atlasdir', metavar='atlasdir', type=str, default=None,
+    help='Path of the atlas store (see 0_import_atlases.py, atlases are '
+         'read in place without network access) or where to find (or '
+         'download) the atlases. Defaults to $HOME/junifer/data/atlas.')
+
+# path to cache the atlases resampled to the VBM grid
+parser.add_argument(
+    '--cachedir', metavar='cachedir', type=str, default=default_cache_dir,
+    help='Path where to cache the atlases resampled to the VBM grid and '
+         'their voxel-to-ROI index. Atlases found in the cache are not '
+         f'resampled again. Defaults to {default_cache_dir}')
+
+# block size
+parser.add_argument(
+    '--blocksize', metavar='blocksize', type=int, default=default_block_size,
+    help='Number of subjects aggregated at once (bounds the memory). '
+         f'Defaults to {default_block_size}.')
+
+# pass input parameters to variables
+args = parser.parse_args()
+atlas_names = args.atlasnames
+results_path = Path(args.results)
+input_dir = Path(args.input)
+agg_methods = args.aggmethod
+atlas_dir = None if args.atlasdir is None else Path(args.atlasdir)
+cache_dir = Path(args.cachedir)
+block_size = args.blocksize
+
+# check parsed arguments and give user info
+invalid_atlases = [x for x in atlas_names if x not in atl.list_atlases()]
+if len(invalid_atlases) > 0:
+    raise_error(
+        f'Invalid atlas names {invalid_atlases}. Valid atlases: '
+        f'{atl.list_atlases()}.')
+results_path.parent.mkdir(exist_ok=True, parents=True)
+results_uri = f'sqlite:///{results_path.as_posix()}'
+logger.info('Aggregated GMD per ROI will be saved (results directory) in '
+            f'{results_path.as_posix()}')
+
+# %%
+# project voxel matrix onto all atlases
+
+start_time = time.time()
+
+voxel_matrix = load_voxel_matrix(input_dir)
+logger.info(
+    f'Voxel matrix with {voxel_matrix["matrix"].shape[0]} voxels and '
+    f'{voxel_matrix["matrix"].shape[1]} subjects loaded from {input_dir}.')
+gmd_index = pd.MultiIndex.from_tuples(
+    voxel_matrix['subject_ids'], names=['SubjectID', 'Session'])
+# empty nifti defining the VBM grid
+vbm_grid = nib.Nifti1Image(
+    np.zeros(voxel_matrix['shape'], dtype=np.int8), voxel_matrix['affine'])
+
+for atlas_name in atlas_names:
+    start_time_atlas = time.time()
+    atlas_img, atlas_labels, _ = atl.get_atlas(atlas_name, atlas_dir)
+    atlas_index = get_cached_atlas_index(
+        atlas_name, atlas_img, vbm_grid, cache_dir)
+    projection = get_roi_projection(atlas_index, voxel_matrix)
+
+    logger.info(f'Compute {agg_methods} of GMD for {atlas_name}.')
+    roi_aggregated = project_voxel_matrix(
+        voxel_matrix, projection, aggregation=agg_methods,
+        block_size=block_size)
+
+    for agg_name, agg_values in roi_aggregated.items():
+        gmd_df = pd.DataFrame(
+            agg_values, index=gmd_index, columns=atlas_labels)
+        save_features(
+            df=gmd_df,
+            uri=results_uri,
+            kind='gmd',
+            atlas_name=atl.get_features_atlas_name(atlas_name),
+            agg_function=agg_name
+            )
+    logger.info(
+        f'GMD for {atlas_name} exported. Elapsed time: '
+        f'{time.time() - start_time_atlas} s.')
+
+# info and compute time
+elapsed_time = time.time() - start_time
+logger.info('PROCESSING DONE for GMD computation from the voxel matrix for '
+            f'atlases {atlas_names}. Elapsed time: {elapsed_time} s.\n')
+
+# %%
@@ -0,0 +1,82 @@
+# %%
+# import packages
+import os
+from pathlib import Path
+import time
+from argparse import ArgumentParser
+
+from confoundcontinuum.logging import configure_logging, log_versions
+from confoundcontinuum.logging import logger
+from confoundcontinuum.io import compact_feature_shards
+
+# %%
+# configure logging
+
+configure_logging()
+log_versions()
+
+# %%
+# set up
+
+# RUN THINGS IN ROOT DIRECTORY OF PROJECT!
+project_dir = Path(os.getcwd())
+default_input_dir = (
+    project_dir / 'results' / '1_feature_extraction' / '1_gmd_Schaefer' /
+    'shards')
+default_results_path = (
+    project_dir / 'results' / '1_feature_extraction' / '1_gmd_Schaefer' /
+    '1_gmd_schaefer_all_subjects.sqlite')
+
+# pipeline help (parser)
+parser = ArgumentParser(
+    description='Compact the Parquet shards written by the extraction '
+    'scripts with --format parquet (e.g. 1_gmd_schaefer.py, '
+    '8_gmd_multi_atlas.py) into the cohort-wide feature tables of one SQLite '
+    'database. Replaces the merge of single subject databases (e.g. '
+    '2_merge_gmd_schaefer_databases.py). Tables existing in the database are '
+    'replaced, together with their rows of the manifest, which are taken '
+    'from the manifest of the shards (resume with --format sqlite). For '
+    'subjects written several times (reruns), the most recent shard is used. '
+    'INPUT parameters optional: --input, --results. '
+    'See parameter help for more information.'
+)
+
+# directory of the shards
+parser.add_argument(
+    '--input', metavar='input', type=str, default=default_input_dir,
+    help='Directory of the Parquet shards (--results of the extraction '
+         f'scripts). Defaults to {default_input_dir}')
+
+# results
+parser.add_argument(
+    '--results', metavar='results', type=str, default=default_results_path,
+    help='Path where to store the cohort-wide tables as SQLite database. '
+         'Specify as </path/to/results>/<name_of_database.sqlite>. '
+         f'Defaults to {default_results_path}')
+
+# pass input parameters to variables
+args = parser.parse_args()
+input_dir = Path(args.input)
+results_path = Path(args.results)
+
+results_path.parent.mkdir(exist_ok=True, parents=True)
+results_uri = f'sqlite:///{results_path.as_posix()}'
+
+# %%
+# compact the shards
+
+start_time = time.time()
+
+logger.info(f'Compact Parquet shards in {input_dir} into {results_path}.')
+features = compact_feature_shards(input_dir, results_uri)
+for _, t_feature in features.iterrows():
+    logger.info(
+        f'Table {t_feature["kind"]}${t_feature["atlas_name"]}$'
+        f'{t_feature["agg_function"]}: {t_feature["n_rows"]} rows.')
+
+# info and compute time
+elapsed_time = time.time() - start_time
+logger.info(f'PROCESSING DONE for compaction of {len(features)} tables. '
+            f'Elapsed time: {elapsed_time} s.\n')
+
+# %%
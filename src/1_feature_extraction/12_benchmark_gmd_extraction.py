@@ -0,0 +1,164 @@
+# %%
+# import packages
+import os
+from pathlib import Path
+import platform
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import nibabel as nib
+import pandas as pd
+
+from confoundcontinuum.logging import configure_logging, log_versions
+from confoundcontinuum.logging import logger, raise_error
+from confoundcontinuum.benchmark import (
+    benchmark_gmd, make_synthetic_atlas, make_synthetic_vbm,
+    summarize_benchmark)
+
+# %%
+# configure logging
+
+configure_logging()
+log_versions()
+
+# %%
+# set up
+
+# RUN THINGS IN ROOT DIRECTORY OF PROJECT!
+project_dir = Path(os.getcwd())
+default_results_dir = (
+    project_dir / 'results' / '1_feature_extraction' / '12_benchmark')
+default_atlases = ['schaefer:400', 'tian:54', 'suit:34']
+
+# pipeline help (parser)
+parser = ArgumentParser(
+    description='Benchmark the extraction of grey matter density (GMD) per '
+    'ROI offline on synthetic data: VBM volumes on the 1.5 mm grid of the '
+    'CAT output and Schaefer-, Tian- and SUIT-like label volumes at 1 mm. '
+    'For each subject and atlas, atlas resampling, indexing, masking, each '
+    'aggregation and saving the results are timed (voxels per second) and '
+    'their peak memory is measured. '
+    'INPUT parameters optional: --nsubjects, --atlases, --aggmethod, '
+    '--winlim, --qc, --uncompressed, --seed, --results. '
+    'See parameter help for more information. '
+    'The timings per subject, atlas and stage and their summary per atlas '
+    'and stage are saved as csv files to the directory specified in '
+    '--results.'
+)
+
+# PARSER INPUT ARGUMENTS
+
+# number of synthetic subjects
+parser.add_argument(
+    '--nsubjects', metavar='nsubjects', type=int, default=5,
+    help='Number of synthetic VBM volumes (subjects). Defaults to 5.')
+
+# synthetic atlases
+parser.add_argument(
+    '--atlases', metavar='atlases', type=str, nargs='+',
+    default=default_atlases,
+    help='Synthetic atlases as <kind>:<n_rois>, with kind one of schaefer, '
+         'tian and suit (see confoundcontinuum.benchmark.'
+         f'make_synthetic_atlas()). Defaults to {" ".join(default_atlases)}.')
+
+# aggregation methods (defaults are set in confoundcontinuum.benchmark)
+parser.add_argument(
+    '--aggmethod', metavar='aggmethod', type=str, nargs='+',
+    help='Aggregation methods to benchmark. Valid inputs as for '
+         '8_gmd_multi_atlas.py. Defaults to winsorized_mean, mean and std.')
+
+# limits for winsorizing mean
+parser.add_argument(
+    '--winlim', metavar='winlim', type=float, nargs='+',
+    help='Lower and upper limit for application of winsorized (or trimmed) '
+         'mean. Defaults to 0.1 0.1.')
+
+# quality control metrics
+parser.add_argument(
+    '--qc', action='store_true',
+    help='Also benchmark the quality control metrics per ROI.')
+
+# uncompressed niftis
+parser.add_argument(
+    '--uncompressed', action='store_true',
+    help='Write the synthetic VBM volumes as uncompressed niftis (as in a '
+         'local VBM cache) instead of .nii.gz (as in the VBM dataset).')
+
+# seed
+parser.add_argument(
+    '--seed', metavar='seed', type=int, default=0,
+    help='Seed of the synthetic data. Defaults to 0.')
+
+# results directory
+parser.add_argument(
+    '--results', metavar='results', type=str, default=default_results_dir,
+    help='Directory where to store the benchmark results. Defaults to '
+         f'{default_results_dir}')
+
+# pass input parameters to variables
+args = parser.parse_args()
+n_subjects = args.nsubjects
+atlases = args.atlases
+agg_methods = args.aggmethod
+win_limits = args.winlim
+qc = args.qc
+suffix = '.nii' if args.uncompressed else '.nii.gz'
+seed = args.seed
+results_dir = Path(args.results)
+
+results_dir.mkdir(exist_ok=True, parents=True)
+
+# %%
+# synthetic data
+
+start_time = time.time()
+logger.info(
+    f'Benchmark on {platform.node()} ({platform.platform()}, '
+    f'{os.cpu_count()} CPUs).')
+
+atlas_niftis = {}
+for t_atlas in atlases:
+    kind, _, n_rois = t_atlas.partition(':')
+    if not n_rois.isdigit():
+        raise_error(
+            f'Atlas {t_atlas} is not specified as <kind>:<n_rois>.')
+    logger.info(f'Generate synthetic {kind} atlas with {n_rois} ROIs.')
+    atlas_niftis[t_atlas] = make_synthetic_atlas(
+        kind, int(n_rois), seed=seed)
+
+with tempfile.TemporaryDirectory() as tmp_dir:
+    vbm_fnames = []
+    subids = []
+    for i_subject in range(n_subjects):
+        subids.append(f'sub-{i_subject:04d}')
+        vbm_fnames.append(Path(tmp_dir) / f'{subids[-1]}{suffix}')
+        nib.save(
+            make_synthetic_vbm(seed=seed + i_subject), vbm_fnames[-1])
+    logger.info(f'{n_subjects} synthetic VBM volumes written to {tmp_dir}.')
+
+    # %%
+    # benchmark
+
+    results_uri = f'sqlite:///{(Path(tmp_dir) / "gmd.sqlite").as_posix()}'
+    results = benchmark_gmd(
+        vbm_fnames, atlas_niftis, results_uri, aggregation=agg_methods,
+        limits=win_limits, subject_ids=subids, qc=qc)
+
+# %%
+# save results
+
+summary = summarize_benchmark(results)
+with pd.option_context('display.width', 200, 'display.max_columns', None,
+                       'display.max_rows', None):
+    logger.info(f'Benchmark summary:\n{summary}')
+results.to_csv(results_dir / 'benchmark_gmd_subjects.csv', index=False)
+summary.to_csv(results_dir / 'benchmark_gmd_summary.csv')
+
+# info and compute time
+elapsed_time = time.time() - start_time
+logger.info(f'PROCESSING DONE for the benchmark of {n_subjects} subjects. '
+            f'Results saved to {results_dir}. '
+            f'Elapsed time: {elapsed_time} s.\n')
+
+# %%
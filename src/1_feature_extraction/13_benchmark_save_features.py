@@ -0,0 +1,138 @@
+# %%
+# import packages
+import os
+from pathlib import Path
+import platform
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import pandas as pd
+
+from confoundcontinuum.logging import configure_logging, log_versions
+from confoundcontinuum.logging import logger
+from confoundcontinuum.benchmark import benchmark_save_features
+
+# %%
+# configure logging
+
+configure_logging()
+log_versions()
+
+# %%
+# set up
+
+# RUN THINGS IN ROOT DIRECTORY OF PROJECT!
+project_dir = Path(os.getcwd())
+default_results_dir = (
+    project_dir / 'results' / '1_feature_extraction' / '12_benchmark')
+default_target = 1e6
+
+# pipeline help (parser)
+parser = ArgumentParser(
+    description='Benchmark the throughput of saving wide feature tables '
+    '(confoundcontinuum.io.save_features) to SQLite on synthetic data: a '
+    'cohort-wide table saved at once (merge, compaction) and single subjects '
+    'saved one by one (extraction), compared to pandas to_sql and with the '
+    'scratch pragmas (write-ahead log, no syncing). The throughput target '
+    '(--target) only applies to the cohort-wide tables: single subjects are '
+    'bounded by one transaction per subject and are reported separately. '
+    'INPUT parameters optional: --nsubjects, --nrois, --nsingle, '
+    '--chunksize, --target, --dbdir, --results. '
+    'See parameter help for more information. '
+    'The results are saved as csv file to the directory specified in '
+    '--results.'
+)
+
+# PARSER INPUT ARGUMENTS
+
+# number of subjects of the cohort-wide table
+parser.add_argument(
+    '--nsubjects', metavar='nsubjects', type=int, default=2000,
+    help='Number of subjects (rows) of the cohort-wide table. Defaults to '
+         '2000.')
+
+# number of ROIs
+parser.add_argument(
+    '--nrois', metavar='nrois', type=int, default=1000,
+    help='Number of ROIs (columns). Defaults to 1000.')
+
+# number of subjects saved one by one
+parser.add_argument(
+    '--nsingle', metavar='nsingle', type=int, default=200,
+    help='Number of subjects saved one by one. Defaults to 200.')
+
+# rows per transaction
+parser.add_argument(
+    '--chunksize', metavar='chunksize', type=int, default=None,
+    help='Rows per transaction of save_features. Defaults to one '
+         'transaction per table.')
+
+# throughput target
+parser.add_argument(
+    '--target', metavar='target', type=float, default=default_target,
+    help='Throughput target of save_features for the cohort-wide table in '
+         f'values per second. Defaults to {default_target:.0f}.')
+
+# directory of the databases
+parser.add_argument(
+    '--dbdir', metavar='dbdir', type=str, default=None,
+    help='Directory for the benchmark databases, on the disk to benchmark. '
+         'Defaults to a temporary directory.')
+
+# results directory
+parser.add_argument(
+    '--results', metavar='results', type=str, default=default_results_dir,
+    help='Directory where to store the benchmark results. Defaults to '
+         f'{default_results_dir}')
+
+# pass input parameters to variables
+args = parser.parse_args()
+n_subjects = args.nsubjects
+n_rois = args.nrois
+n_single = args.nsingle
+chunksize = args.chunksize
+target = args.target
+db_dir = args.dbdir
+results_dir = Path(args.results)
+
+results_dir.mkdir(exist_ok=True, parents=True)
+
+# %%
+# benchmark
+
+start_time = time.time()
+logger.info(
+    f'Benchmark on {platform.node()} ({platform.platform()}, '
+    f'{os.cpu_count()} CPUs).')
+
+with tempfile.TemporaryDirectory(dir=db_dir) as tmp_dir:
+    results = benchmark_save_features(
+        tmp_dir, n_subjects=n_subjects, n_rois=n_rois, chunksize=chunksize,
+        n_single=n_single, target=target)
+
+# %%
+# save results
+
+with pd.option_context('display.width', 200, 'display.max_columns', None):
+    logger.info(f'Benchmark results:\n{results}')
+table_results = results.query(
+    'case == "table" and method == "save_features"')
+if not table_results['meets_target'].all():
+    logger.warning(
+        'save_features did not reach the throughput target of '
+        f'{target:.0f} values per second for the cohort-wide table.')
+# without target: bounded by one transaction per subject
+for _, t_result in results.query('case == "subject"').iterrows():
+    logger.info(
+        f'Single subjects ({t_result["method"]}): '
+        f'{t_result["values_per_s"]:.0f} values per second (no target).')
+results.to_csv(results_dir / 'benchmark_save_features.csv', index=False)
+
+# info and compute time
+elapsed_time = time.time() - start_time
+logger.info(f'PROCESSING DONE for the benchmark of saving {n_subjects} x '
+            f'{n_rois} features. Results saved to {results_dir}. '
+            f'Elapsed time: {elapsed_time} s.\n')
+
+# %%
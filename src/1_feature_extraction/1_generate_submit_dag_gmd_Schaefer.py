@@ -3,6 +3,8 @@ import os
 from pathlib import Path
 import tempfile
 
+from confoundcontinuum.jobs import get_resource_requests, read_job_resources
+
 import nest_asyncio
 nest_asyncio.apply()
 import datalad.api as dl  # noqa E402
@@ -33,39 +35,72 @@ logs_dir.mkdir(exist_ok=True, parents=True)
 submit_fname = script_dir / '1_gmd_schaefer.submit'
 dag_fname = script_dir / '1_gmd_schaefer.dag'
 
+# subjects per job (processed one after the other in the job)
+chunk_size = 20
+
+# output format of 1_gmd_schaefer.py: 'sqlite' (one database per subject, to
+# be merged by 2_merge_gmd_schaefer_databases.py) or 'parquet' (one shard per
+# table and job, to be compacted by 11_compact_feature_shards.py)
+output_format = 'sqlite'
+shards_dir = (
+    project_dir / 'results' / '1_feature_extraction' / '1_gmd_Schaefer' /
+    'shards')
+
+# %% resource requests from the resources measured in earlier runs
+
+# peak usage of the jobs in the HTCondor logs (memory and disk do not grow
+# with the chunk size, as the subjects of a chunk are processed in turn)
+resources = read_job_resources(logs_dir, '1_gmd_schaefer_*.log')
+requests = get_resource_requests(resources)
+
 # %% define preamble
 
 # define arguments for executable here
-exec_string = (
-    '1_gmd_schaefer.py '
-    f'--results {results_dir.as_posix()}'
-    '/1_gmd_schaefer_$(subject)_$(session).sqlite '
-    '--rois 100 200 300 400 500 600 700 800 900 1000 '
-    '--subid $(subject) '
-    '--ses $(session)'
-)
+if output_format == 'parquet':
+    # all subjects of a chunk in one process, which writes one shard per
+    # table (instead of one shard per subject and table)
+    executable = 'run_in_venv.sh'
+    exec_string = (
+        '1_gmd_schaefer.py '
+        f'--results {shards_dir.as_posix()} '
+        '--format parquet '
+        '--rois 100 200 300 400 500 600 700 800 900 1000 '
+        '--subid $(subjects) '
+        '--ses $(sessions)'
+    )
+else:
+    # one process (and database) per subject, see run_chunk_in_venv.sh
+    executable = 'run_chunk_in_venv.sh'
+    exec_string = (
+        "'$(subjects)' '$(sessions)' 1_gmd_schaefer.py "
+        f'--results {results_dir.as_posix()}'
+        '/1_gmd_schaefer_{subject}_{session}.sqlite '
+        '--rois 100 200 300 400 500 600 700 800 900 1000 '
+        '--subid {subject} '
+        '--ses {session}'
+    )
 
 preamble = f"""
 # The environment
 universe = vanilla
 getenv = True
 
-# Resources
-request_cpus = 1
-request_memory = 1.6G
-request_disk = 500
+# Resources (memory in MB, disk in KB)
+request_cpus = {requests['request_cpus']}
+request_memory = {requests['request_memory']}
+request_disk = {requests['request_disk']}
 
 # Executable
 initial_dir = {script_dir}
-executable = $(initial_dir)/run_in_venv.sh
+executable = $(initial_dir)/{executable}
 transfer_executable = False
 
-arguments = {exec_string}
+arguments = "{exec_string}"
 
 # Logs
-log = {logs_dir}/1_gmd_schaefer_$(subject)_$(session).log
-output = {logs_dir}/1_gmd_schaefer_$(subject)_$(session).out
-error = {logs_dir}/1_gmd_schaefer_$(subject)_$(session).err
+log = {logs_dir}/1_gmd_schaefer_chunk$(chunk).log
+output = {logs_dir}/1_gmd_schaefer_chunk$(chunk).out
+error = {logs_dir}/1_gmd_schaefer_chunk$(chunk).err
 """
 
 with open(submit_fname, 'w') as submit_file:
@@ -84,12 +119,17 @@ with tempfile.TemporaryDirectory() as tmpdir:
     files = [x.name for x in db_dir.glob('*.nii.gz')]
 
 
+# Get all subject and session names from file list
+subjects = [fname.split('_')[0][5:] for fname in files]
+sessions = [fname.split('_')[1] for fname in files]
+
 with open(dag_fname, 'w') as dag_file:
-    # Get all subject and session names from file list
-    for i_job, fname in enumerate(files):
-        sub_number = fname.split('_')[0][5:]
-        ses_number = fname.split('_')[1]
+    # one job per chunk of subject/session pairs
+    for i_job, i_start in enumerate(range(0, len(files), chunk_size)):
+        chunk_subjects = subjects[i_start:i_start + chunk_size]
+        chunk_sessions = sessions[i_start:i_start + chunk_size]
 
         dag_file.write(f'JOB job{i_job} {submit_fname}\n')
-        dag_file.write(f'VARS job{i_job} subject="{sub_number}" '
-                       f'session="{ses_number}"\n\n')
+        dag_file.write(f'VARS job{i_job} chunk="{i_job}" '
+                       f'subjects="{" ".join(chunk_subjects)}" '
+                       f'sessions="{" ".join(chunk_sessions)}"\n\n')
@@ -3,30 +3,29 @@
 from pathlib import Path
 import tempfile
 import time
-import shutil
 import os
+import sys
 
 from argparse import ArgumentParser
+from functools import partial
 
-from nilearn import image
+import nibabel as nib
 # from nilearn import plotting
-from nilearn import datasets
-from nilearn import masking
 # import matplotlib.pyplot as plt
 import numpy as np
-from scipy.stats.mstats import winsorize
 import pandas as pd
 
 from confoundcontinuum.logging import configure_logging, log_versions
 from confoundcontinuum.logging import logger, raise_error
-from confoundcontinuum.io import save_features
+from confoundcontinuum.io import (
+    FeatureShardWriter, get_missing_feature_shards, get_missing_features,
+    save_features)
+import confoundcontinuum.atlases as atl
+from confoundcontinuum.features import (
+    drop_dataset_files, get_cached_atlas_index, get_dataset,
+    get_dataset_files, get_gmd, load_vbm_bbox)
 # from confoundcontinuum.io import read_features
 
-# workaround to import datalad when using with ipykernel
-import nest_asyncio
-nest_asyncio.apply()
-import datalad.api as dl  # noqa E402
-
 # %% configure logging
 
 configure_logging()
@@ -41,21 +40,25 @@ _valid_nrois = [100, 200, 300, 400, 500, 600, 700, 800, 900, 1000]
 
 # RUN THINGS IN ROOT DIRECTORY OF PROJECT!
 project_dir = Path(os.getcwd())
-default_atlas_dir = project_dir / 'data' / 'masks' / 'schaefer_2018'
+default_atlas_dir = project_dir / 'data' / 'masks' / 'atlas_store'
+default_cache_dir = project_dir / 'data' / 'masks' / 'atlas_index'
 default_win_limits = [0.1, 0.1]
 
 # HELP description
 parser = ArgumentParser(
     description='Extract grey matter density (GMD) of VBM data per ROI. '
     'INPUT parameters required: --results, --rois, --subid, --ses. '
-    'INPUT parameters optional: --tmp, --atlasdir, --winlim. '
+    'INPUT parameters optional: --tmp, --atlasdir, --cachedir, --winlim, '
+    '--datasetdir, --format, --qc. '
     'See parameter help for more information.'
     ' ROIs are defined by the Schaefer atlas (Schaefer et al., 2018). '
     ' Different granularities between 100 and 1000 (steps of 100) can be'
     ' applied. Dimensionality within ROIs is reduced by mean of GMD per ROI,'
     ' winsorized mean (default limits 10%) and standard deviation. These'
     ' values are exported in a SQLite database to the directory specified '
-    'in --results.'
+    'in --results. Granularities and aggregations already completed in the '
+    'database or the shards (see their manifest) are skipped, so that failed '
+    'or extended runs only compute the missing work.'
 )
 
 # REQUIRED Input Parameters
@@ -63,7 +66,8 @@ parser.add_argument(
     '--results', metavar='results', type=str, required=True,
     help='Path where to store the results as SQLite database, '
          'containing winsorized mean, mean and std of GMD per ROI. '
-         'Specify as </path/to/results>/<name_of_database.sqlite>. ')
+         'Specify as </path/to/results>/<name_of_database.sqlite>. With '
+         '--format parquet, path of the directory of the Parquet shards.')
 
 # atlas granularity
 parser.add_argument(
@@ -73,16 +77,18 @@ parser.add_argument(
 
 # subject ID
 parser.add_argument(
-    '--subid', metavar='subid', type=str, required=True,
-    help='Subject ID in accordance with the subject IDs from the respective '
-         f'database input files (see datlad dataset {REPO_URL}).')
+    '--subid', metavar='subid', type=str, required=True, nargs='+',
+    help='Subject ID(s) in accordance with the subject IDs from the '
+         f'respective database input files (see datlad dataset {REPO_URL}). '
+         'Several subjects (e.g. all subjects of a job) are processed one '
+         'after the other in this process.')
 
 # Session ID
 parser.add_argument(
-    '--ses', metavar='session', type=str, required=True,
-    help='Session ID in accordance with the recording session indicated in the'
-         ' VBM input files (see datalad dataset {REPO_URL}). Needed for '
-         'unambigous subject-recording distinction. '
+    '--ses', metavar='session', type=str, required=True, nargs='+',
+    help='Session ID(s) in accordance with the recording session indicated '
+         f'in the VBM input files (see datalad dataset {REPO_URL}), one per '
+         'subject ID. Needed for unambigous subject-recording distinction. '
          'Valid input: "ses-2" or "ses-3".')
 
 # OPTIONAL Input Parameters (default values defined)
@@ -90,13 +96,28 @@ parser.add_argument(
 # path to store atlas downloaded via nilearn - defaults to juseless path
 parser.add_argument(
     '--atlasdir', metavar='atlasdir', type=str, default=default_atlas_dir,
-    help='Path where to find the atlases. Schaefer atlases are copied '
-         '(when existing) from this directory to juseless local node. '
-         'If not existing in the directory specified here they are '
-         'downloaded using nilearn `datasets.fetch_atlas_schaefer_2018` '
-         'function. '
+    help='Path of the atlas store (see 0_import_atlases.py) or directory '
+         'where to find the atlases. Atlases are read from the store in '
+         'place, without network access. In a plain directory, missing '
+         'Schaefer atlases are downloaded using nilearn '
+         '`datasets.fetch_atlas_schaefer_2018` function. '
          f'Defaults to {default_atlas_dir}')
 
+# shared local clone of the VBM dataset
+parser.add_argument(
+    '--datasetdir', metavar='datasetdir', type=str, default=None,
+    help='Directory for a local clone of the VBM datalad dataset shared by '
+         'all jobs on a node (e.g. on node-local scratch). The dataset is '
+         'cloned only once and each job only gets and drops its own niftis. '
+         'Defaults to a fresh clone in a temporary directory.')
+
+# path to cache the atlases resampled to the VBM grid
+parser.add_argument(
+    '--cachedir', metavar='cachedir', type=str, default=default_cache_dir,
+    help='Path where to cache the atlases resampled to the VBM grid and '
+         'their voxel-to-ROI index. Atlases found in the cache are not '
+         f'resampled again. Defaults to {default_cache_dir}')
+
 # limits for winsorizing mean
 parser.add_argument(
     '--winlim', metavar='winlim', type=float, nargs='+',
@@ -106,16 +127,41 @@ parser.add_argument(
          'floats between 0 and 1 in decimal notation of per cent values (e.g.'
          ' 0.1 0.1).')
 
+# output format
+parser.add_argument(
+    '--format', metavar='format', type=str, default='sqlite',
+    choices=['sqlite', 'parquet'],
+    help='Output format. sqlite: save the results in the SQLite database '
+         '--results. parquet: append the results to one Parquet shard per '
+         'table in the directory --results, so that no database per subject '
+         'needs to be merged (see 11_compact_feature_shards.py). Each process '
+         'writes its own shards: pass all subjects of a job to one process '
+         '(--subid, --ses) instead of running it once per subject. The work '
+         'completed in the shards is recorded in their manifest and carried '
+         'over to the database by the compaction. Defaults to sqlite.')
+
+# quality control metrics
+parser.add_argument(
+    '--qc', action='store_true',
+    help='Also save quality control metrics per ROI (number of voxels, '
+         'fraction of zero and of non-finite voxels, min, max and number of '
+         'winsorized voxels), computed from the same voxel values as the '
+         'GMD, as tables qc_<metric> next to the GMD tables.')
+
 
 # pass input parameters to variables
 args = parser.parse_args()
 
 results_path = Path(args.results)
 n_rois_atlas = args.rois
-subid = args.subid
-session = args.ses
+subids = args.subid
+sessions = args.ses
 atlas_dir = Path(args.atlasdir)
+cache_dir = Path(args.cachedir)
+dataset_dir = args.datasetdir
 win_limits = args.winlim
+output_format = args.format
+qc = args.qc
 
 # USER INFORMATION: confirm input parameters
 logger.info(f'Loading input datalad dataset (VBM niftis) from URL {REPO_URL}')
@@ -136,6 +182,11 @@ else:
     logger.info(f'Reading atlas from {atlas_dir.as_posix()} '
                 f'(not default directory).')
 
+if len(subids) != len(sessions):
+    raise_error(
+        f'Number of subject IDs ({len(subids)}) and of sessions '
+        f'({len(sessions)}) differ.')
+
 if len(win_limits) != 2:
     raise_error('--win-limits should have exactly two elements')
 
@@ -147,28 +198,72 @@ if win_limits == default_win_limits:
 else:
     logger.info(f'Using winsorized mean limits {win_limits} (not-default).')
 
+# names of the aggregations (tables) and parameters of the manifest
+limits_suffix = (
+    str(win_limits[0]).replace('.', '') + '_' +
+    str(win_limits[1]).replace('.', ''))
+agg_functions = [f'winsorized_mean_limits_{limits_suffix}', 'mean', 'std']
+# quality control metrics (see confoundcontinuum.features.get_roi_qc)
+qc_functions = {}
+if qc:
+    qc_functions = {
+        f'qc_{x}': f'qc_{x}' for x in [
+            'n_voxels', 'zero_fraction', 'nonfinite_fraction', 'min', 'max']}
+    qc_functions['qc_n_winsorized'] = f'qc_n_winsorized_limits_{limits_suffix}'
+    logger.info('Quality control metrics per ROI will be saved.')
+agg_functions = agg_functions + list(qc_functions.values())
+manifest_params = {'atlas_resolution': atlas_resolution}
+results_uri = f'sqlite:///{results_path.as_posix()}'
+
+# granularities to compute per subject and session
+subject_n_rois = {x: n_rois_atlas for x in zip(subids, sessions)}
+
+# skip the work completed in the results database or in the shards (rerun
+# of failed jobs or new granularities)
+if output_format == 'sqlite':
+    results_path.parent.mkdir(exist_ok=True, parents=True)
+    get_missing = partial(get_missing_features, results_uri)
+else:
+    get_missing = partial(get_missing_feature_shards, results_path)
+missing_features = get_missing(
+    pd.MultiIndex.from_tuples(
+        list(subject_n_rois), names=['SubjectID', 'Session']),
+    kind='gmd',
+    atlas_names=[f'schaefer2018_{x}parcels' for x in n_rois_atlas],
+    agg_functions=agg_functions, params=manifest_params)
+for (subid, session) in list(subject_n_rois):
+    missing_atlases = missing_features.query(
+        'SubjectID == @subid and Session == @session')[
+            'atlas_name'].unique()
+    n_rois_done = [
+        x for x in n_rois_atlas
+        if f'schaefer2018_{x}parcels' not in missing_atlases]
+    if len(n_rois_done) > 0:
+        logger.info(f'Skipping granularity(ies) {n_rois_done} of {subid} '
+                    f'{session}: already completed in '
+                    f'{results_path.as_posix()}.')
+    subject_n_rois[(subid, session)] = [
+        x for x in n_rois_atlas if x not in n_rois_done]
+    if len(subject_n_rois[(subid, session)]) == 0:
+        del subject_n_rois[(subid, session)]
+if len(subject_n_rois) == 0:
+    logger.info('PROCESSING DONE: nothing left to compute.')
+    sys.exit(0)
+
 # %% Clone, get and load VBM
 
 start_time_all = time.time()
+shard_writer = None
+if output_format == 'parquet':
+    # one shard per table for all subjects of this process
+    shard_writer = FeatureShardWriter(results_path)
+# atlases (image, labels, voxel-to-ROI index) per granularity, loaded once
+atlases = {}
 
-# Clone dataset into temporary directory
-with tempfile.TemporaryDirectory() as tmpdir:
-    # Define tmp subdirectories
-    tmp_db_path = Path(tmpdir) / 'data'
-    tmp_cat_inst_dir = tmp_db_path / 'cat_m0wp1'
-    tmp_cat_dat_dir = tmp_cat_inst_dir / 'm0wp1'
-    tmp_masks = tmp_db_path / 'masks'
-    tmp_masks_sub = tmp_masks / 'schaefer_2018'
-
-    # Create the directories if they do not exist
-    tmp_cat_inst_dir.mkdir(exist_ok=True, parents=True)
-    tmp_masks_sub.mkdir(exist_ok=True, parents=True)
 
-    # Clone VBM datalad dataset
-    logger.info(
-        f'Cloning VBM datalad dataset from {REPO_URL} to {tmp_cat_inst_dir}')
-    dl.install(path=tmp_cat_inst_dir, source=REPO_URL)  # type: ignore
-    logger.info('Dataset cloned.')
+def extract_subject(subid, session, tmp_cat_inst_dir):
+    """Compute and save the GMD of one subject and session"""
+    tmp_cat_dat_dir = tmp_cat_inst_dir / 'm0wp1'
 
     # VBM nifti image path (filename format UKB/VBM pre-processed specific)
     image_fname = tmp_cat_dat_dir / f'm0wp1{subid}_{session}_T1w.nii.gz'
@@ -181,12 +276,22 @@ with tempfile.TemporaryDirectory() as tmpdir:
     # Get data (dataset component=VBM nifti) of predefined subject(s)/session(s)
     logger.info('Getting VBM niftis (dataset components) of predefined '
                 'subject(s)/session(s).')
-    dl.get(path=image_fname, dataset=tmp_cat_inst_dir)
-    logger.info('Got VBM niftis.')
-
-    # load VBM as nifti, resolution 1.5 mm
-    logger.info(f'Loading VBM nifti from {image_fname}')
-    vbm_img = image.load_img(image_fname.as_posix())
+    try:
+        get_dataset_files(tmp_cat_inst_dir, [image_fname])
+        logger.info('Got VBM niftis.')
+
+        # load VBM as nifti, resolution 1.5 mm
+        logger.info(f'Loading VBM nifti from {image_fname}')
+        vbm_img = nib.load(image_fname.as_posix())
+        # read (and decompress) the data once as float32 for all
+        # granularities
+        vbm_data = load_vbm_bbox(
+            vbm_img, tuple(slice(0, x) for x in vbm_img.shape[:3]))
+    finally:
+        # also if getting or loading fails, so that the nifti (and its lock)
+        # is not left on the shared clone
+        if dataset_dir is not None:
+            drop_dataset_files(tmp_cat_inst_dir, [image_fname])
     logger.info('VBM nifti loaded.')
 
     # control plot
@@ -196,100 +301,51 @@ with tempfile.TemporaryDirectory() as tmpdir:
     # Get atlas
 
     # for loop for multiple granularities passed as ROI parameter
-    for roi_atlas in n_rois_atlas:
+    for roi_atlas in subject_n_rois[(subid, session)]:
         start_time_1gran = time.time()
         logger.info(f'Compute GMD for atlas with granularity {roi_atlas}:')
 
-    # Get atlas
-        atlas_fname = (
-            atlas_dir / f'Schaefer2018_{roi_atlas}Parcels_'
-            f'{yeo_networks}Networks_order_FSLMNI152_'
-            f'{atlas_resolution}mm.nii.gz')
-        atlas_tname = atlas_dir / f'Schaefer2018_{roi_atlas}Parcels_'\
-            f'{yeo_networks}Networks_order.txt'
-
-        logger.info(f'Checking if atlas {atlas_fname.as_posix()} and its '
-                    f'metadata file {atlas_tname.as_posix()} exist and '
-                    f'can be copied to {tmp_masks.as_posix()}:')
-
-    # Fetch atlas from nilearn to /tmp
-        if atlas_fname.exists() and atlas_tname.exists():
-            logger.info(f'Atlas {atlas_fname.as_posix()} and its metadata '
-                        'file exist.')
-
-            logger.info(f'Copying atlas {atlas_fname.as_posix()} and '
-                        f'metadata {atlas_tname.as_posix()} '
-                        f'to {tmp_masks_sub.as_posix()}')
-            shutil.copy2(atlas_fname, tmp_masks_sub)
-            shutil.copy2(atlas_tname, tmp_masks_sub)
-        else:
+    # Get atlas (resolved from the atlas store without network access, see
+    # 0_import_atlases.py), once for all subjects of this process
+        if roi_atlas not in atlases:
+            atlas_img, labels, _ = atl.get_atlas(
+                f'Schaefer{roi_atlas}x{yeo_networks}', atlas_dir)
+            logger.info(f'Atlas was loaded. Granularity: {roi_atlas}, '
+                        f'resolution: {atlas_resolution} mm.')
+
+            # downsample to 1.5 mm and flatten into voxel-to-ROI index
+            # (once, cached for all following jobs)
+            logger.info('Re-sampling atlas and building voxel-to-ROI index.')
+            atlases[roi_atlas] = (atlas_img, labels, get_cached_atlas_index(
+                f'Schaefer{roi_atlas}x{yeo_networks}x{atlas_resolution}',
+                atlas_img, vbm_img, cache_dir))
             logger.info(
-                f'Atlas or metadata was not found in {atlas_dir.as_posix()}. '
-                'They will be downloaded from nilearn.')
-
-        atl = datasets.fetch_atlas_schaefer_2018(
-            n_rois=roi_atlas, resolution_mm=atlas_resolution,
-            data_dir=tmp_masks.as_posix())
-        logger.info(f'Atlas now available in {tmp_masks.as_posix()}')
-
-    # Load atlas, downsample, retrieve info
-        logger.info(f'Loading atlas as nifti from {atl.maps}')
-        atlas_img = image.load_img(atl.maps)  # nifti
-        logger.info(f'Atlas was loaded. Granularity: {roi_atlas}, '
-                    f'resolution: {atlas_resolution} mm.')
-
-        # downsample to 1.5 mm
-        logger.info('Re-sampling atlas.')
-        atlas_img_re = image.resample_to_img(
-            atlas_img, vbm_img, interpolation='nearest',
-            )
-        logger.info(
-            f'Atlas was re-sampled from {atlas_img.header.get_zooms()[0]} '
-            f'mm to resolution of VBM ({vbm_img.header.get_zooms()[0]} mm)'
-            ' with nearest interpolation.')
-
-        # plot check
-        # plotting.plot_anat(atlas_img_re)
-        # plotting.show()
-
-        # get atlas as np array to check for granularity
-        atlas = image.get_data(atlas_img_re)
-
-        # atlas granularity/number of ROIs
-        if np.unique(atlas).shape[0]-1 != roi_atlas:
+                f'Atlas was re-sampled from {atlas_img.header.get_zooms()[0]} '
+                f'mm to resolution of VBM ({vbm_img.header.get_zooms()[0]} '
+                'mm) with nearest interpolation.')
+        atlas_img, labels, atlas_index = atlases[roi_atlas]
+
+        # atlas granularity/number of ROIs left after re-sampling
+        n_rois_resampled = np.count_nonzero(
+            np.bincount(atlas_index['voxel_rois']))
+        if n_rois_resampled != roi_atlas:
             raise_error('Granularity of loaded atlas '
-                        f'({np.unique(atlas).shape[0]-1}) differs from wished'
+                        f'({n_rois_resampled}) differs from wished'
                         f' granularity ({roi_atlas}).')
-        granularity = np.unique(atlas).shape[0]
 
-        # get list of atlas labels from atlas object
-        labels = [
-            '_'.join(x.split('_')[1:]) for x in atl.labels.astype('U')
-        ]
-    # nifti - make mask & (winsorized) mean - all ROIs
+    # nifti - (winsorized) mean and std - all ROIs in one pass
         start_time_mask = time.time()
 
-        win_mean_gmd = np.ones(shape=(granularity-1, 1)) * np.nan
-        mean_gmd = np.ones(shape=(granularity-1, 1)) * np.nan  # comparison
-        std_gmd = np.ones(shape=(granularity-1, 1)) * np.nan
-
-        # extract (win.) mean of all ROIs (slow solution)
-        for i_roi, roi in enumerate(range(1, granularity)):
-            # apply function to image - here: select ROI
-            logger.info(f'compute mask for ROI {roi}.')
-            mask = image.math_img(f'img=={roi}', img=atlas_img_re)
-            # apply mask to vbm data
-            logger.info(f'Mask computed. Apply mask for ROI {roi}.')
-            gmd = masking.apply_mask(imgs=vbm_img, mask_img=mask)
-            # extract winsorized mean, mean, std of GMD within ROI
-            logger.info(f'Mask applied for ROI {roi}. '
-                        f'Compute winsorized mean (limits {win_limits}), mean '
-                        f'and standard deviation of GMD for ROI {roi}.')
-            win_mean_gmd[i_roi] = winsorize(gmd, limits=win_limits).mean()
-            mean_gmd[i_roi] = gmd.mean()
-            std_gmd[i_roi] = gmd.std()
-            logger.info(
-                f'winsorized mean, mean and STD computed for ROI {roi}.\n')
+        logger.info(f'Compute winsorized mean (limits {win_limits}), mean '
+                    'and standard deviation of GMD for all ROIs.')
+        gmd_aggregated, _ = get_gmd(
+            atlas_img, vbm_data,
+            aggregation=['winsorized_mean', 'mean', 'std'],
+            limits=win_limits, atlas_index=atlas_index, qc=qc)
+        win_mean_gmd = gmd_aggregated['winsorized_mean'].reshape(-1, 1)
+        mean_gmd = gmd_aggregated['mean'].reshape(-1, 1)  # comparison
+        std_gmd = gmd_aggregated['std'].reshape(-1, 1)
+        logger.info('winsorized mean, mean and STD computed for all ROIs.\n')
 
         if (
                 win_mean_gmd.shape[0] != roi_atlas or
@@ -301,13 +357,9 @@ with tempfile.TemporaryDirectory() as tmpdir:
 
         # time estimate
         elapsed_time_mask = time.time() - start_time_mask
-        logger.info('Elapsed time for 1sbj mask application: '
+        logger.info('Elapsed time for 1sbj ROI reduction: '
                     f'{elapsed_time_mask} s.')
 
-        # plot_roi on top of vbm - control
-        # plotting.plot_roi(mask, vbm_img)
-        # plotting.show()
-
     # create dataframes
 
         # winsorized mean of ROI GMD
@@ -348,37 +400,39 @@ with tempfile.TemporaryDirectory() as tmpdir:
 
         # Best: use directly juseless project folder as results_path
         # to save sqlite database
-        results_uri = f'sqlite:///{results_path.as_posix()}'
         atlas_name = f'schaefer2018_{roi_atlas}parcels'
 
-        logger.info('Exporting dataframes as SQLite database '
+        logger.info(f'Exporting dataframes as {output_format} '
                     f'to "{results_path.as_posix()}".')
 
-        save_features(
-            df=gmd_win_df,
-            uri=results_uri,
-            kind='gmd',
-            atlas_name=atlas_name,
-            agg_function=(
-                'winsorized_mean_limits_'
-                + str(win_limits[0]).replace('.', '') +
-                '_'+str(win_limits[1]).replace('.', '')),
+        gmd_dfs = dict(zip(
+            agg_functions[:3], [gmd_win_df, gmd_mean_df, gmd_std_df]))
+        # quality control metrics of the same voxel values
+        for qc_name, qc_function in qc_functions.items():
+            gmd_dfs[qc_function] = pd.DataFrame(
+                gmd_aggregated[qc_name].reshape(1, -1), columns=labels,
+                index=gmd_win_df.index)
+        # do not save completed aggregations again
+        missing_aggs = missing_features.query(
+            'SubjectID == @subid and Session == @session and '
+            'atlas_name == @atlas_name')['agg_function'].tolist()
+        gmd_dfs = {
+            k: v for k, v in gmd_dfs.items() if k in missing_aggs}
+        for agg_function, gmd_df in gmd_dfs.items():
+            if shard_writer is not None:
+                shard_writer.write(
+                    gmd_df, kind='gmd', atlas_name=atlas_name,
+                    agg_function=agg_function, manifest=manifest_params)
+            else:
+                save_features(
+                    df=gmd_df,
+                    uri=results_uri,
+                    kind='gmd',
+                    atlas_name=atlas_name,
+                    agg_function=agg_function,
+                    manifest=manifest_params,
                     )
-        save_features(
-            df=gmd_mean_df,
-            uri=results_uri,
-            kind='gmd',
-            atlas_name=atlas_name,
-            agg_function='mean',
-                    )
-        save_features(
-            df=gmd_std_df,
-            uri=results_uri,
-            kind='gmd',
-            atlas_name=atlas_name,
-            agg_function='std',
-                    )
-        logger.info('Dataframes exported as SQLite database.')
+        logger.info(f'Dataframes exported as {output_format}.')
 
         logger.info(f'COMPUTATION of GMD with 1 GRANULARITY {roi_atlas} DONE.')
         elapsed_time_1gran = time.time() - start_time_1gran
@@ -387,6 +441,40 @@ with tempfile.TemporaryDirectory() as tmpdir:
             '1 sbj, 1 Schaefer atlas granularity'
             f' {roi_atlas}: {elapsed_time_1gran} s.')
 
+
+# Clone dataset into temporary directory
+with tempfile.TemporaryDirectory() as tmpdir:
+    # Define tmp subdirectories
+    tmp_db_path = Path(tmpdir) / 'data'
+    tmp_cat_inst_dir = (
+        tmp_db_path if dataset_dir is None else Path(dataset_dir)
+        ) / 'cat_m0wp1'
+
+    # Create the directories if they do not exist
+    tmp_cat_inst_dir.mkdir(exist_ok=True, parents=True)
+
+    # Clone VBM datalad dataset (once per node if --datasetdir is given)
+    logger.info(
+        f'Cloning VBM datalad dataset from {REPO_URL} to {tmp_cat_inst_dir}')
+    get_dataset(REPO_URL, tmp_cat_inst_dir)
+    logger.info('Dataset cloned.')
+
+    # process the subjects one after the other in this process; a failed
+    # subject does not stop the remaining ones
+    failed = []
+    for (subid, session) in subject_n_rois:
+        logger.info(f'Processing subject {subid}, session {session}.')
+        try:
+            extract_subject(subid, session, tmp_cat_inst_dir)
+        except Exception:
+            logger.exception(f'Error processing {subid} {session}.')
+            failed.append((subid, session))
+
+if shard_writer is not None:
+    shard_writer.close()
+if len(failed) > 0:
+    raise_error(f'{len(failed)} of {len(subject_n_rois)} subjects failed: '
+                f'{failed}')
 elapsed_time_all = time.time() - start_time_all
 logger.info('\n PROCESSING DONE for GMD with all passed granularities '
             f'({n_rois_atlas}). Entire process took {elapsed_time_all} s.\n')
@@ -3,6 +3,8 @@ import os
 from pathlib import Path
 import tempfile
 
+from confoundcontinuum.jobs import get_resource_requests, read_job_resources
+
 import nest_asyncio
 nest_asyncio.apply()
 import datalad.api as dl  # noqa E402
@@ -32,17 +34,28 @@ logs_dir.mkdir(exist_ok=True, parents=True)
 submit_fname = script_dir / '3_gmd_SUIT_dag.submit'
 dag_fname = script_dir / '3_gmd_SUIT_dag.dag'
 
+# subjects per job (processed one after the other in the job, see
+# run_chunk_in_venv.sh)
+chunk_size = 20
+
+# %% resource requests from the resources measured in earlier runs
+
+# peak usage of the jobs in the HTCondor logs (memory and disk do not grow
+# with the chunk size, as the subjects of a chunk are processed in turn)
+resources = read_job_resources(logs_dir, '3_gmd_SUIT_*.log')
+requests = get_resource_requests(resources)
+
 # %% define preamble
 
 # define arguments for executable here
 exec_string = (
-    '3_gmd_SUIT.py '
-    '--subid $(subject) '
-    '--ses $(session) '
+    "'$(subjects)' '$(sessions)' 3_gmd_SUIT.py "
+    '--subid {subject} '
+    '--ses {session} '
     '--atlasname SUITxMNI '
     '--aggmethod winsorized_mean mean std '
     f'--results {results_dir.as_posix()}'
-    '/3_gmd_SUIT_$(subject)_$(session).sqlite'
+    '/3_gmd_SUIT_{subject}_{session}.sqlite'
 )
 
 preamble = f"""
@@ -50,22 +63,22 @@ preamble = f"""
 universe = vanilla
 getenv = True
 
-# Resources
-request_cpus = 1
-request_memory = 1.6G
-request_disk = 500
+# Resources (memory in MB, disk in KB)
+request_cpus = {requests['request_cpus']}
+request_memory = {requests['request_memory']}
+request_disk = {requests['request_disk']}
 
 # Executable
 initial_dir = {script_dir}
-executable = $(initial_dir)/run_in_venv.sh
+executable = $(initial_dir)/run_chunk_in_venv.sh
 transfer_executable = False
 
-arguments = {exec_string}
+arguments = "{exec_string}"
 
 # Logs
-log = {logs_dir}/3_gmd_SUIT_$(subject)_$(session).log
-output = {logs_dir}/3_gmd_SUIT_$(subject)_$(session).out
-error = {logs_dir}/3_gmd_SUIT_$(subject)_$(session).err
+log = {logs_dir}/3_gmd_SUIT_chunk$(chunk).log
+output = {logs_dir}/3_gmd_SUIT_chunk$(chunk).out
+error = {logs_dir}/3_gmd_SUIT_chunk$(chunk).err
 """
 
 with open(submit_fname, 'w') as submit_file:
@@ -84,12 +97,17 @@ with tempfile.TemporaryDirectory() as tmpdir:
     files = [x.name for x in db_dir.glob('*.nii.gz')]
 
 
+# Get all subject and session names from file list
+subjects = [fname.split('_')[0][5:] for fname in files]
+sessions = [fname.split('_')[1] for fname in files]
+
 with open(dag_fname, 'w') as dag_file:
-    # Get all subject and session names from file list
-    for i_job, fname in enumerate(files):
-        sub_number = fname.split('_')[0][5:]
-        ses_number = fname.split('_')[1]
+    # one job per chunk of subject/session pairs
+    for i_job, i_start in enumerate(range(0, len(files), chunk_size)):
+        chunk_subjects = subjects[i_start:i_start + chunk_size]
+        chunk_sessions = sessions[i_start:i_start + chunk_size]
 
         dag_file.write(f'JOB job{i_job} {submit_fname}\n')
-        dag_file.write(f'VARS job{i_job} subject="{sub_number}" '
-                       f'session="{ses_number}"\n\n')
+        dag_file.write(f'VARS job{i_job} chunk="{i_job}" '
+                       f'subjects="{" ".join(chunk_subjects)}" '
+                       f'sessions="{" ".join(chunk_sessions)}"\n\n')
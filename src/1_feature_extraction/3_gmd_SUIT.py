@@ -8,9 +8,9 @@ from argparse import ArgumentParser
 import pandas as pd
 
 from confoundcontinuum.logging import configure_logging, log_versions
-from confoundcontinuum.logging import logger
-from confoundcontinuum.features import (
-    load_atlas, get_gmd, get_vbm, list_atlases, get_atlas_params)
+from confoundcontinuum.logging import logger, raise_error
+import confoundcontinuum.atlases as atl
+from confoundcontinuum.features import drop_dataset_files, get_gmd, get_vbm
 from confoundcontinuum.io import save_features
 
 # workaround to import datalad when using with ipykernel
@@ -30,12 +30,14 @@ log_versions()
 # fix definitions
 CAT_REPO_URL = 'ria+http://ukb.ds.inm7.de#~cat_m0wp1'
 dataset_name = 'cat_m0wp1'
+valid_atlases = [x for x in atl.list_atlases() if x.startswith('SUIT')]
 
 # pipeline help (parser)
 parser = ArgumentParser(
     description='Extract grey matter density (GMD) of VBM data per ROI. '
     'INPUT parameters required: --results, --rois, --subid, --ses. '
-    'INPUT parameters optional: --tmp, --atlasdir, --winlim. '
+    'INPUT parameters optional: --tmp, --atlasdir, --winlim, --datasetdir, '
+    '--vbmcache, --vbmcachesize. '
     'See parameter help for more information.'
     ' ROIs are defined by the Schaefer atlas (Schaefer et al., 2018). '
     ' Different granularities between 100 and 1000 (steps of 100) can be'
@@ -70,21 +72,24 @@ parser.add_argument(
 parser.add_argument(
     '--atlasname', metavar='atlasname', type=str, required=True,
     help='Atlas name to use for parcellation of gray matter density (GMD). '
-         'Specify by name of atlas following the junifer convention.'
-         f'Valid atlases: {list_atlases()}.')
+         'Specify by name of atlas following the junifer convention. '
+         f'Valid atlases: {valid_atlases}.')
 
 # DATA OUTPUT related
 # aggregation methods (defaults are set in motorpred.features.get_gmd())
 parser.add_argument(
     '--aggmethod', metavar='aggmethod', type=str, nargs='+',
-    help='Aggregation method to summarize gray matter density per ROI.'
-         'Check valid inputs via helper of motorpred.featured.get_gmd().')
+    help='Aggregation method to summarize gray matter density per ROI. '
+         'All methods are computed from one pass over the VBM data. Valid '
+         'inputs: winsorized_mean, trimmed_mean, mean, std, median and '
+         'quantile_<q> (e.g. quantile_0.25). Check '
+         'confoundcontinuum.features._get_funcbyname() for details.')
 
 # limits for winsorizing mean
 parser.add_argument(
     '--winlim', metavar='winlim', type=float, nargs='+',
-    help='Lower and upper limit for application of winsorized mean to '
-         'aggregate GMD per ROI. The limits need to be provided as 2 '
+    help='Lower and upper limit for application of winsorized (or trimmed) '
+         'mean to aggregate GMD per ROI. The limits need to be provided as 2 '
          'floats between 0 and 1 in decimal notation of per cent values (e.g.'
          ' 0.1 0.1).')
 
@@ -96,6 +101,36 @@ parser.add_argument(
          'containing chosen aggregation_methods of GMD per ROI. '
          'Specify as </path/to/results>/<name_of_database.sqlite>. ')
 
+# atlas directory
+parser.add_argument(
+    '--atlasdir', metavar='atlasdir', type=str, default=None,
+    help='Path of the atlas store (see 0_import_atlases.py, atlases are '
+         'read in place without network access) or where to find (or '
+         'download) the atlases. Defaults to a download into a temporary '
+         'directory.')
+
+# shared local clone of the VBM dataset
+parser.add_argument(
+    '--datasetdir', metavar='datasetdir', type=str, default=None,
+    help='Directory for a local clone of the VBM datalad dataset shared by '
+         'all jobs on a node (e.g. on node-local scratch). The dataset is '
+         'cloned only once and each job only gets and drops its own niftis. '
+         'Defaults to a fresh clone in a temporary directory.')
+
+# local VBM cache
+parser.add_argument(
+    '--vbmcache', metavar='vbmcache', type=str, default=None,
+    help='Path of a local cache for the VBM niftis. Niftis are stored there '
+         'uncompressed and are neither fetched nor decompressed again by '
+         'later jobs. Defaults to no cache.')
+
+# maximum size of the local VBM cache
+parser.add_argument(
+    '--vbmcachesize', metavar='vbmcachesize', type=float, default=None,
+    help='Maximum size of the VBM cache in GB. The least recently used '
+         'niftis are removed from the cache when it is exceeded. Defaults to '
+         'an unbounded cache.')
+
 # pass input parameters to variables
 args = parser.parse_args()
 subid = args.subid
@@ -104,22 +139,33 @@ atlas_name = args.atlasname
 agg_methods = args.aggmethod
 win_limits = args.winlim
 results_path = Path(args.results)
+dataset_dir = args.datasetdir
+atlas_dir = args.atlasdir
+vbm_cache_dir = args.vbmcache
+vbm_cache_size = (
+    None if args.vbmcachesize is None else args.vbmcachesize * 1e9)
 
 # check parsed arguments and give user info
-# atlasname (atlas name checked in motorpred.features._retrieve_atlas)
+# atlasname
+if atlas_name not in valid_atlases:
+    raise_error(
+        f'Invalid atlas name {atlas_name}. Valid atlases: {valid_atlases}.')
 # aggregation methods (validity checked in motorpred.features._get_funcbyname)
 # winsorize mean limits (check if argument needed,
 # validity of limits checked in motorpred.features._get_funcbyname)
-if ('winsorized_mean' in agg_methods) and (win_limits is None):
+uses_limits = any(
+    x in agg_methods for x in ['winsorized_mean', 'trimmed_mean'])
+if uses_limits and (win_limits is None):
     logger.warning(
         "The limits argument for the aggregation option \'winsorized mean\'"
-        "is required but was not specified. The default limits as defined "
-        "in motorpred.features.get_gmd will therefore be used.")
-elif ('winsorized_mean' not in agg_methods) and (win_limits is not None):
+        " or \'trimmed mean\' is required but was not specified. The default "
+        "limits as defined in motorpred.features.get_gmd will therefore be "
+        "used.")
+elif (not uses_limits) and (win_limits is not None):
     logger.warning(
         "The limits for aggregation option \'winsorized mean\' were set "
-        "although the \'winsorized mean\' was not chosen as aggregation "
-        "option.")
+        "although neither the \'winsorized mean\' nor the \'trimmed mean\' "
+        "was chosen as aggregation option.")
 # tmp (check when defining subdirectories below)
 # results (check existance of parent directory without DB file name!!)
 results_path.parent.mkdir(exist_ok=True, parents=True)
@@ -137,24 +183,28 @@ with tempfile.TemporaryDirectory() as tmpdir:
     # sub-directories (existance checked by subfunctions or datalad)
     tmp_data = Path(tmpdir) / 'data'
     tmp_masks = tmp_data / 'masks'  # directory to save atlases
+    if atlas_dir is None:
+        atlas_dir = tmp_masks
+    vbm_dir = tmp_data if dataset_dir is None else Path(dataset_dir)
 
     # VBM - clone, get, load
     logger.info('Retrieve VBM nifti from datalad dataset with repo URL '
-                f'{CAT_REPO_URL} to temporary directory {tmp_data}.')
-    vbm_nifti = get_vbm(CAT_REPO_URL, tmp_data, dataset_name, subid, session)
-
-    # atlas info and parameters
-    atlas_famname, atlas_params = get_atlas_params(atlas_name)
+                f'{CAT_REPO_URL} to {vbm_dir}.')
+    vbm_nifti = get_vbm(
+        CAT_REPO_URL, vbm_dir, dataset_name, subid, session,
+        cache_dir=vbm_cache_dir, cache_size=vbm_cache_size)
 
     # get atlas
-    atlas_img, atlas_labels, _ = load_atlas(
-        atlas_famname=atlas_famname, out_dir=tmp_masks, **atlas_params)
-
-# resample atlas and get GMD
-logger.info(
-    f'Start GMD computation for {atlas_name}.')
-gmd_parcellations, agg_func_params = get_gmd(
-    atlas_img, vbm_nifti, aggregation=agg_methods, limits=win_limits)
+    atlas_img, atlas_labels, _ = atl.get_atlas(atlas_name, atlas_dir)
+
+    # resample atlas and get GMD (VBM data is read lazily from the dataset)
+    logger.info(
+        f'Start GMD computation for {atlas_name}.')
+    gmd_parcellations, agg_func_params = get_gmd(
+        atlas_img, vbm_nifti, aggregation=agg_methods, limits=win_limits)
+    if dataset_dir is not None and vbm_cache_dir is None:
+        drop_dataset_files(
+            vbm_dir / dataset_name, [vbm_nifti.get_filename()])
 # Get actually used winlimits
 win_limits = agg_func_params['winsorized_mean']['limits']
 
@@ -173,13 +223,13 @@ for agg_name in gmd_parcellations.keys():
     # save in SQLite
     logger.info(f'Export dataframe for {agg_name} to SQLite database '
                 f'in "{results_path.as_posix()}".')
-    if agg_name == 'winsorized_mean':
+    if agg_name in ['winsorized_mean', 'trimmed_mean']:
         save_features(
             df=gmd_df,
             uri=results_uri,
             kind='gmd',
             atlas_name=atlas_name,
-            agg_function='winsorized_mean_limits_'
+            agg_function=f'{agg_name}_limits_'
                          + str(win_limits[0]).replace('.', '') +
                          '_'+str(win_limits[1]).replace('.', '')
             )
@@ -10,7 +10,7 @@ import pandas as pd
 from confoundcontinuum.logging import configure_logging, log_versions
 from confoundcontinuum.logging import logger
 import confoundcontinuum.atlases as atl
-from confoundcontinuum.features import get_gmd, get_vbm
+from confoundcontinuum.features import drop_dataset_files, get_gmd, get_vbm
 from confoundcontinuum.io import save_features
 
 # workaround to import datalad when using with ipykernel
@@ -36,7 +36,8 @@ atlas_names = [x for x in atl.list_atlases() if x.startswith('Tian')]
 parser = ArgumentParser(
     description='Extract grey matter density (GMD) of VBM data per ROI. '
     'INPUT parameters required: --results, --rois, --subid, --ses. '
-    'INPUT parameters optional: --tmp, --atlasdir, --winlim. '
+    'INPUT parameters optional: --tmp, --atlasdir, --winlim, --datasetdir, '
+    '--vbmcache, --vbmcachesize. '
     'See parameter help for more information.'
     ' ROIs are defined by the Tian subcortical atlas (Tian et al., 2020). '
     ' Different valid scales from I to IV can be applied. It can be chosen '
@@ -72,14 +73,17 @@ parser.add_argument(
 # aggregation methods (defaults are set in motorpred.features.get_gmd())
 parser.add_argument(
     '--aggmethod', metavar='aggmethod', type=str, nargs='+',
-    help='Aggregation method to summarize gray matter density per ROI.'
-         'Check valid inputs via helper of motorpred.featured.get_gmd().')
+    help='Aggregation method to summarize gray matter density per ROI. '
+         'All methods are computed from one pass over the VBM data. Valid '
+         'inputs: winsorized_mean, trimmed_mean, mean, std, median and '
+         'quantile_<q> (e.g. quantile_0.25). Check '
+         'confoundcontinuum.features._get_funcbyname() for details.')
 
 # limits for winsorizing mean
 parser.add_argument(
     '--winlim', metavar='winlim', type=float, nargs='+',
-    help='Lower and upper limit for application of winsorized mean to '
-         'aggregate GMD per ROI. The limits need to be provided as 2 '
+    help='Lower and upper limit for application of winsorized (or trimmed) '
+         'mean to aggregate GMD per ROI. The limits need to be provided as 2 '
          'floats between 0 and 1 in decimal notation of per cent values (e.g.'
          ' 0.1 0.1).')
 
@@ -91,6 +95,36 @@ parser.add_argument(
          'containing chosen aggregation_methods of GMD per ROI. '
          'Specify as </path/to/results>/<name_of_database.sqlite>. ')
 
+# atlas directory
+parser.add_argument(
+    '--atlasdir', metavar='atlasdir', type=str, default=None,
+    help='Path of the atlas store (see 0_import_atlases.py, atlases are '
+         'read in place without network access) or where to find (or '
+         'download) the atlases. Defaults to a download into a temporary '
+         'directory.')
+
+# shared local clone of the VBM dataset
+parser.add_argument(
+    '--datasetdir', metavar='datasetdir', type=str, default=None,
+    help='Directory for a local clone of the VBM datalad dataset shared by '
+         'all jobs on a node (e.g. on node-local scratch). The dataset is '
+         'cloned only once and each job only gets and drops its own niftis. '
+         'Defaults to a fresh clone in a temporary directory.')
+
+# local VBM cache
+parser.add_argument(
+    '--vbmcache', metavar='vbmcache', type=str, default=None,
+    help='Path of a local cache for the VBM niftis. Niftis are stored there '
+         'uncompressed and are neither fetched nor decompressed again by '
+         'later jobs. Defaults to no cache.')
+
+# maximum size of the local VBM cache
+parser.add_argument(
+    '--vbmcachesize', metavar='vbmcachesize', type=float, default=None,
+    help='Maximum size of the VBM cache in GB. The least recently used '
+         'niftis are removed from the cache when it is exceeded. Defaults to '
+         'an unbounded cache.')
+
 # pass input parameters to variables
 args = parser.parse_args()
 subid = args.subid
@@ -98,22 +132,30 @@ session = args.ses
 agg_methods = args.aggmethod
 win_limits = args.winlim
 results_path = Path(args.results)
+dataset_dir = args.datasetdir
+atlas_dir = args.atlasdir
+vbm_cache_dir = args.vbmcache
+vbm_cache_size = (
+    None if args.vbmcachesize is None else args.vbmcachesize * 1e9)
 
 # check parsed arguments and give user info
 # atlasname (atlas name checked in motorpred.atlases._retrieve_tian)
 # aggregation methods (validity checked in motorpred.features._get_funcbyname)
 # winsorize mean limits (check if argument needed,
 # validity of limits checked in motorpred.features._get_funcbyname)
-if ('winsorized_mean' in agg_methods) and (win_limits is None):
+uses_limits = any(
+    x in agg_methods for x in ['winsorized_mean', 'trimmed_mean'])
+if uses_limits and (win_limits is None):
     logger.warning(
         "The limits argument for the aggregation option \'winsorized mean\'"
-        "is required but was not specified. The default limits as defined "
-        "in motorpred.features.get_gmd will therefore be used.")
-elif ('winsorized_mean' not in agg_methods) and (win_limits is not None):
+        " or \'trimmed mean\' is required but was not specified. The default "
+        "limits as defined in motorpred.features.get_gmd will therefore be "
+        "used.")
+elif (not uses_limits) and (win_limits is not None):
     logger.warning(
         "The limits for aggregation option \'winsorized mean\' were set "
-        "although the \'winsorized mean\' was not chosen as aggregation "
-        "option.")
+        "although neither the \'winsorized mean\' nor the \'trimmed mean\' "
+        "was chosen as aggregation option.")
 # results (check existance of parent directory without DB file name!!)
 results_path.parent.mkdir(exist_ok=True, parents=True)
 results_uri = f'sqlite:///{results_path.as_posix()}'
@@ -131,23 +173,20 @@ with tempfile.TemporaryDirectory() as tmpdir:
     tmp_data = Path(tmpdir) / 'data'
     tmp_masks = tmp_data / 'masks'  # directory to save atlases
     tmp_masks.mkdir(exist_ok=True, parents=True)
+    if atlas_dir is None:
+        atlas_dir = tmp_masks
+    vbm_dir = tmp_data if dataset_dir is None else Path(dataset_dir)
 
     # VBM - clone, get, load
     logger.info('Retrieve VBM nifti from datalad dataset with repo URL '
-                f'{CAT_REPO_URL} to temporary directory {tmp_data}.')
-    vbm_nifti = get_vbm(CAT_REPO_URL, tmp_data, dataset_name, subid, session)
+                f'{CAT_REPO_URL} to {vbm_dir}.')
+    vbm_nifti = get_vbm(
+        CAT_REPO_URL, vbm_dir, dataset_name, subid, session,
+        cache_dir=vbm_cache_dir, cache_size=vbm_cache_size)
 
-    # set atlas parameters
     for atlas_name in atlas_names:
-        scale = atl._available_atlases[atlas_name]['scale']
-        field = atl._available_atlases[atlas_name]['magneticfield']
-        space = atlas_name.split('x')[-1]
-        resolution = min(
-            atl._available_atlases[atlas_name]['valid_resolutions'])
-        # get atlas
-        atlas_img, atlas_labels, _ = atl.load_atlas(
-            name=atlas_name, atlas_dir=tmp_masks, resolution=resolution,
-            scale=scale, space=space, magneticfield=field)
+        # get atlas (highest valid resolution)
+        atlas_img, atlas_labels, _ = atl.get_atlas(atlas_name, atlas_dir)
 
         # resample atlas and get GMD
         logger.info(
@@ -172,13 +211,13 @@ with tempfile.TemporaryDirectory() as tmpdir:
             # save in SQLite
             logger.info(f'Export dataframe for {agg_name} to SQLite database '
                         f'in "{results_path.as_posix()}".')
-            if agg_name == 'winsorized_mean':
+            if agg_name in ['winsorized_mean', 'trimmed_mean']:
                 save_features(
                     df=gmd_df,
                     uri=results_uri,
                     kind='gmd',
                     atlas_name=atlas_name,
-                    agg_function='winsorized_mean_limits_'
+                    agg_function=f'{agg_name}_limits_'
                                  + str(win_limits[0]).replace('.', '') +
                                  '_'+str(win_limits[1]).replace('.', '')
                     )
@@ -199,6 +238,10 @@ with tempfile.TemporaryDirectory() as tmpdir:
             f'results) 1 sbj, for atlas {atlas_name}. Elapsed time: '
             f'{elapsed_time} s.\n')
 
+    if dataset_dir is not None and vbm_cache_dir is None:
+        drop_dataset_files(
+            vbm_dir / dataset_name, [vbm_nifti.get_filename()])
+
 # info and compute time
 elapsed_time = time.time() - start_time
 logger.info('PROCESSING DONE for GMD computation (including saving '
@@ -2,7 +2,7 @@
 # imports
 import os
 from pathlib import Path
-from confoundcontinuum.io import read_features
+from confoundcontinuum.io import iter_features, read_features
 import datatable as dt
 
 from confoundcontinuum.logging import configure_logging, log_versions, logger
@@ -44,42 +44,30 @@ agg_fct = (
         '_'+str(win_limits[1]).replace('.', '')
     )
 
-# Read in
-win_mean_df_dict = {}
+# rows per chunk read from the databases (bounds the memory of the cohorts)
+chunksize = 5000
+
+# read in chunks, convert and save
 for feature_dir, atlas_name, feature_name in zip(feature_dirs, atlas_names, feature_names):  # noqa
     feature_fname = root_dir / feature_dir / feature_name
     feature_uri = f'sqlite:///{feature_fname.as_posix()}'
 
-    # Read in
     logger.info(
         f'Reading in GMV {atlas_name} from {feature_dir}')
-    win_mean_df = read_features(
-        uri=feature_uri,
-        kind='gmd',
-        atlas_name=atlas_name,
-        index_col=['SubjectID', 'Session'],
-        agg_function=agg_fct,
-    )
-    # aggregate in dict
-    win_mean_df_dict[atlas_name] = win_mean_df
-
-# keep 2nd session only
-GMV = {
-    key: win_mean.xs('ses-2', level=1, drop_level=True).copy()
-    for (key, win_mean) in win_mean_df_dict.items()}
-
-# convert and save
-cortical_gmv_df = GMV['schaefer2018_1000parcels'].reset_index(level=0)
-subcortical_gmv_df = GMV['Tian4x3TxMNInonlinear2009cAsym'].reset_index(level=0)
-cerebellar_gmv_df = GMV['SUITxMNI'].reset_index(level=0)
-
-cortical_gmv_dt = dt.Frame(cortical_gmv_df)
-subcortical_gmv_dt = dt.Frame(subcortical_gmv_df)
-cerebellar_gmv_dt = dt.Frame(cerebellar_gmv_df)
-
-cortical_gmv_dt.to_jay((out / '1_gmd_schaefer_all_subjects.jay').as_posix())
-subcortical_gmv_dt.to_jay((out / '4_gmd_tian_all_subjects.jay').as_posix())
-cerebellar_gmv_dt.to_jay((out / '2_gmd_SUIT_all_subjects.jay').as_posix())
+    gmv_dt = dt.Frame()
+    # keep 2nd session only
+    for win_mean_df in iter_features(
+            uri=feature_uri,
+            kind='gmd',
+            atlas_name=atlas_name,
+            index_col=['SubjectID', 'Session'],
+            agg_function=agg_fct,
+            chunksize=chunksize,
+            sessions=['ses-2'],
+    ):
+        gmv_dt.rbind(dt.Frame(
+            win_mean_df.reset_index(level=1, drop=True).reset_index(level=0)))
+    gmv_dt.to_jay((out / feature_fname.with_suffix('.jay').name).as_posix())
 
 logger.info('Gray matter volumes converted and saved to .jay files.')
 
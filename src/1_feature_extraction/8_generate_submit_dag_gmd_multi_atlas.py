@@ -0,0 +1,112 @@
+# %%
+import os
+from pathlib import Path
+import tempfile
+
+import nest_asyncio
+nest_asyncio.apply()
+import datalad.api as dl  # noqa E402
+
+# %% define variables and paths
+
+# URL to datalad dataset to clone in temporary directory to get file names
+REPO_URL = 'ria+http://ukb.ds.inm7.de#~cat_m0wp1'
+
+# RUN THINGS IN ROOT DIRECTORY OF PROJECT!
+project_dir = Path(os.getcwd())
+
+# directory of actual python script to be run for feature extraction
+script_dir = project_dir / 'src' / '1_feature_extraction'
+
+# check existance results directory
+results_dir = (
+    project_dir / 'results' / '1_feature_extraction' / '8_gmd_multi_atlas' /
+    'databases')
+results_dir.mkdir(exist_ok=True, parents=True)
+
+# check existance log directory
+logs_dir = (
+    project_dir / 'results' / '1_feature_extraction' / '8_gmd_multi_atlas' /
+    'logs')
+logs_dir.mkdir(exist_ok=True, parents=True)
+
+submit_fname = script_dir / '8_gmd_multi_atlas.submit'
+dag_fname = script_dir / '8_gmd_multi_atlas.dag'
+
+# atlases parcellated from one VBM load per subject
+atlas_names = (
+    [f'Schaefer{n_rois}x7' for n_rois in range(100, 1100, 100)] +
+    ['Tian4x3TxMNInonlinear2009cAsym', 'SUITxMNI'])
+
+# subjects per job (atlases are loaded and resampled once per job) and
+# worker processes per job
+chunk_size = 50
+n_jobs = 4
+
+# %% define preamble
+
+# define arguments for executable here
+exec_string = (
+    '8_gmd_multi_atlas.py '
+    f'--results {results_dir.as_posix()}'
+    '/8_gmd_multi_atlas_chunk$(chunk).sqlite '
+    f'--atlasnames {" ".join(atlas_names)} '
+    '--aggmethod winsorized_mean mean std count sum sumsq '
+    f'--njobs {n_jobs} '
+    '--subid $(subjects) '
+    '--ses $(sessions)'
+)
+
+preamble = f"""
+# The environment
+universe = vanilla
+getenv = True
+
+# Resources
+request_cpus = {n_jobs}
+request_memory = {1.6 * n_jobs:.1f}G
+request_disk = {500 * chunk_size}
+
+# Executable
+initial_dir = {script_dir}
+executable = $(initial_dir)/run_in_venv.sh
+transfer_executable = False
+
+arguments = {exec_string}
+
+# Logs
+log = {logs_dir}/8_gmd_multi_atlas_chunk$(chunk).log
+output = {logs_dir}/8_gmd_multi_atlas_chunk$(chunk).out
+error = {logs_dir}/8_gmd_multi_atlas_chunk$(chunk).err
+"""
+
+with open(submit_fname, 'w') as submit_file:
+    submit_file.write(preamble)
+    submit_file.write('queue\n')
+
+# %% Get subject and session name from datalad dataset and create dag-file
+
+# Clone dataset into temporary directory
+with tempfile.TemporaryDirectory() as tmpdir:
+    dl.install(path=tmpdir, source=REPO_URL)  # type: ignore
+    # path were symbolic links lie
+    db_dir = Path(tmpdir) / 'm0wp1'
+
+    # get all filenames which end with .nii.gz in directory in list
+    files = [x.name for x in db_dir.glob('*.nii.gz')]
+
+
+# Get all subject and session names from file list
+subjects = [fname.split('_')[0][5:] for fname in files]
+sessions = [fname.split('_')[1] for fname in files]
+
+with open(dag_fname, 'w') as dag_file:
+    # one job per chunk of subject/session pairs
+    for i_job, i_start in enumerate(range(0, len(files), chunk_size)):
+        chunk_subjects = subjects[i_start:i_start + chunk_size]
+        chunk_sessions = sessions[i_start:i_start + chunk_size]
+
+        dag_file.write(f'JOB job{i_job} {submit_fname}\n')
+        dag_file.write(f'VARS job{i_job} chunk="{i_job}" '
+                       f'subjects="{" ".join(chunk_subjects)}" '
+                       f'sessions="{" ".join(chunk_sessions)}"\n\n')
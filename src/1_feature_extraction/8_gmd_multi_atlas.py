@@ -0,0 +1,424 @@
+# %%
+# import packages
+import os
+from pathlib import Path
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from functools import partial
+
+import numpy as np
+import pandas as pd
+import nibabel as nib
+
+from confoundcontinuum.logging import configure_logging, log_versions
+from confoundcontinuum.logging import logger, raise_error
+import confoundcontinuum.atlases as atl
+from confoundcontinuum.features import (
+    drop_dataset_files, get_cached_atlas_index, get_dataset_files,
+    get_gmd_subjects, get_vbm_fnames)
+from confoundcontinuum.io import (
+    FeatureShardWriter, get_missing_feature_shards, get_missing_features,
+    save_features)
+
+if __name__ == '__main__':
+    # %%
+    # configure logging
+
+    configure_logging()
+    log_versions()
+
+    # %%
+    # set up
+
+    # fix definitions
+    CAT_REPO_URL = 'ria+http://ukb.ds.inm7.de#~cat_m0wp1'
+    dataset_name = 'cat_m0wp1'
+
+    # RUN THINGS IN ROOT DIRECTORY OF PROJECT!
+    project_dir = Path(os.getcwd())
+    default_cache_dir = project_dir / 'data' / 'masks' / 'atlas_index'
+    default_prefetch = 2
+
+    # pipeline help (parser)
+    parser = ArgumentParser(
+        description='Extract grey matter density (GMD) of VBM data per ROI '
+        'for several atlases and a batch of subjects at once. The VBM nifti '
+        'of a subject is cloned, fetched and loaded only once and then '
+        'parcellated with all atlases. The atlases are loaded and resampled '
+        'once per batch and the subjects are processed in parallel in a local '
+        'process pool. '
+        'INPUT parameters required: --results, --atlasnames, --subid, --ses. '
+        'INPUT parameters optional: --aggmethod, --winlim, --atlasdir, '
+        '--cachedir, --njobs, --datasetdir, --vbmcache, --vbmcachesize, '
+        '--prefetch, --format, --qc. '
+        'See parameter help for more information. '
+        'Dimensionality within ROIs is reduced by the chosen aggregation '
+        'methods (default: winsorized mean with limits 10%, mean and standard '
+        'deviation). These values are exported in a SQLite database to the '
+        'directory specified in --results. Subjects, atlases and aggregations '
+        'already completed in the database or the shards (see their '
+        'manifest) are skipped, so that reruns and new atlases only compute '
+        'the missing work.'
+    )
+
+    # PARSER INPUT ARGUMENTS
+
+    # DATA INPUT related
+    # subject IDs
+    parser.add_argument(
+        '--subid', metavar='subid', type=str, required=True, nargs='+',
+        help='Subject IDs in accordance with the subject IDs from the '
+             'respective database input files (see datlad dataset '
+             f'{CAT_REPO_URL}).')
+
+    # Session IDs
+    parser.add_argument(
+        '--ses', metavar='session', type=str, required=True, nargs='+',
+        help='Session IDs in accordance with the recording session indicated '
+             'in the VBM input files (see datalad dataset '
+             f'{CAT_REPO_URL}). Needed for unambigous subject-recording '
+             'distinction. One session per subject ID in --subid. Valid '
+             'input: "ses-2" or "ses-3".')
+
+    # ATLAS related
+    # atlas names
+    parser.add_argument(
+        '--atlasnames', metavar='atlasnames', type=str, nargs='+',
+        required=True,
+        help='Atlas names to use for parcellation of gray matter density '
+             '(GMD). Specify by name of atlas as listed in '
+             'confoundcontinuum.atlases.list_atlases(), e.g. Schaefer100x7 '
+             'Tian4x3TxMNInonlinear2009cAsym SUITxMNI.')
+
+    # atlas directory
+    parser.add_argument(
+        '--atlasdir', metavar='atlasdir', type=str, default=None,
+        help='Path of the atlas store (see 0_import_atlases.py, atlases are '
+             'read in place without network access) or where to find (or '
+             'download) the atlases. Defaults to $HOME/junifer/data/atlas.')
+
+    # path to cache the atlases resampled to the VBM grid
+    parser.add_argument(
+        '--cachedir', metavar='cachedir', type=str, default=default_cache_dir,
+        help='Path where to cache the atlases resampled to the VBM grid and '
+             'their voxel-to-ROI index. Atlases found in the cache are not '
+             f'resampled again. Defaults to {default_cache_dir}')
+
+    # shared local clone of the VBM dataset
+    parser.add_argument(
+        '--datasetdir', metavar='datasetdir', type=str, default=None,
+        help='Directory for a local clone of the VBM datalad dataset shared '
+             'by all jobs on a node (e.g. on node-local scratch). The dataset '
+             'is cloned only once and each job only gets and drops its own '
+             'niftis. Defaults to a fresh clone in a temporary directory.')
+
+    # number of worker processes
+    parser.add_argument(
+        '--njobs', metavar='njobs', type=int, default=1,
+        help='Number of worker processes to process the subjects in '
+             'parallel. Defaults to 1.')
+
+    # DATA OUTPUT related
+    # aggregation methods (defaults are set in
+    # confoundcontinuum.features.get_gmd)
+    parser.add_argument(
+        '--aggmethod', metavar='aggmethod', type=str, nargs='+',
+        help='Aggregation method to summarize gray matter density per ROI. '
+             'All methods are computed from one pass over the VBM data. '
+             'Valid inputs: winsorized_mean, trimmed_mean, mean, std, median '
+             'and quantile_<q> (e.g. quantile_0.25). The sufficient '
+             'statistics count, sum, sumsq and hist_<n_bins> (histogram '
+             'sketch, e.g. hist_64) allow to derive coarser parcellations '
+             'later (see '
+             'confoundcontinuum.features.aggregate_roi_stats()). Check '
+             'confoundcontinuum.features._get_funcbyname() for details.')
+
+    # limits for winsorizing mean
+    parser.add_argument(
+        '--winlim', metavar='winlim', type=float, nargs='+',
+        help='Lower and upper limit for application of winsorized (or '
+             'trimmed) mean to aggregate GMD per ROI. The limits need to be '
+             'provided as 2 floats between 0 and 1 in decimal notation of per '
+             'cent values (e.g. 0.1 0.1).')
+
+    # results directory
+    # path to where to store results (pipeline output)
+    parser.add_argument(
+        '--results', metavar='results', type=str, required=True,
+        help='Path where to store the results as SQLite database, '
+             'containing chosen aggregation_methods of GMD per ROI for all '
+             'atlases and subjects. Specify as '
+             '</path/to/results>/<name_of_database.sqlite>. With --format '
+             'parquet, path of the directory of the Parquet shards.')
+
+    # output format
+    parser.add_argument(
+        '--format', metavar='format', type=str, default='sqlite',
+        choices=['sqlite', 'parquet'],
+        help='Output format. sqlite: save the results in the SQLite database '
+             '--results. parquet: append the results to one Parquet shard per '
+             'table in the directory --results (one shard per job, see '
+             '11_compact_feature_shards.py for the cohort-wide tables). The '
+             'work completed in the shards is recorded in their manifest and '
+             'carried over to the database by the compaction. Defaults to '
+             'sqlite.')
+
+    # local VBM cache
+    parser.add_argument(
+        '--vbmcache', metavar='vbmcache', type=str, default=None,
+        help='Path of a local cache for the VBM niftis. Niftis are stored '
+             'there uncompressed and are neither fetched nor decompressed '
+             'again by later jobs. Defaults to no cache.')
+
+    # maximum size of the local VBM cache
+    parser.add_argument(
+        '--vbmcachesize', metavar='vbmcachesize', type=float, default=None,
+        help='Maximum size of the VBM cache in GB. The least recently used '
+             'niftis are removed from the cache when it is exceeded. Defaults '
+             'to an unbounded cache.')
+
+    # number of VBM niftis fetched ahead
+    parser.add_argument(
+        '--prefetch', metavar='prefetch', type=int, default=default_prefetch,
+        help='Number of VBM niftis fetched from the datalad dataset in the '
+             'background ahead of the ones being processed. Niftis are '
+             'dropped once processed, so only a few of them are on disk at a '
+             'time. Not used with --vbmcache (all niftis are cached upfront). '
+             f'Defaults to {default_prefetch}.')
+
+    # quality control metrics
+    parser.add_argument(
+        '--qc', action='store_true',
+        help='Also save quality control metrics per ROI (number of voxels, '
+             'fraction of zero and of non-finite voxels, min, max and number '
+             'of winsorized voxels), computed from the same voxel values as '
+             'the aggregations, as tables qc_<metric> next to the GMD '
+             'tables.')
+
+    # pass input parameters to variables
+    args = parser.parse_args()
+    subids = args.subid
+    sessions = args.ses
+    atlas_names = args.atlasnames
+    atlas_dir = None if args.atlasdir is None else Path(args.atlasdir)
+    cache_dir = Path(args.cachedir)
+    agg_methods = args.aggmethod
+    win_limits = args.winlim
+    n_jobs = args.njobs
+    dataset_dir = args.datasetdir
+    results_path = Path(args.results)
+    vbm_cache_dir = args.vbmcache
+    vbm_cache_size = (
+        None if args.vbmcachesize is None else args.vbmcachesize * 1e9)
+    prefetch = args.prefetch
+    output_format = args.format
+    qc = args.qc
+
+    # check parsed arguments and give user info
+    # subjects and sessions
+    if len(subids) != len(sessions):
+        raise_error(
+            f'The number of subject IDs ({len(subids)}) and sessions '
+            f'({len(sessions)}) differ.')
+    logger.info(
+        f'GMD will be computed for {len(subids)} subject(s) with {n_jobs} '
+        'worker process(es).')
+    # atlasnames
+    invalid_atlases = [x for x in atlas_names if x not in atl.list_atlases()]
+    if len(invalid_atlases) > 0:
+        raise_error(
+            f'Invalid atlas names {invalid_atlases}. Valid atlases: '
+            f'{atl.list_atlases()}.')
+    logger.info(f'GMD will be computed for the atlases {atlas_names}.')
+    # aggregation methods (validity checked in features._get_funcbyname)
+    # winsorize mean limits (check if argument needed,
+    # validity of limits checked in features._get_funcbyname)
+    uses_limits = (agg_methods is None) or any(
+        x in agg_methods for x in ['winsorized_mean', 'trimmed_mean'])
+    if uses_limits and (win_limits is None):
+        logger.warning(
+            "The limits argument for the aggregation option \'winsorized "
+            "mean\' or \'trimmed mean\' is required but was not specified. "
+            "The default limits as defined in "
+            "confoundcontinuum.features.get_gmd will therefore be used.")
+    elif (not uses_limits) and (win_limits is not None):
+        logger.warning(
+            "The limits for aggregation option \'winsorized mean\' were set "
+            "although neither the \'winsorized mean\' nor the \'trimmed "
+            "mean\' was chosen as aggregation option.")
+    # resolve the defaults of confoundcontinuum.features.get_gmd to name the
+    # tables
+    if agg_methods is None:
+        agg_methods = ['winsorized_mean', 'mean', 'std']
+    if win_limits is None:
+        win_limits = [0.1, 0.1]
+    agg_functions = {
+        x: (f'{x}_limits_' + str(win_limits[0]).replace('.', '') +
+            '_' + str(win_limits[1]).replace('.', ''))
+        if x in ['winsorized_mean', 'trimmed_mean'] else x
+        for x in agg_methods}
+    # quality control metrics (see confoundcontinuum.features.get_roi_qc)
+    if qc:
+        agg_functions.update({
+            f'qc_{x}': f'qc_{x}' for x in [
+                'n_voxels', 'zero_fraction', 'nonfinite_fraction', 'min',
+                'max']})
+        agg_functions['qc_n_winsorized'] = (
+            'qc_n_winsorized_limits_' + str(win_limits[0]).replace('.', '') +
+            '_' + str(win_limits[1]).replace('.', ''))
+        logger.info('Quality control metrics per ROI will be saved.')
+    # results (check existance of parent directory without DB file name!!)
+    results_path.parent.mkdir(exist_ok=True, parents=True)
+    results_uri = f'sqlite:///{results_path.as_posix()}'
+    shard_writer = None
+    if output_format == 'parquet':
+        shard_writer = FeatureShardWriter(results_path)
+    logger.info('Aggregated GMD per ROI will be saved (results directory) in '
+                f'{results_path.as_posix()}')
+    # skip the work completed in the results database or in the shards
+    # (rerun of failed jobs or new atlases)
+    if output_format == 'sqlite':
+        get_missing = partial(get_missing_features, results_uri)
+    else:
+        get_missing = partial(get_missing_feature_shards, results_path)
+    # parameters of the manifest per atlas (the aggregations and their
+    # limits are part of the table names)
+    manifest_params = {
+        x: {'atlas_resolution': atl.get_atlas_kwargs(x).get('resolution')}
+        for x in atlas_names}
+    missing_features = pd.concat([
+        get_missing(
+            pd.MultiIndex.from_arrays(
+                [subids, sessions], names=['SubjectID', 'Session']),
+            kind='gmd', atlas_names=[atl.get_features_atlas_name(x)],
+            agg_functions=list(agg_functions.values()),
+            params=manifest_params[x])
+        for x in atlas_names], ignore_index=True)
+    missing_subjects = set(
+        missing_features[['SubjectID', 'Session']].itertuples(
+            index=False, name=None))
+    atlas_names = [
+        x for x in atlas_names if atl.get_features_atlas_name(x) in
+        missing_features['atlas_name'].unique()]
+    subids, sessions = [
+        list(x) for x in zip(*[
+            (t_sub, t_ses) for t_sub, t_ses in zip(subids, sessions)
+            if (t_sub, t_ses) in missing_subjects])] or [[], []]
+    if len(subids) == 0:
+        logger.info('PROCESSING DONE: nothing left to compute in '
+                    f'{results_path.as_posix()}.')
+        sys.exit(0)
+    logger.info(
+        f'Missing work: {len(subids)} subject(s) for the atlases '
+        f'{atlas_names}.')
+
+    # %%
+    # process (atlases loaded and resampled once, VBM loaded once per subject)
+
+    start_time = time.time()
+
+    # Clone dataset into temporary directory
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # sub-directories (existance checked by subfunctions or datalad)
+        tmp_data = Path(tmpdir) / 'data'
+        vbm_dir = tmp_data if dataset_dir is None else Path(dataset_dir)
+
+        # VBM - clone once (per node), get all niftis of the batch into the
+        # cache or only the first one (grid) and the others while processing
+        logger.info('Retrieve VBM niftis from datalad dataset with repo URL '
+                    f'{CAT_REPO_URL} to {vbm_dir}.')
+        vbm_fnames = get_vbm_fnames(
+            CAT_REPO_URL, vbm_dir, dataset_name, subids, sessions,
+            cache_dir=vbm_cache_dir, cache_size=vbm_cache_size,
+            get=False)
+        install_dir = None if vbm_cache_dir is not None else (
+            vbm_dir / dataset_name)
+        if install_dir is not None:
+            get_dataset_files(install_dir, vbm_fnames[:1])
+
+        # get atlases and resample them once to the (shared) VBM grid (cached
+        # on disk for later jobs)
+        vbm_grid = nib.load(vbm_fnames[0].as_posix())  # header only
+        atlas_indexes = {}
+        atlas_labels = {}
+        for atlas_name in atlas_names:
+            atlas_img, atlas_labels[atlas_name], _ = atl.get_atlas(
+                atlas_name, atlas_dir)
+            atlas_indexes[atlas_name] = get_cached_atlas_index(
+                atlas_name, atlas_img, vbm_grid, cache_dir)
+
+        # get GMD of all subjects (in parallel)
+        logger.info(f'Start GMD computation for {atlas_names}.')
+        gmd_subjects, _ = get_gmd_subjects(
+            vbm_fnames, atlas_indexes, aggregation=agg_methods,
+            limits=win_limits, n_jobs=n_jobs, dataset_dir=install_dir,
+            prefetch=prefetch, qc=qc)
+        if install_dir is not None:
+            drop_dataset_files(install_dir, vbm_fnames[:1])
+
+    # save GMD (one table per atlas and aggregation for the whole batch)
+    gmd_index = pd.MultiIndex.from_arrays(
+        [subids, sessions], names=['SubjectID', 'Session'])
+    for atlas_name in atlas_names:
+        table_atlas_name = atl.get_features_atlas_name(atlas_name)
+        for agg_name in gmd_subjects[0][atlas_name].keys():
+            # create dataframe
+            logger.info(
+                f'Create dataframe for {agg_name} for GMD ({atlas_name}).')
+            gmd_values = np.stack(
+                [x[atlas_name][agg_name] for x in gmd_subjects])
+            if gmd_values.ndim == 3:
+                # histogram sketch: one row per subject and bin
+                t_index = pd.MultiIndex.from_tuples(
+                    [(*x, i_bin) for x in gmd_index
+                     for i_bin in range(gmd_values.shape[1])],
+                    names=['SubjectID', 'Session', 'Bin'])
+                gmd_values = gmd_values.reshape(-1, gmd_values.shape[2])
+            else:
+                t_index = gmd_index
+            gmd_df = pd.DataFrame(
+                gmd_values, index=t_index, columns=atlas_labels[atlas_name])
+
+            # save in SQLite (or the Parquet shards)
+            logger.info(f'Export dataframe for {agg_name} to {output_format} '
+                        f'in "{results_path.as_posix()}".')
+            agg_function = agg_functions[agg_name]
+            # do not save completed subjects again
+            t_missing = missing_features.query(
+                'atlas_name == @table_atlas_name and '
+                'agg_function == @agg_function')
+            t_subjects = pd.MultiIndex.from_arrays([
+                gmd_df.index.get_level_values('SubjectID'),
+                gmd_df.index.get_level_values('Session')])
+            gmd_df = gmd_df[t_subjects.isin(list(t_missing[
+                ['SubjectID', 'Session']].itertuples(
+                    index=False, name=None)))]
+            if len(gmd_df) == 0:
+                continue
+            if shard_writer is not None:
+                shard_writer.write(
+                    gmd_df, kind='gmd', atlas_name=table_atlas_name,
+                    agg_function=agg_function,
+                    manifest=manifest_params[atlas_name])
+            else:
+                save_features(
+                    df=gmd_df,
+                    uri=results_uri,
+                    kind='gmd',
+                    atlas_name=table_atlas_name,
+                    agg_function=agg_function,
+                    manifest=manifest_params[atlas_name],
+                    )
+    if shard_writer is not None:
+        shard_writer.close()
+    logger.info(f'Dataframes exported as {output_format}.')
+
+    # info and compute time
+    elapsed_time = time.time() - start_time
+    logger.info('PROCESSING DONE for GMD computation (including saving '
+                f'results) {len(subids)} sbj, for atlases {atlas_names}. '
+                f'Elapsed time: {elapsed_time} s.\n')
+
+    # %%
@@ -0,0 +1,125 @@
+# %%
+# import packages
+import os
+from pathlib import Path
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from nilearn import datasets, image
+
+from confoundcontinuum.logging import configure_logging, log_versions
+from confoundcontinuum.logging import logger
+from confoundcontinuum.features import build_voxel_matrix, get_vbm_fnames
+
+# workaround to import datalad when using with ipykernel
+import nest_asyncio
+nest_asyncio.apply()
+import datalad.api as dl  # noqa E402
+
+# %%
+# configure logging
+
+configure_logging()
+log_versions()
+
+# %%
+# set up
+
+# fix definitions
+CAT_REPO_URL = 'ria+http://ukb.ds.inm7.de#~cat_m0wp1'
+dataset_name = 'cat_m0wp1'
+
+# RUN THINGS IN ROOT DIRECTORY OF PROJECT!
+project_dir = Path(os.getcwd())
+default_output_dir = project_dir / 'data' / 'voxel_matrix'
+default_chunk_size = 100
+
+# pipeline help (parser)
+parser = ArgumentParser(
+    description='Write the VBM voxels inside a brain mask of all subjects '
+    'into one memory-mapped float32 voxel x subject matrix. ROI aggregations '
+    'of any atlas can then be computed for the whole cohort with '
+    '10_project_voxel_matrix.py instead of a Condor DAG. '
+    'INPUT parameters optional: --output, --mask, --chunksize. '
+    'See parameter help for more information.'
+)
+
+# output directory
+parser.add_argument(
+    '--output', metavar='output', type=str, default=default_output_dir,
+    help='Directory to save the voxel matrix to. '
+         f'Defaults to {default_output_dir}')
+
+# brain mask
+parser.add_argument(
+    '--mask', metavar='mask', type=str, default=None,
+    help='Path to a brain mask nifti on the VBM grid. Defaults to the MNI152 '
+         'brain mask of nilearn, resampled to the VBM grid.')
+
+# number of VBM niftis fetched at once
+parser.add_argument(
+    '--chunksize', metavar='chunksize', type=int, default=default_chunk_size,
+    help='Number of VBM niftis fetched from the datalad dataset at once. '
+         'Niftis are dropped again once written to the matrix. '
+         f'Defaults to {default_chunk_size}.')
+
+# pass input parameters to variables
+args = parser.parse_args()
+output_dir = Path(args.output)
+mask_fname = args.mask
+chunk_size = args.chunksize
+
+# %%
+# build voxel matrix
+
+start_time = time.time()
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    tmp_data = Path(tmpdir) / 'data'
+    install_dir = tmp_data / dataset_name
+
+    # get all subjects and sessions from the dataset
+    dl.install(path=install_dir, source=CAT_REPO_URL)  # type: ignore
+    files = sorted(x.name for x in (install_dir / 'm0wp1').glob('*.nii.gz'))
+    subids = [fname.split('_')[0][5:] for fname in files]
+    sessions = [fname.split('_')[1] for fname in files]
+    logger.info(f'{len(files)} VBM niftis found in {CAT_REPO_URL}.')
+
+    def _get_chunk(i_start):
+        return get_vbm_fnames(
+            CAT_REPO_URL, tmp_data, dataset_name,
+            subids[i_start:i_start + chunk_size],
+            sessions[i_start:i_start + chunk_size])
+
+    def _fetch_vbm(first_chunk):
+        """Yield the VBM niftis chunk by chunk, dropping written chunks"""
+        vbm_fnames = first_chunk
+        for i_start in range(0, len(files), chunk_size):
+            if i_start > 0:
+                vbm_fnames = _get_chunk(i_start)
+            yield from vbm_fnames
+            dl.drop(
+                path=[x.as_posix() for x in vbm_fnames], dataset=install_dir)
+
+    # brain mask on the VBM grid
+    first_chunk = _get_chunk(0)
+    if mask_fname is None:
+        logger.info('Resample MNI152 brain mask to the VBM grid.')
+        mask_nifti = image.resample_to_img(
+            datasets.load_mni152_brain_mask(),
+            image.load_img(first_chunk[0].as_posix()),
+            interpolation='nearest')
+    else:
+        mask_nifti = image.load_img(mask_fname)
+
+    build_voxel_matrix(
+        _fetch_vbm(first_chunk), list(zip(subids, sessions)),
+        mask_nifti, output_dir)
+
+# info and compute time
+elapsed_time = time.time() - start_time
+logger.info(f'PROCESSING DONE for voxel matrix of {len(files)} VBM niftis. '
+            f'Elapsed time: {elapsed_time} s.\n')
+
+# %%
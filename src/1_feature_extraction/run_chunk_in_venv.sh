@@ -0,0 +1,45 @@
+#!/bin/bash
+# Run a python script once per subject/session pair of a chunk of subjects.
+# Usage: run_chunk_in_venv.sh "<subjects>" "<sessions>" <script.py> <args>
+# {subject} and {session} in <args> are replaced for each pair.
+
+eval "$(conda shell.bash hook)"
+
+conda activate /home/vkomeyer/miniconda3/envs/confound_continuum
+if [ $? -ne 0 ]; then
+    echo "Error activating the environment"
+    exit -1
+fi
+
+conda info
+echo $PATH
+
+export MKL_NUM_THREADS=1
+export OPENBLAS_NUM_THREADS=1
+export NUMEXPR_NUM_THREADS=1
+export OMP_NUM_THREADS=1
+
+subjects=($1)
+sessions=($2)
+shift 2
+
+n_failed=0
+for i in "${!subjects[@]}"; do
+    args=()
+    for arg in "$@"; do
+        arg=${arg//\{subject\}/${subjects[$i]}}
+        args+=("${arg//\{session\}/${sessions[$i]}}")
+    done
+    echo "Run ${subjects[$i]} ${sessions[$i]}"
+    python "${args[@]}"
+    if [ $? -ne 0 ]; then
+        echo "Error processing ${subjects[$i]} ${sessions[$i]}"
+        n_failed=$((n_failed + 1))
+    fi
+done
+
+# fail the job if any subject failed (the remaining ones are processed)
+if [ $n_failed -ne 0 ]; then
+    echo "${n_failed} of ${#subjects[@]} subjects failed"
+    exit 1
+fi
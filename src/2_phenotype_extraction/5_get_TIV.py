@@ -7,16 +7,18 @@ import tempfile
 import pandas as pd
 
 from confoundcontinuum.logging import logger, raise_error
+from confoundcontinuum.features import (
+    drop_dataset_files, get_dataset, get_dataset_files)
 
-import nest_asyncio
-nest_asyncio.apply()
-import datalad.api as dl  # noqa E402
 # %%
 # set params
 
 # input
 feature = 'all_gmv'
 shuffle_feature = False
+# directory of a local clone of the VBM dataset shared with other jobs (e.g.
+# on node-local scratch), None: fresh clone in a temporary directory
+dataset_dir = None
 
 # %%
 # directories
@@ -40,7 +42,9 @@ tiv_out_fname = (
 with tempfile.TemporaryDirectory() as tmpdir:
     # Define tmp subdirectories
     tmp_db_path = Path(tmpdir) / 'data'
-    tmp_cat_inst_dir = tmp_db_path / 'cat_m0wp1'
+    tmp_cat_inst_dir = (
+        tmp_db_path if dataset_dir is None else Path(dataset_dir)
+        ) / 'cat_m0wp1'
     tmp_tiv_fname = tmp_cat_inst_dir / 'stats' / tiv_in_name
 
     # Create the directories if they do not exist
@@ -49,7 +53,7 @@ with tempfile.TemporaryDirectory() as tmpdir:
     # Clone VBM datalad dataset
     logger.info(
         f'Cloning VBM datalad dataset from {REPO_URL} to {tmp_cat_inst_dir}')
-    dl.install(path=tmp_cat_inst_dir, source=REPO_URL)  # type: ignore
+    get_dataset(REPO_URL, tmp_cat_inst_dir)
     logger.info('Dataset cloned.')
 
     # check if symbolic link of cloned file exists
@@ -58,7 +62,7 @@ with tempfile.TemporaryDirectory() as tmpdir:
 
     # Get TIV file
     logger.info('Get TIV file.')
-    dl.get(path=tmp_tiv_fname, dataset=tmp_cat_inst_dir)
+    get_dataset_files(tmp_cat_inst_dir, [tmp_tiv_fname])
     logger.info('Got TIV file.')
 
     # load VBM as nifti, resolution 1.5 mm
@@ -68,6 +72,8 @@ with tempfile.TemporaryDirectory() as tmpdir:
         index_col=['SubjectID', 'Session'])
     TIV = TIV.xs('ses-2', level=1, drop_level=True).copy()
     logger.info('TIV loaded.')
+    if dataset_dir is not None:
+        drop_dataset_files(tmp_cat_inst_dir, [tmp_tiv_fname])
 
     # save TIV to .csv
     TIV.to_csv(tiv_out_fname)
@@ -3,7 +3,10 @@
 import os
 from pathlib import Path
 from confoundcontinuum.pipelines import feature_choice
+from confoundcontinuum.features import (
+    correlate_voxel_matrix, load_voxel_matrix, voxel_matrix_to_nifti)
 import numpy as np
+import nibabel as nib
 
 import pandas as pd
 import datatable as dt
@@ -22,6 +25,10 @@ import datalad.api as dl  # noqa E402
 # input
 feature = 'all_gmv'
 shuffle_feature = False
+# correlate the confounds with the GMD of every voxel (voxel matrix of
+# src/1_feature_extraction/9_build_voxel_matrix.py) instead of the features
+voxelwise = False
+voxel_block_size = 1024  # number of voxels in memory at once
 
 # %%
 # directories
@@ -32,6 +39,7 @@ project_dir = Path(os.getcwd())
 base_dir = project_dir / 'results'
 feature_dir = base_dir / '1_feature_extraction' / 'extracted_features'
 phenotype_dir = base_dir / '2_phenotype_extraction'
+voxel_matrix_dir = project_dir / 'data' / 'voxel_matrix'
 
 out_dir = base_dir / '3_statistical_continuum'
 out_dir.mkdir(exist_ok=True, parents=True)
@@ -53,11 +61,21 @@ p_vals_ftrs_cnfds_fname = (
 )
 corr_ftrs_cnfds_abs_fname = (
     out_dir / 'summary_abs_correlations_GMV_allUKB_confounds.csv')
+corr_vxls_cnfds_fname = (
+    out_dir / 'voxelwise_correlations_GMD_allUKB_confounds.nii.gz')
+p_vals_vxls_cnfds_fname = (
+    out_dir / 'voxelwise_pvals_GMD_allUKB_confounds.nii.gz')
+vxls_cnfds_fname = (  # confound and correlation type of each volume
+    out_dir / 'voxelwise_confounds_GMD_allUKB_confounds.csv')
 
 # %%
 # load data
-FTR = feature_choice(feature=feature, project_dir=project_dir)
-logger.info(f'Features {feature} loaded.')
+if voxelwise:
+    VXL = load_voxel_matrix(voxel_matrix_dir)
+    logger.info(f'Voxel matrix loaded from {voxel_matrix_dir}.')
+else:
+    FTR = feature_choice(feature=feature, project_dir=project_dir)
+    logger.info(f'Features {feature} loaded.')
 CNFD = dt.fread(confound_fname)
 CNFD = CNFD.to_pandas()
 CNFD.set_index('SubjectID', inplace=True)
@@ -420,7 +438,49 @@ else:
 # %%
 # Correlate all confounds with GMV (confound-feature relationship)
 
-if (os.path.isfile(corr_ftrs_cnfds_fname)
+if voxelwise:
+    # Remove target related confounds and non-rankable discrete confounds
+    trgt_cols = [
+        'Hand_grip_strength_left-0', 'Hand_grip_strength_right-0',
+        'HGS_mean_left_right']
+    confounds = [
+        x for x in CNFD.columns
+        if x not in trgt_cols + discrete_cols]
+    missed = [
+        x for x in confounds
+        if x not in cont_cols + discrete_cols_rank + binary_cols]
+    if len(missed) > 0:
+        logger.warning(f'The columns {missed} were missed to be included.')
+        confounds = [x for x in confounds if x not in missed]
+    corr_types = [
+        'spearman' if x in discrete_cols_rank else 'pearson'
+        for x in confounds]
+
+    # confounds in the order of the voxel matrix columns (2nd session only,
+    # other columns have no confounds and are excluded per confound)
+    sbj_order = [
+        sbj if ses == 'ses-2' else None for sbj, ses in VXL['subject_ids']]
+    VXL_CNFD = CNFD[confounds].reindex(sbj_order)
+    logger.info(
+        f'{VXL_CNFD.notna().any(axis=1).sum()} subjects of the voxel matrix '
+        'have confounds.')
+
+    # stream the voxel matrix in blocks of voxels
+    corr, p_vals = correlate_voxel_matrix(
+        VXL, VXL_CNFD, method=corr_types, block_size=voxel_block_size)
+
+    # Save correlation and p value maps (one volume per confound)
+    nib.save(voxel_matrix_to_nifti(corr, VXL), corr_vxls_cnfds_fname)
+    logger.info(f'Correlation maps were saved to {corr_vxls_cnfds_fname}.')
+    nib.save(voxel_matrix_to_nifti(p_vals, VXL, fill_value=1.),
+             p_vals_vxls_cnfds_fname)
+    logger.info(f'p value maps were saved to {p_vals_vxls_cnfds_fname}.')
+    pd.DataFrame(
+        {'confounds': confounds, 'corr_type': corr_types}).rename_axis(
+            'volume').to_csv(vxls_cnfds_fname)
+    logger.info(
+        f'Confounds of the map volumes were saved to {vxls_cnfds_fname}.')
+elif (os.path.isfile(corr_ftrs_cnfds_fname)
         and os.path.isfile(p_vals_ftrs_cnfds_fname)):
     CORR = pd.read_csv(corr_ftrs_cnfds_fname, index_col=[0])
     p_vals = pd.read_csv(p_vals_ftrs_cnfds_fname, index_col=[0])
@@ -0,0 +1,132 @@
+# %%
+# import packages
+import os
+from pathlib import Path
+import time
+from argparse import ArgumentParser
+
+from confoundcontinuum.logging import configure_logging, log_versions
+from confoundcontinuum.logging import logger
+from confoundcontinuum.jobs import get_dag_jobs, get_submit_jobs, run_jobs
+
+# %%
+# configure logging
+
+configure_logging()
+log_versions()
+
+# %%
+# set up
+
+# RUN THINGS IN ROOT DIRECTORY OF PROJECT!
+project_dir = Path(os.getcwd())
+
+# pipeline help (parser)
+parser = ArgumentParser(
+    description='Run the jobs of a HTCondor DAG file (e.g. '
+    '1_feature_extraction/1_gmd_schaefer.dag) or submit file (e.g. '
+    '4_prediction/2_predict.submit with the job options of '
+    '1_create_pipeline_options.py) on this machine without HTCondor. Jobs '
+    'run in parallel as long as their requested CPUs and memory fit the '
+    'resources, pinned to their CPUs and killed if exceeding their memory '
+    'request. Failed jobs are retried. Wall time and peak resident memory '
+    '(RSS) of each job are saved as CSV. '
+    'INPUT parameters required: --dag or --submit. '
+    'INPUT parameters optional: --ncpus, --memory, --retries, --initialdir, '
+    '--executable, --nomemlimit, --results. '
+    'See parameter help for more information.'
+)
+
+# job definitions
+jobs_group = parser.add_mutually_exclusive_group(required=True)
+jobs_group.add_argument(
+    '--dag', metavar='dag', type=str,
+    help='Path of the DAG file (JOB, VARS, RETRY and PARENT/CHILD).')
+jobs_group.add_argument(
+    '--submit', metavar='submit', type=str,
+    help='Path of the submit file (queue, queue <N> or '
+         'queue <variables> from <file>).')
+
+# resources
+parser.add_argument(
+    '--ncpus', metavar='ncpus', type=int, default=None,
+    help='Number of CPUs to use. Defaults to all available CPUs.')
+parser.add_argument(
+    '--memory', metavar='memory', type=float, default=None,
+    help='Memory to use in GB. Defaults to the total memory.')
+
+# retries
+parser.add_argument(
+    '--retries', metavar='retries', type=int, default=1,
+    help='Number of retries of failed jobs (RETRY in the DAG file takes '
+         'precedence). Defaults to 1.')
+
+# paths of the cluster
+parser.add_argument(
+    '--initialdir', metavar='initialdir', type=str, default=None,
+    help='Overrides initial_dir of the submit files (e.g. the path of the '
+         'repository on this machine). Defaults to initial_dir of the '
+         'submit files.')
+parser.add_argument(
+    '--executable', metavar='executable', type=str, default=None,
+    help='Overrides the executable of the submit files, e.g. a copy of '
+         'run_in_venv.sh activating the local environment. Defaults to the '
+         'executable of the submit files.')
+
+# memory limit
+parser.add_argument(
+    '--nomemlimit', action='store_true',
+    help='Do not kill jobs exceeding their memory request.')
+
+# results
+parser.add_argument(
+    '--results', metavar='results', type=str, default=None,
+    help='Path of the CSV with the status, wall time and peak RSS of each '
+         'job. Defaults to <dag or submit file>.jobs.csv.')
+
+# pass input parameters to variables
+args = parser.parse_args()
+jobs_fname = Path(args.dag if args.dag is not None else args.submit)
+n_cpus = args.ncpus
+memory = None if args.memory is None else args.memory * 1024
+retries = args.retries
+variables = (
+    None if args.initialdir is None else {'initial_dir': args.initialdir})
+executable = args.executable
+enforce_memory = not args.nomemlimit
+results_path = (
+    Path(f'{jobs_fname}.jobs.csv') if args.results is None
+    else Path(args.results))
+
+# %%
+# read the jobs
+
+if args.dag is not None:
+    jobs = get_dag_jobs(jobs_fname, variables)
+else:
+    jobs = get_submit_jobs(jobs_fname, variables)
+if executable is not None:
+    for t_job in jobs:
+        t_job['executable'] = Path(executable)
+logger.info(f'{len(jobs)} jobs read from {jobs_fname}.')
+
+# %%
+# run the jobs
+
+start_time = time.time()
+
+results = run_jobs(
+    jobs, n_cpus=n_cpus, memory=memory, retries=retries,
+    enforce_memory=enforce_memory)
+results_path.parent.mkdir(exist_ok=True, parents=True)
+results.to_csv(results_path, index=False)
+logger.info(f'Status, wall time and peak RSS of the jobs saved in '
+            f'{results_path}.')
+
+# info and compute time
+elapsed_time = time.time() - start_time
+logger.info(f'PROCESSING DONE for {len(jobs)} jobs '
+            f'({(results["status"] != "done").sum()} not done). Elapsed '
+            f'time: {elapsed_time} s.\n')
+
+# %%